@@ -11,6 +11,7 @@ from utils.copilot import add_context_to_copilot
 from utils.exam_trainer import setup_exam_trainer
 from utils.functions import load_env_vars, load_model
 from utils.profiles import default_profile, exam_trainer_profile
+from utils.reference_store import ReferenceStore
 from utils.tools import (
     query_vector_db,
     query_wolfram_alpha,
@@ -192,7 +193,7 @@ async def on_chat_start() -> None:
     cl.user_session.set("permitted_document_ids", permitted_document_ids)
     cl.user_session.set("settings", DEFAULT_SETTINGS)
     cl.user_session.set("chat_history", [])
-    cl.user_session.set("references", [])
+    cl.user_session.set("references", ReferenceStore())
     cl.user_session.set("copilot_context", None)
     cl.user_session.set("num_user_messages", 0)
 
@@ -201,6 +202,14 @@ async def on_chat_start() -> None:
         await setup_exam_trainer()
 
 
+@cl.on_chat_end
+async def on_chat_end() -> None:
+    # removes the references which were spilled to disk
+    references: ReferenceStore | None = cl.user_session.get("references", None)
+    if references is not None:
+        references.close()
+
+
 # Decorator to process each message sent by the user
 @cl.on_message
 async def main(message: cl.Message) -> None:
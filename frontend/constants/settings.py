@@ -13,9 +13,22 @@ DEFAULT_SETTINGS = {
         "streaming": True,  # Streaming mode
     },
     "app_settings": {
-        "max_tokens": -1,  # Maximum amount of tokens to send to the model, -1 for unlimited
+        "compact_tool_turns": 2,  # Tool responses older than this amount of turns are sent as citation keys and excerpts, -1 to disable
+        "max_tokens": -1,  # Maximum amount of tokens to send to the model, -1 for the budget of the model in MODEL_TOKEN_BUDGETS
         "max_tool_recursion": 5,  # Maximum amount of tool recursions, the model must respond to the user after this amount
         "max_images": 1,  # Maximum amount of images to send to the model
         "max_messages": -1,  # Maximum amount of messages the user can send before the chat is stopped
+        "speculative_retrieval": False,  # Query the vector database with the user message while the model is called
     },
 }
+
+# the prompt budget of the models, the oldest turns of the chat history are dropped to stay below it
+# the budgets are well below the context windows, long prompts are slow and expensive
+MODEL_TOKEN_BUDGETS = {
+    "gpt-4o-mini": 32_000,
+    "gpt-4o": 32_000,
+    "claude-3-5-sonnet-20240620": 32_000,
+    "claude-3-haiku-20240307": 32_000,
+    "llama3.1": 8_000,
+}
+DEFAULT_TOKEN_BUDGET = 16_000
@@ -1,3 +1,4 @@
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 
 import jwt
@@ -6,8 +7,19 @@ from chainlit.utils import mount_chainlit
 from constants.urls import VALIDATION_URL
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from utils.http_client import close_http_session, get_http_session
+from utils.prefetch import prefetch_metrics
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the pooled session of the tools is opened once and closed on shutdown
+    get_http_session()
+    yield
+    await close_http_session()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost",
@@ -80,4 +92,9 @@ async def read_main(request: Request):
     return {"access_token": token}
 
 
+@app.get("/metrics")
+async def metrics():
+    return {"query_prefetch": prefetch_metrics()}
+
+
 mount_chainlit(app=app, target="app.py", path="")
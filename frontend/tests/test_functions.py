@@ -0,0 +1,139 @@
+import chainlit as cl
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+from utils import functions
+from utils.functions import (
+    DROPPED_TOOL_RESPONSE,
+    compact_tool_messages,
+    limit_context,
+)
+
+
+class FakeUserSession(dict):
+    def set(self, key, value) -> None:
+        self[key] = value
+
+
+@pytest.fixture(autouse=True)
+def user_session(monkeypatch):
+    user_session = FakeUserSession()
+    monkeypatch.setattr(cl, "user_session", user_session)
+    # one token per word, the tiktoken encodings are not needed for the tests
+    monkeypatch.setattr(functions, "count_text_tokens", lambda text: len(text.split()))
+    monkeypatch.setattr(functions, "POST_PROMPT", "")
+    return user_session
+
+
+def tool_response(reference_key: str, num_words: int) -> str:
+    return (
+        "## Sektions Referenz\n"
+        f"**Zitationsschlüssel**: [{reference_key}]\n"
+        "**Inhalt**:\n" + " ".join(["Wort"] * num_words) + "\n## Ende der Antwort"
+    )
+
+
+def turn(question: str, tool_call_ids: list[str], num_words: int) -> list:
+    return [
+        HumanMessage(content=question),
+        AIMessage(
+            content="",
+            tool_calls=[
+                {"name": "search", "args": {"query": question}, "id": tool_call_id}
+                for tool_call_id in tool_call_ids
+            ],
+        ),
+        *[
+            ToolMessage(
+                content=tool_response(f"EX1.{tool_call_id}", num_words),
+                tool_call_id=tool_call_id,
+            )
+            for tool_call_id in tool_call_ids
+        ],
+    ]
+
+
+def assert_tool_calls_are_answered(messages: list) -> None:
+    tool_call_ids = [
+        tool_call["id"]
+        for message in messages
+        if type(message) == AIMessage
+        for tool_call in message.tool_calls
+    ]
+    tool_response_ids = [
+        message.tool_call_id for message in messages if type(message) == ToolMessage
+    ]
+    assert tool_call_ids == tool_response_ids
+
+
+def test_limit_context_drops_whole_turns():
+    chat_history = [
+        SystemMessage(content="System"),
+        *turn("Was ist Impuls?", ["a"], 100),
+        *turn("Was ist Energie?", ["b"], 100),
+    ]
+
+    messages = limit_context(chat_history, max_tokens=150)
+
+    assert messages[0] == chat_history[0]
+    assert messages[1].content == "Was ist Energie?"
+    assert_tool_calls_are_answered(messages)
+    assert len(chat_history) == 7
+
+
+def test_limit_context_keeps_a_history_which_fits():
+    chat_history = [
+        SystemMessage(content="System"),
+        *turn("Was ist Impuls?", ["a"], 10),
+    ]
+
+    assert limit_context(chat_history, max_tokens=1000) is chat_history
+
+
+def test_limit_context_shrinks_the_oldest_tool_responses_of_the_current_turn():
+    chat_history = [
+        SystemMessage(content="System"),
+        *turn("Was ist Impuls?", ["a", "b", "c"], 400),
+    ]
+
+    messages = limit_context(chat_history, max_tokens=600)
+
+    assert_tool_calls_are_answered(messages)
+    assert sum(functions.count_message_tokens(message) for message in messages) <= 600
+    # the latest tool response is kept in full
+    assert messages[-1] is chat_history[-1]
+    assert "Gekürzte Tool Antwort" in messages[-3].content
+    assert chat_history[-3].content == tool_response("EX1.a", 400)
+
+
+def test_limit_context_replaces_tool_responses_which_are_too_long_even_as_excerpts():
+    chat_history = [
+        SystemMessage(content="System"),
+        *turn("Was ist Impuls?", ["a", "b"], 400),
+    ]
+
+    messages = limit_context(chat_history, max_tokens=100)
+
+    assert_tool_calls_are_answered(messages)
+    assert [message.content for message in messages[-2:]] == [
+        DROPPED_TOOL_RESPONSE,
+        DROPPED_TOOL_RESPONSE,
+    ]
+
+
+def test_compact_tool_messages_keeps_the_latest_turns():
+    chat_history = [
+        SystemMessage(content="System"),
+        *turn("Was ist Impuls?", ["a"], 400),
+        *turn("Was ist Energie?", ["b"], 400),
+        *turn("Was ist Arbeit?", ["c"], 400),
+    ]
+
+    messages = compact_tool_messages(chat_history, keep_turns=2)
+
+    assert messages[3].content.startswith("## Gekürzte Tool Antwort")
+    assert "[EX1.a]: Wort Wort" in messages[3].content
+    assert messages[3].tool_call_id == "a"
+    assert messages[6:] == chat_history[6:]
+    # the compacted messages are cached, so the token counts of limit_context stay cached
+    assert compact_tool_messages(chat_history, keep_turns=2)[3] is messages[3]
+    assert compact_tool_messages(chat_history, keep_turns=-1) is chat_history
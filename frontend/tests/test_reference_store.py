@@ -0,0 +1,69 @@
+import os
+
+from utils.reference_store import ReferenceStore
+from utils.references import SectionReference
+
+
+def section_reference(section_id: str, num_chars: int) -> SectionReference:
+    return SectionReference(
+        document_name="Experimentalphysik 1",
+        chapter_name="1 Einleitung",
+        section_name=f"1.{section_id} Grundlagen",
+        document_id="EX1",
+        chapter_id="1",
+        section_id=section_id,
+        content="a" * num_chars,
+    )
+
+
+def test_least_recently_used_references_are_spilled_and_loaded_again():
+    reference_store = ReferenceStore(max_chars=250)
+    for section_id in ["1", "2"]:
+        reference_store.add(section_reference(section_id, 100))
+    # marks 1.1 as recently used, so 1.2 is spilled first
+    reference_store.get("EX1 1.1")
+    reference_store.add(section_reference("3", 100))
+
+    assert list(reference_store.references) == ["EX1 1.1", "EX1 1.3"]
+    assert reference_store.spilled_keys == {"EX1 1.2"}
+    assert reference_store.num_chars == 200
+    assert len(reference_store) == 3
+    assert "EX1 1.2" in reference_store
+
+    spilled_reference = reference_store.get("EX1 1.2")
+    assert spilled_reference.content == "a" * 100
+    assert reference_store.spilled_keys == {"EX1 1.1"}
+    assert reference_store.get("EX1 9.9") is None
+
+    reference_store.close()
+
+
+def test_the_first_reference_with_a_key_is_kept():
+    reference_store = ReferenceStore(max_chars=250)
+    first_reference = section_reference("1", 100)
+    reference_store.add(first_reference)
+    reference_store.add(section_reference("1", 200))
+
+    assert reference_store.get("EX1 1.1") is first_reference
+    assert reference_store.num_chars == 100
+
+
+def test_a_reference_larger_than_the_limit_stays_in_memory():
+    reference_store = ReferenceStore(max_chars=50)
+    reference_store.add(section_reference("1", 100))
+
+    assert list(reference_store.references) == ["EX1 1.1"]
+    assert reference_store.spill_dir is None
+
+
+def test_close_removes_the_spill_files():
+    reference_store = ReferenceStore(max_chars=150)
+    for section_id in ["1", "2"]:
+        reference_store.add(section_reference(section_id, 100))
+    spill_dir = reference_store.spill_dir
+    assert os.path.isdir(spill_dir)
+
+    reference_store.close()
+
+    assert not os.path.exists(spill_dir)
+    assert len(reference_store) == 0
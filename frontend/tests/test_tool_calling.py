@@ -0,0 +1,135 @@
+import asyncio
+import json
+
+import chainlit as cl
+import pytest
+from langchain_core.messages import ToolMessage
+from utils import tool_calling, tools
+from utils.stream_handler import apply_tool_constraints
+from utils.tool_calling import ToolDispatcher
+
+
+class FakeUserSession(dict):
+    def set(self, key, value) -> None:
+        self[key] = value
+
+
+@pytest.fixture
+def user_session(monkeypatch):
+    user_session = FakeUserSession(
+        settings={
+            "retrieval_settings": {
+                "collection_name": "default",
+                "top_k": 200,
+                "top_n": 5,
+                "use_rerank": True,
+                "extend_results": False,
+                "rerank_score_threshold": 0.1,
+            }
+        },
+        permitted_document_ids=None,
+    )
+    monkeypatch.setattr(cl, "user_session", user_session)
+    return user_session
+
+
+@pytest.fixture
+def backend_requests(monkeypatch):
+    # records the backend requests instead of sending them
+    backend_requests = []
+
+    async def post_json(url: str, request_json_body: dict) -> dict:
+        backend_requests.append(url)
+        await asyncio.sleep(0.05)
+        return {"url": url}
+
+    monkeypatch.setattr(tools, "post_json", post_json)
+    return backend_requests
+
+
+@pytest.fixture
+def tool_runs(monkeypatch):
+    # the steps and references of the tools are created in run_tool_call
+    tool_runs = []
+
+    async def run_tool_call(tool_call):
+        response_json = await tools.get_tool_response(
+            *tools.build_tool_request(tool_call)
+        )
+        tool_runs.append(tool_call["id"])
+        return ToolMessage(
+            tool_call_id=tool_call["id"],
+            name=tool_call["name"],
+            content=json.dumps(response_json),
+        )
+
+    monkeypatch.setattr(tool_calling, "run_tool_call", run_tool_call)
+    return tool_runs
+
+
+QUERY_CALL = {
+    "id": "call_query",
+    "name": "query_vector_db",
+    "args": {"query": "Energieerhaltung beim Pendel"},
+}
+TOC_CALL = {
+    "id": "call_toc",
+    "name": "retrieve_table_of_contents",
+    "args": {"script_id": "EX1"},
+}
+
+
+def test_dropped_tool_call_is_not_run(user_session, backend_requests, tool_runs):
+    async def main():
+        tool_dispatcher = ToolDispatcher()
+        # the query is complete first, the table of contents call drops it
+        tool_dispatcher.dispatch(QUERY_CALL)
+        query_request = tool_dispatcher.requests[QUERY_CALL["id"]]
+        tool_dispatcher.dispatch(TOC_CALL)
+
+        tool_calls = apply_tool_constraints([QUERY_CALL, TOC_CALL])
+        tool_messages = await tool_dispatcher.gather(tool_calls)
+        await asyncio.sleep(0)
+        return query_request, tool_messages
+
+    query_request, tool_messages = asyncio.run(main())
+
+    assert tool_runs == [TOC_CALL["id"]]
+    assert [message.tool_call_id for message in tool_messages] == [TOC_CALL["id"]]
+    assert query_request.cancelled()
+    assert user_session["tool_requests"] is None
+
+
+def test_early_request_is_used_by_the_tool_call(
+    user_session, backend_requests, tool_runs
+):
+    async def main():
+        tool_dispatcher = ToolDispatcher()
+        tool_dispatcher.dispatch(QUERY_CALL)
+        # the model is still streaming
+        await asyncio.sleep(0.1)
+        assert tool_runs == []
+        return await tool_dispatcher.gather([QUERY_CALL])
+
+    tool_messages = asyncio.run(main())
+
+    assert backend_requests == [tools.VECTOR_DB_URL]
+    assert tool_runs == [QUERY_CALL["id"]]
+    assert json.loads(tool_messages[0].content) == {"url": tools.VECTOR_DB_URL}
+
+
+def test_tool_calls_without_request_are_run_in_gather(
+    user_session, backend_requests, tool_runs
+):
+    tool_call = {"id": "call_bad", "name": "retrieve_section", "args": {}}
+
+    async def main():
+        tool_dispatcher = ToolDispatcher()
+        tool_dispatcher.dispatch(tool_call)
+        return tool_dispatcher
+
+    tool_dispatcher = asyncio.run(main())
+
+    # bad arguments are reported by the tool itself, nothing is sent early
+    assert tool_dispatcher.requests == {tool_call["id"]: None}
+    assert backend_requests == []
@@ -0,0 +1,93 @@
+import base64
+import copy
+import os
+import sys
+import time
+import tracemalloc
+
+# run from anywhere, the utils are imported from the frontend directory
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+from constants.prompts import POST_PROMPT
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+from utils.functions import inject_post_prompt
+
+NUM_TURNS = 20
+# a turn calls the model up to max_tool_recursion + 1 times
+NUM_CALLS_PER_TURN = 6
+TOOL_RESPONSE_SIZE = 8_000
+IMAGE_SIZE = 40_000
+
+
+def inject_post_prompt_deepcopy(chat_history: list) -> list:
+    # the previous implementation, a deep copy of the whole chat history per call
+    chat_history_temp = copy.deepcopy(chat_history)
+    for message in reversed(chat_history_temp):
+        if type(message) == HumanMessage:
+            for content in message.content:
+                if content["type"] == "text":
+                    content["text"] += POST_PROMPT
+            break
+    return chat_history_temp
+
+
+def build_chat_history(num_turns: int) -> list:
+    image_url = "data:image/jpeg;base64," + base64.b64encode(
+        os.urandom(IMAGE_SIZE)
+    ).decode("utf-8")
+
+    chat_history = [SystemMessage("System Prompt " * 500)]
+    for turn in range(num_turns):
+        chat_history.append(
+            HumanMessage(
+                [
+                    {"type": "text", "text": f"Frage {turn}"},
+                    {"type": "image_url", "image_url": {"url": image_url}},
+                ]
+            )
+        )
+        tool_call = {"id": f"call_{turn}", "name": "query_vector_db", "args": {}}
+        chat_history.append(AIMessage("", tool_calls=[tool_call]))
+        chat_history.append(
+            ToolMessage("x" * TOOL_RESPONSE_SIZE, tool_call_id=f"call_{turn}")
+        )
+        chat_history.append(AIMessage("Antwort " * 200))
+    return chat_history
+
+
+def measure(inject, chat_history: list) -> tuple[float, int]:
+    # the memory allocated by the calls of a turn, it is garbage after the model calls
+    allocated = 0
+    duration = 0.0
+    tracemalloc.start()
+    for _ in range(NUM_CALLS_PER_TURN):
+        tracemalloc.reset_peak()
+        size_before, _ = tracemalloc.get_traced_memory()
+        start_time = time.perf_counter()
+        messages = inject(chat_history)
+        duration += time.perf_counter() - start_time
+        _, peak = tracemalloc.get_traced_memory()
+        allocated += peak - size_before
+        del messages
+    tracemalloc.stop()
+    return duration / NUM_CALLS_PER_TURN, allocated
+
+
+def main() -> None:
+    for num_turns in [1, 5, NUM_TURNS]:
+        chat_history = build_chat_history(num_turns)
+        for name, inject in [
+            ("deepcopy", inject_post_prompt_deepcopy),
+            ("shared", inject_post_prompt),
+        ]:
+            assert inject(chat_history)[-4].content[0]["text"].endswith(POST_PROMPT)
+            duration, allocated = measure(inject, chat_history)
+            print(
+                f"{len(chat_history):4d} messages, {name:>8}: "
+                f"{duration * 1000:8.3f} ms per call, "
+                f"{allocated / 1024:9.1f} KiB allocated per turn"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+# run from anywhere, the utils are imported from the frontend directory
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+from utils.stream_renderer import StreamRenderer
+
+NUM_RESPONSES = 5
+NUM_TOKENS = 600
+# the typical time between two tokens of the streamed models
+TOKEN_INTERVAL = 0.01
+
+TOKENS = [
+    " Die",
+    " Energie",
+    " ist",
+    " erhalten",
+    ",",
+    " also",
+    " gilt",
+    " \\(",
+    "E",
+    " =",
+    " \\frac{1}{2}",
+    " m",
+    " v^2",
+    " \\)",
+    ".",
+    "\n\n",
+]
+
+
+class FakeMessage:
+    # counts the frames which would be sent over the websocket by chainlit
+    def __init__(self) -> None:
+        self.content = ""
+        self.frames_sent = 0
+        self.bytes_sent = 0
+
+    async def send(self) -> None:
+        await self.update()
+
+    async def update(self) -> None:
+        # chainlit serializes and emits the whole message on every update
+        frame = json.dumps({"output": self.content})
+        self.frames_sent += 1
+        self.bytes_sent += len(frame)
+
+
+async def stream_response(
+    flush_interval: float,
+    flush_size: int,
+) -> tuple[FakeMessage, float]:
+    msg = FakeMessage()
+    await msg.send()
+    renderer = StreamRenderer(
+        msg,
+        flush_interval=flush_interval,
+        flush_size=flush_size,
+    )
+
+    cpu_time = 0.0
+    for _ in range(NUM_TOKENS):
+        await asyncio.sleep(TOKEN_INTERVAL)
+        start_time = time.process_time()
+        await renderer.write(random.choice(TOKENS))
+        cpu_time += time.process_time() - start_time
+
+    start_time = time.process_time()
+    await renderer.close()
+    cpu_time += time.process_time() - start_time
+
+    return msg, cpu_time
+
+
+async def main() -> None:
+    # flush_size=0 updates the message on every token, the previous behavior
+    for name, flush_interval, flush_size in [
+        ("per token", 0.0, 0),
+        ("throttled", 0.05, 64),
+    ]:
+        frames_sent, bytes_sent, cpu_time = 0, 0, 0.0
+        for _ in range(NUM_RESPONSES):
+            msg, response_cpu_time = await stream_response(flush_interval, flush_size)
+            frames_sent += msg.frames_sent
+            bytes_sent += msg.bytes_sent
+            cpu_time += response_cpu_time
+
+        print(
+            f"{name:>10}: {frames_sent / NUM_RESPONSES:7.1f} frames, "
+            f"{bytes_sent / NUM_RESPONSES / 1024:8.1f} KiB, "
+            f"{cpu_time / NUM_RESPONSES * 1000:6.2f} ms CPU per response"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
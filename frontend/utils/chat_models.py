@@ -0,0 +1,50 @@
+from typing import Any, AsyncIterator, List, Optional
+
+from langchain_anthropic import ChatAnthropic
+from langchain_anthropic.chat_models import (
+    _make_message_chunk_from_anthropic_event,
+    _tools_in_params,
+)
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk
+
+
+class ChatAnthropicWithCacheUsage(ChatAnthropic):
+    """
+    langchain_anthropic==0.1.23 drops the cache fields of the usage when streaming.
+    Same stream as ChatAnthropic, but the raw usage of the message_start event is kept in the response_metadata of its chunk,
+    it contains cache_read_input_tokens and cache_creation_input_tokens, see record_token_usage.
+    """
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        *,
+        stream_usage: Optional[bool] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        if stream_usage is None:
+            stream_usage = self.stream_usage
+        kwargs["stream"] = True
+        payload = self._get_request_payload(messages, stop=stop, **kwargs)
+        stream = await self._async_client.messages.create(**payload)
+        coerce_content_to_string = not _tools_in_params(payload)
+        async for event in stream:
+            msg = _make_message_chunk_from_anthropic_event(
+                event,
+                stream_usage=stream_usage,
+                coerce_content_to_string=coerce_content_to_string,
+            )
+            if msg is None:
+                continue
+
+            if event.type == "message_start":
+                msg.response_metadata["usage"] = event.message.usage.model_dump()
+
+            chunk = ChatGenerationChunk(message=msg)
+            if run_manager and isinstance(msg.content, str):
+                await run_manager.on_llm_new_token(msg.content, chunk=chunk)
+            yield chunk
@@ -1,6 +1,8 @@
 import base64
-import copy
+import functools
+import json
 import os
+import re
 import uuid
 
 import chainlit as cl
@@ -12,14 +14,37 @@ from constants.prompts import (
     SYSTEM_PROMPT_EXAM_TRAINER_TEMPLATE,
     SYSTEM_PROMPT_TEMPLATE,
 )
-from constants.settings import DEFAULT_SETTINGS
+from constants.settings import (
+    DEFAULT_SETTINGS,
+    DEFAULT_TOKEN_BUDGET,
+    MODEL_TOKEN_BUDGETS,
+)
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.messages import (
+    AIMessage,
     BaseMessage,
     HumanMessage,
     SystemMessage,
+    ToolMessage,
 )
 
+# images are sent with detail "low", which is a fixed amount of tokens
+IMAGE_TOKENS = 85
+# the role and separators of every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# the references in the tool responses, see print_reference
+TOOL_REFERENCE_PATTERN = re.compile(
+    r"\*\*(?:Zitationsschlüssel|Citation Key)\*\*: \[(.+?)\].*?\*\*(?:Inhalt|Content)\*\*:\n(.*?)(?=\n## \w+ Referen|\n## Ende der Antwort|\Z)",
+    re.DOTALL,
+)
+EXCERPT_LENGTH = 200
+# replaces a tool response which does not fit into the token budget even after the compaction
+DROPPED_TOOL_RESPONSE = "## Gekürzte Tool Antwort\nDie Antwort war zu lang für den Kontext, die Inhalte können bei Bedarf gezielter erneut mit den Tools abgerufen werden."
+
+# anthropic only caches the prompt up to explicit breakpoints, openai caches the longest common prefix automatically
+CACHE_CONTROL = {"type": "ephemeral"}
+
 
 def load_model() -> BaseChatModel:
 
@@ -29,25 +54,35 @@ def load_model() -> BaseChatModel:
     if provider == "openai":
         from langchain_openai import ChatOpenAI
 
+        # the usage of the stream contains the cached prompt tokens
         model = ChatOpenAI(
             model=model_name,
+            stream_usage=True,
             **DEFAULT_SETTINGS["model_settings"],
         )
     elif provider == "azure":
         from langchain_openai import AzureChatOpenAI
 
+        # stream_options is only accepted by api versions 2024-09-01-preview and newer
+        model_kwargs = {}
+        if os.getenv("AZURE_OPENAI_CHAT_STREAM_USAGE", "false").lower() == "true":
+            model_kwargs["stream_options"] = {"include_usage": True}
+
         model = AzureChatOpenAI(
             api_key=os.getenv("AZURE_OPENAI_CHAT_API_KEY"),
             azure_deployment=os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT"),
             api_version=os.getenv("AZURE_OPENAI_CHAT_API_VERSION"),
             azure_endpoint=os.getenv("AZURE_OPENAI_CHAT_ENDPOINT"),
+            model_kwargs=model_kwargs,
             **DEFAULT_SETTINGS["model_settings"],
         )
     elif provider == "anthropic":
-        from langchain_anthropic import ChatAnthropic
+        from .chat_models import ChatAnthropicWithCacheUsage
 
-        model = ChatAnthropic(
+        # the cache breakpoints are added in add_cache_control
+        model = ChatAnthropicWithCacheUsage(
             model=model_name,
+            default_headers={"anthropic-beta": "prompt-caching-2024-07-31"},
             **DEFAULT_SETTINGS["model_settings"],
         )
     else:
@@ -153,26 +188,333 @@ def format_system_prompt(prompt_type: str = "default") -> str:
 def inject_post_prompt(chat_history: list[BaseMessage]) -> list[BaseMessage]:
     """
     Injects the post prompt to the latest user message in the chat history.
-    Returns a copy of the chat history with the post prompt injected.
+    Returns a new list with a copy of the latest user message, all other messages are shared with the chat history.
     """
-    chat_history_temp = copy.deepcopy(chat_history)
-
-    if len(chat_history_temp) == 0:
-        return chat_history_temp
-
     # go trough the chat history in reverse order
     # and inject the post prompt to the first user message
-    for message in reversed(chat_history_temp):
+    for message_idx in range(len(chat_history) - 1, -1, -1):
+        message = chat_history[message_idx]
         if type(message) == HumanMessage:
-            if type(message.content) == list:
-                for content in message.content:
-                    if content["type"] == "text":
-                        content["text"] += POST_PROMPT
-            elif type(message.content) == str:
-                message.content += POST_PROMPT
             break
+    else:
+        return list(chat_history)
+
+    # only the text parts are copied, the images are shared
+    if type(message.content) == list:
+        content = [
+            (
+                {**part, "text": part["text"] + POST_PROMPT}
+                if part["type"] == "text"
+                else part
+            )
+            for part in message.content
+        ]
+    elif type(message.content) == str:
+        content = message.content + POST_PROMPT
+    else:
+        content = message.content
+
+    return [
+        *chat_history[:message_idx],
+        message.copy(update={"content": content}),
+        *chat_history[message_idx + 1 :],
+    ]
+
+
+@functools.cache
+def get_encoding():
+    # imported here, tiktoken is only installed through langchain_openai
+    import tiktoken
+
+    # the counts are only an estimate for the models which are not from OpenAI
+    return tiktoken.get_encoding("o200k_base")
+
+
+def count_text_tokens(text: str) -> int:
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+
+def count_message_tokens(message: BaseMessage) -> int:
+    num_tokens = MESSAGE_OVERHEAD_TOKENS
+    if type(message.content) == str:
+        num_tokens += count_text_tokens(message.content)
+    else:
+        for content in message.content:
+            if content["type"] == "text":
+                num_tokens += count_text_tokens(content["text"])
+            else:
+                num_tokens += IMAGE_TOKENS
+
+    if type(message) == AIMessage:
+        for tool_call in message.tool_calls:
+            num_tokens += count_text_tokens(
+                tool_call["name"] + json.dumps(tool_call["args"], ensure_ascii=False)
+            )
+
+    return num_tokens
+
+
+def get_token_budget(max_tokens: int = -1) -> int:
+    if max_tokens > 0:
+        return max_tokens
+    model_name = os.getenv("LANDAU_MODEL_NAME", "gpt-4o-mini")
+    return MODEL_TOKEN_BUDGETS.get(model_name, DEFAULT_TOKEN_BUDGET)
+
+
+def limit_context(
+    chat_history: list[BaseMessage],
+    max_tokens: int = -1,
+) -> list[BaseMessage]:
+    """
+    Drops the oldest turns of the chat history until it fits into the token budget of the model.
+    A turn starts with a user message, so an AIMessage is never separated from the ToolMessages of its tool calls.
+    If the current turn alone is still too long, its oldest tool responses are compacted and then replaced by a note,
+    the ToolMessages themselves are kept, so every tool call still has its response.
+    The system message and the current turn are always kept, the chat history itself is not modified.
+    """
+    max_tokens = get_token_budget(max_tokens) - count_text_tokens(POST_PROMPT)
+
+    # the messages are never modified after they are added, so their token counts are cached
+    # the messages are kept in the cache, otherwise their ids could be reused
+    token_counts: dict[int, tuple[BaseMessage, int]] = cl.user_session.get(
+        "token_counts", {}
+    )
+    num_tokens = []
+    for message in chat_history:
+        if id(message) not in token_counts:
+            token_counts[id(message)] = (message, count_message_tokens(message))
+        num_tokens.append(token_counts[id(message)][1])
+    cl.user_session.set(
+        "token_counts",
+        {id(message): token_counts[id(message)] for message in chat_history},
+    )
+
+    pinned_messages = 0
+    if len(chat_history) > 0 and type(chat_history[0]) == SystemMessage:
+        pinned_messages = 1
+
+    turn_starts = [
+        message_idx
+        for message_idx in range(pinned_messages, len(chat_history))
+        if type(chat_history[message_idx]) == HumanMessage
+    ]
+
+    total_tokens = sum(num_tokens)
+    first_message_idx = pinned_messages
+    for turn_start in turn_starts:
+        if total_tokens <= max_tokens:
+            break
+        total_tokens -= sum(num_tokens[first_message_idx:turn_start])
+        first_message_idx = turn_start
+
+    messages = chat_history[first_message_idx:]
+    # only the current turn is left, but it is still too long
+    shrink_tool_messages = total_tokens > max_tokens
+    if shrink_tool_messages:
+        messages, total_tokens = _shrink_tool_messages(
+            messages, num_tokens[first_message_idx:], total_tokens, max_tokens
+        )
+
+    if first_message_idx == pinned_messages and not shrink_tool_messages:
+        return chat_history
+
+    print(
+        f"Limited the context from {len(chat_history)} to "
+        f"{len(chat_history) - first_message_idx + pinned_messages} messages ({total_tokens} tokens)"
+    )
+    return chat_history[:pinned_messages] + messages
+
+
+def _shrink_tool_messages(
+    messages: list[BaseMessage],
+    num_tokens: list[int],
+    total_tokens: int,
+    max_tokens: int,
+) -> tuple[list[BaseMessage], int]:
+    # the oldest tool responses are shrunk first, the latest ones are the most relevant for the answer
+    # first every response is compacted to excerpts, only then the responses are replaced by a note
+    messages, num_tokens = list(messages), list(num_tokens)
+    for shrink in [
+        compact_tool_message,
+        lambda message: message.copy(update={"content": DROPPED_TOOL_RESPONSE}),
+    ]:
+        for message_idx, message in enumerate(messages):
+            if total_tokens <= max_tokens:
+                return messages, total_tokens
+            if type(message) != ToolMessage or type(message.content) != str:
+                continue
+            shrunk_message = shrink(message)
+            shrunk_tokens = count_message_tokens(shrunk_message)
+            if shrunk_tokens >= num_tokens[message_idx]:
+                continue
+            total_tokens -= num_tokens[message_idx] - shrunk_tokens
+            messages[message_idx] = shrunk_message
+            num_tokens[message_idx] = shrunk_tokens
+
+    return messages, total_tokens
+
+
+def compact_tool_message(message: ToolMessage) -> ToolMessage:
+    # the full content of the references stays in the references of the user session
+    references = TOOL_REFERENCE_PATTERN.findall(message.content)
+    if len(references) == 0:
+        return message
+
+    lines = [
+        "## Gekürzte Tool Antwort",
+        "Die vollständigen Inhalte können bei Bedarf erneut mit den Tools abgerufen werden.",
+    ]
+    for reference_key, content in references:
+        excerpt = " ".join(content.split())
+        if len(excerpt) > EXCERPT_LENGTH:
+            excerpt = excerpt[:EXCERPT_LENGTH].rsplit(" ", 1)[0] + " ..."
+        lines.append(f"[{reference_key}]: {excerpt}")
+
+    return message.copy(update={"content": "\n".join(lines)})
+
+
+def compact_tool_messages(
+    chat_history: list[BaseMessage],
+    keep_turns: int = 2,
+) -> list[BaseMessage]:
+    """
+    Replaces the references in the tool responses of all but the last keep_turns turns with their citation keys and a short excerpt.
+    The current turn is never compacted, -1 disables the compaction. The chat history itself is not modified.
+    """
+    if keep_turns < 0:
+        return chat_history
+
+    turn_starts = [
+        message_idx
+        for message_idx, message in enumerate(chat_history)
+        if type(message) == HumanMessage
+    ]
+    keep_turns = max(1, keep_turns)
+    if len(turn_starts) <= keep_turns:
+        return chat_history
+    compact_before = turn_starts[-keep_turns]
+
+    # the compacted messages are cached, so the token counts of limit_context are cached as well
+    compacted_messages: dict[int, tuple[ToolMessage, ToolMessage]] = (
+        cl.user_session.get("compacted_tool_messages", {})
+    )
+    messages = list(chat_history)
+    for message_idx in range(compact_before):
+        message = chat_history[message_idx]
+        if type(message) != ToolMessage or type(message.content) != str:
+            continue
+        if id(message) not in compacted_messages:
+            compacted_messages[id(message)] = (message, compact_tool_message(message))
+        messages[message_idx] = compacted_messages[id(message)][1]
+
+    cl.user_session.set(
+        "compacted_tool_messages",
+        {
+            id(message): compacted_messages[id(message)]
+            for message in chat_history[:compact_before]
+            if id(message) in compacted_messages
+        },
+    )
+    return messages
+
+
+def _with_cache_control(message: BaseMessage) -> BaseMessage:
+    if type(message.content) == str:
+        content = [
+            {"type": "text", "text": message.content, "cache_control": CACHE_CONTROL}
+        ]
+    else:
+        content = [
+            *message.content[:-1],
+            {**message.content[-1], "cache_control": CACHE_CONTROL},
+        ]
+    return message.copy(update={"content": content})
+
+
+def add_cache_control(messages: list[BaseMessage]) -> list[BaseMessage]:
+    """
+    Marks the cached prompt prefix for the providers which need explicit breakpoints.
+    The first breakpoint is the system message, which also caches the tool schemas in front of it.
+    The second one is the last message before the latest user message, i.e. the end of the previous turn.
+    Everything after it changes from call to call, e.g. the post prompt of the latest user message.
+    """
+    if os.getenv("LANDAU_MODEL_PROVIDER", "openai").lower() != "anthropic":
+        return messages
+
+    messages = list(messages)
+    if len(messages) > 0 and type(messages[0]) == SystemMessage:
+        messages[0] = _with_cache_control(messages[0])
+
+    for message_idx in range(len(messages) - 1, 0, -1):
+        if type(messages[message_idx]) == HumanMessage:
+            previous_message = messages[message_idx - 1]
+            if type(previous_message) == AIMessage and previous_message.content:
+                messages[message_idx - 1] = _with_cache_control(previous_message)
+            break
+
+    return messages
 
-    return chat_history_temp
+
+def start_turn_usage() -> None:
+    cl.user_session.set(
+        "turn_usage",
+        {
+            "model_calls": 0,
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "cache_read_tokens": 0,
+            "cache_creation_tokens": 0,
+        },
+    )
+
+
+def record_model_call() -> None:
+    turn_usage: dict | None = cl.user_session.get("turn_usage", None)
+    if turn_usage is not None:
+        turn_usage["model_calls"] += 1
+
+
+def record_token_usage(chunk: BaseMessage) -> None:
+    # called by the stream handlers for every chunk of the model calls of a turn
+    turn_usage: dict | None = cl.user_session.get("turn_usage", None)
+    if turn_usage is None:
+        return
+
+    usage_metadata = getattr(chunk, "usage_metadata", None) or {}
+    turn_usage["input_tokens"] += usage_metadata.get("input_tokens", 0)
+    turn_usage["output_tokens"] += usage_metadata.get("output_tokens", 0)
+
+    # the pinned langchain versions do not fill input_token_details,
+    # the cached tokens of anthropic are read from the raw usage instead, see ChatAnthropicWithCacheUsage
+    input_token_details = usage_metadata.get("input_token_details", None)
+    if input_token_details:
+        cache_read_tokens = input_token_details.get("cache_read", 0)
+        cache_creation_tokens = input_token_details.get("cache_creation", 0)
+    else:
+        response_metadata = getattr(chunk, "response_metadata", None) or {}
+        usage = response_metadata.get("usage", None) or {}
+        cache_read_tokens = usage.get("cache_read_input_tokens", 0)
+        cache_creation_tokens = usage.get("cache_creation_input_tokens", 0)
+    turn_usage["cache_read_tokens"] += cache_read_tokens or 0
+    turn_usage["cache_creation_tokens"] += cache_creation_tokens or 0
+
+
+def end_turn_usage() -> None:
+    turn_usage: dict | None = cl.user_session.get("turn_usage", None)
+    if turn_usage is None:
+        return
+
+    token_usage: list[dict] = cl.user_session.get("token_usage", [])
+    token_usage.append(turn_usage)
+    cl.user_session.set("token_usage", token_usage)
+    cl.user_session.set("turn_usage", None)
+
+    print(
+        f"Turn usage: {turn_usage['model_calls']} model calls, "
+        f"{turn_usage['input_tokens']} input tokens "
+        f"({turn_usage['cache_read_tokens']} read from the cache, {turn_usage['cache_creation_tokens']} written to the cache), "
+        f"{turn_usage['output_tokens']} output tokens"
+    )
 
 
 def add_user_message(
@@ -209,12 +551,16 @@ def add_system_message(
     chat_history: list[BaseMessage],
     prompt_type: str = "default",
 ) -> list[BaseMessage]:
-    system_prompt = SystemMessage(format_system_prompt(prompt_type))
+    system_prompt = format_system_prompt(prompt_type)
 
+    # the system message is only replaced if it changed, it is the start of the cached prompt prefix
     if len(chat_history) == 0:
-        chat_history.append(system_prompt)
-    else:
-        chat_history[0] = system_prompt
+        chat_history.append(SystemMessage(system_prompt))
+    elif (
+        type(chat_history[0]) != SystemMessage
+        or chat_history[0].content != system_prompt
+    ):
+        chat_history[0] = SystemMessage(system_prompt)
 
     return chat_history
 
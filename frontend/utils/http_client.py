@@ -0,0 +1,34 @@
+import aiohttp
+
+# one pooled session per process, so the tools reuse keep-alive connections to the backend
+# instead of opening a new TCP connection (and DNS lookup) for every call
+CONNECTION_LIMIT = 100
+CONNECTION_LIMIT_PER_HOST = 32
+KEEPALIVE_TIMEOUT = 60
+DNS_CACHE_TTL = 300
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=60, connect=5)
+
+_session: aiohttp.ClientSession | None = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    # created lazily, the session has to be created inside the running event loop
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=CONNECTION_LIMIT,
+                limit_per_host=CONNECTION_LIMIT_PER_HOST,
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=DNS_CACHE_TTL,
+            ),
+            timeout=REQUEST_TIMEOUT,
+        )
+    return _session
+
+
+async def close_http_session() -> None:
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
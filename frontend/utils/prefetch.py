@@ -0,0 +1,95 @@
+import asyncio
+import re
+import time
+from typing import Awaitable, Callable
+
+# a query of the model is served from the prefetch if most of its words are in the user message
+# e.g. "Was besagt das Ohm'sche Gesetz?" -> "Ohm'sche Gesetz Definition"
+MIN_QUERY_OVERLAP = 0.5
+# short words are mostly articles and conjunctions
+MIN_WORD_LENGTH = 4
+
+# shared by all sessions of the process
+PREFETCH_STATS = {
+    "prefetches": 0,
+    "hits": 0,
+    "misses": 0,
+    "failures": 0,
+    "time_saved": 0.0,
+}
+
+
+def prefetch_metrics() -> dict:
+    return {
+        **PREFETCH_STATS,
+        "hit_rate": PREFETCH_STATS["hits"] / max(1, PREFETCH_STATS["prefetches"]),
+    }
+
+
+def _query_words(query: str) -> set[str]:
+    return {
+        word
+        for word in re.findall(r"\w+", query.lower())
+        if len(word) >= MIN_WORD_LENGTH
+    }
+
+
+class QueryPrefetch:
+    """
+    A vector search with the raw user message, started together with the first model call.
+    The first similar query of the model is answered with its result instead of a new request.
+    """
+
+    def __init__(self, query: str, fetch: Callable[[], Awaitable[dict]]) -> None:
+        self.query = query
+        self.query_words = _query_words(query)
+        self.used = False
+        self.start_time = time.perf_counter()
+        self.duration = 0.0
+        self.task = asyncio.create_task(self._run(fetch))
+        PREFETCH_STATS["prefetches"] += 1
+
+    async def _run(self, fetch: Callable[[], Awaitable[dict]]) -> dict | None:
+        try:
+            result = await fetch()
+        except Exception as e:
+            # the tool call then sends its own request
+            print(f"Query prefetch failed: {e}")
+            return None
+        self.duration = time.perf_counter() - self.start_time
+        return result
+
+    def similarity(self, query: str) -> float:
+        query_words = _query_words(query)
+        if len(query_words) == 0:
+            return 0.0
+        return len(query_words & self.query_words) / len(query_words)
+
+    def matches(self, query: str) -> bool:
+        return not self.used and self.similarity(query) >= MIN_QUERY_OVERLAP
+
+    async def consume(self, query: str) -> dict | None:
+        if not self.matches(query):
+            return None
+        self.used = True
+
+        wait_start = time.perf_counter()
+        result = await self.task
+        if result is None:
+            PREFETCH_STATS["failures"] += 1
+            return None
+
+        # the part of the request which overlapped with the model call
+        time_saved = self.duration - (time.perf_counter() - wait_start)
+        PREFETCH_STATS["hits"] += 1
+        PREFETCH_STATS["time_saved"] += time_saved
+        print(
+            f"Query prefetch hit for '{query}', saved {time_saved:.2f}s "
+            f"(hit rate {prefetch_metrics()['hit_rate']:.0%})"
+        )
+        return result
+
+    def close(self) -> None:
+        if not self.used:
+            PREFETCH_STATS["misses"] += 1
+            self.task.cancel()
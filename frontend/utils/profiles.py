@@ -1,58 +1,88 @@
-import asyncio
-
 import chainlit as cl
 from langchain_core.language_models import BaseChatModel
 from langchain_core.messages import BaseMessage
 
 from .functions import (
     add_system_message,
+    add_cache_control,
     add_user_message,
+    compact_tool_messages,
+    end_turn_usage,
     inject_post_prompt,
+    limit_context,
     maybe_add_message_quota_element,
+    start_turn_usage,
 )
 from .stream_handler import handle_stream, handle_stream_output
-from .tool_calling import execute_tool_call
+from .tool_calling import ToolDispatcher, execute_tool_calls
+from .tools import end_query_prefetch, start_query_prefetch
+
+
+def prepare_messages(
+    chat_history: list[BaseMessage],
+    compact_tool_turns: int,
+    max_tokens: int,
+) -> list[BaseMessage]:
+    messages = compact_tool_messages(chat_history, compact_tool_turns)
+    messages = limit_context(messages, max_tokens)
+    # the post prompt is only added to the latest user message, after the cached prefix
+    return add_cache_control(inject_post_prompt(messages))
 
 
 async def default_profile(user_message: cl.Message) -> None:
     app_settings = cl.user_session.get("settings")["app_settings"]
     max_images = app_settings["max_images"]
     max_tool_recursion = app_settings["max_tool_recursion"]
+    max_tokens = app_settings["max_tokens"]
+    compact_tool_turns = app_settings["compact_tool_turns"]
 
     chat_history: list[BaseMessage] = cl.user_session.get("chat_history", [])
     model: BaseChatModel = cl.user_session.get("model")
     model_with_tools: BaseChatModel = cl.user_session.get("model_with_tools")
 
-    # we need to add the user message to the chat history before we can limit the context and afterwords add the system message
-    # this is done as the limit context function removes all messages which are too old
-    # we inject the system message after the limit context function
+    # the system message is always the first message of the chat history, limit_context keeps it pinned
     # TODO: THIS IS ULTRA HACKY; If I dont call the add_system_message function first thing, it will overwrite the user message
     chat_history = add_system_message(chat_history, "default")
     chat_history = add_user_message(user_message, chat_history, max_images)
-
-    # TODO: Write a proper function to limit the context, I cant just cut off the last n messages, I might cut off a tool call.
-    # chat_history = limit_context(chat_history, max_tokens=max_tokens)
-
-    stream = model_with_tools.astream(inject_post_prompt(chat_history))
-    model_message, tool_calls = await handle_stream(stream, model)
+    start_turn_usage()
+
+    # opt-in, the first query of the model is usually close to the user message
+    if app_settings.get("speculative_retrieval", False):
+        start_query_prefetch(user_message.content)
+
+    # the context is compacted and limited for every call, the chat history itself keeps all messages
+    # the tool calls are started while the model is still streaming
+    tool_dispatcher = ToolDispatcher()
+    stream = model_with_tools.astream(
+        prepare_messages(chat_history, compact_tool_turns, max_tokens)
+    )
+    model_message, tool_calls = await handle_stream(
+        stream, model, tool_dispatcher.dispatch
+    )
     tool_calls = await handle_stream_output(model_message, tool_calls)
 
     current_tool_recursion = 0
     while len(tool_calls) > 0:
         current_tool_recursion += 1
 
-        # execute the tool calls concurrently
-        await asyncio.gather(*[execute_tool_call(tool) for tool in tool_calls])
+        # wait for the tool calls, they are executed concurrently
+        await execute_tool_calls(tool_calls, tool_dispatcher)
 
         # remove the tools if the model has recursed too many times
+        tool_dispatcher = ToolDispatcher()
+        messages = prepare_messages(chat_history, compact_tool_turns, max_tokens)
         stream = (
-            model_with_tools.astream(inject_post_prompt(chat_history))
+            model_with_tools.astream(messages)
             if current_tool_recursion < max_tool_recursion
-            else model.astream(inject_post_prompt(chat_history))
+            else model.astream(messages)
+        )
+        model_message, tool_calls = await handle_stream(
+            stream, model, tool_dispatcher.dispatch
         )
-        model_message, tool_calls = await handle_stream(stream, model)
         tool_calls = await handle_stream_output(model_message, tool_calls)
 
+    end_query_prefetch()
+    end_turn_usage()
     await maybe_add_message_quota_element(model_message)
 
 
@@ -65,18 +95,21 @@ async def exam_trainer_profile(user_message: cl.Message) -> None:
     model_with_tools: BaseChatModel = cl.user_session.get("model_with_tools")
 
     chat_history = add_user_message(user_message, chat_history, max_images)
+    start_turn_usage()
 
-    stream = model_with_tools.astream(chat_history)
+    # the section text in the system prompt is the same for all questions of a section
+    stream = model_with_tools.astream(add_cache_control(chat_history))
     model_message, tool_calls = await handle_stream(stream, model)
     tool_calls = await handle_stream_output(model_message, tool_calls)
 
     if len(tool_calls) > 0:
 
         # execute the tool calls concurrently
-        await asyncio.gather(*[execute_tool_call(tool) for tool in tool_calls])
+        await execute_tool_calls(tool_calls)
 
-        stream = model.astream(chat_history)
+        stream = model.astream(add_cache_control(chat_history))
         model_message, tool_calls = await handle_stream(stream, model)
         tool_calls = await handle_stream_output(model_message, tool_calls)
 
+    end_turn_usage()
     await maybe_add_message_quota_element(model_message)
@@ -3,6 +3,7 @@ from typing import Literal
 
 import chainlit as cl
 
+from .reference_store import ReferenceStore
 from .references import (
     BaseReference,
     FormulaReference,
@@ -10,6 +11,16 @@ from .references import (
     SnippetReference,
 )
 
+# Snippet Reference
+# [EX1 15.7/1]
+SNIPPET_KEY_PATTERN = re.compile(r"\[[A-Z\d]+\s\d+\.\d+\/\d+\]")
+# Section Reference
+# [FEYNMAN2 4.2]
+SECTION_KEY_PATTERN = re.compile(r"\[[A-Z\d]+\s\d+\.\d+\]")
+# Formula Reference
+# [EX1 15.7 (1.3)]
+FORMULA_KEY_PATTERN = re.compile(r"\[[A-Z\d]+\s\d+\.\d+\s\(\d+\.\d+\)\]")
+
 
 def to_reference(
     raw_reference: dict,
@@ -51,42 +62,26 @@ def to_reference(
 
 
 async def add_references_to_messsage(model_message: cl.Message) -> None:
-    references: list[BaseReference] = cl.user_session.get("references")
-
-    # Snippet Reference
-    # \[[A-Z]+\d+\s\d+\.\d+\/\d+\]
-    # [EX1 15.7/1]
-
-    # Section Reference
-    # \[[A-Z]+\d+\s\d+\.\d+\]
-    # [FEYNMAN2 4.2]
-
-    # Formula Reference
-    # \[[A-Z]+\d+\s\d+\.\d+\s\(\d+\.\d+\)\]
-    # [EX1 15.7 (1.3)]
+    references: ReferenceStore = cl.user_session.get("references")
 
     message_text = model_message.content
-    available_reference_keys = [ref.reference_key for ref in references]
     # check the message for references using the regex
-    found_snippet_keys = re.findall(r"\[[A-Z\d]+\s\d+\.\d+\/\d+\]", message_text)
-    found_section_keys = re.findall(r"\[[A-Z\d]+\s\d+\.\d+\]", message_text)
-    found_formula_keys = re.findall(
-        r"\[[A-Z\d]+\s\d+\.\d+\s\(\d+\.\d+\)\]", message_text
+    found_reference_keys = (
+        SNIPPET_KEY_PATTERN.findall(message_text)
+        + SECTION_KEY_PATTERN.findall(message_text)
+        + FORMULA_KEY_PATTERN.findall(message_text)
+    )
+    # we need to strip the brackets from the found references, the order of the message is kept
+    found_reference_keys = list(
+        dict.fromkeys(ref_key[1:-1] for ref_key in found_reference_keys)
     )
-    # we need to strip the brackets from the found references
-    found_reference_keys = [
-        ref_key[1:-1]
-        for ref_key in found_snippet_keys + found_section_keys + found_formula_keys
-    ]
 
+    matched_reference_keys = [
+        ref_key for ref_key in found_reference_keys if ref_key in references
+    ]
     unmatched_reference_keys = [
-        ref_key
-        for ref_key in list(set(found_reference_keys))
-        if ref_key not in available_reference_keys
+        ref_key for ref_key in found_reference_keys if ref_key not in references
     ]
-    matched_reference_keys = list(
-        set(found_reference_keys) - set(unmatched_reference_keys)
-    )
 
     for ref_key in unmatched_reference_keys:
         message_text = message_text.replace(ref_key, f"~~{ref_key}~~")
@@ -98,8 +93,7 @@ async def add_references_to_messsage(model_message: cl.Message) -> None:
             content=ref.print_reference(),
             display="side",
         )
-        for ref in references
-        if ref.reference_key in matched_reference_keys
+        for ref in map(references.get, matched_reference_keys)
     ]
 
     if len(unmatched_reference_keys) > 0:
@@ -121,11 +115,10 @@ def update_references(new_references: list[BaseReference] | BaseReference) -> No
     if not isinstance(new_references, list):
         new_references = [new_references]
 
-    references: list[BaseReference] = cl.user_session.get("references", [])
-    reference_keys = [ref.reference_key for ref in references]
+    references: ReferenceStore | None = cl.user_session.get("references", None)
+    if references is None:
+        references = ReferenceStore()
+        cl.user_session.set("references", references)
 
     for reference in new_references:
-        reference_key = reference.reference_key
-        if reference_key not in reference_keys:
-            references.append(reference)
-            reference_keys.append(reference_key)
+        references.add(reference)
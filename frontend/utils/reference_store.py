@@ -0,0 +1,90 @@
+import os
+import shelve
+import shutil
+import tempfile
+import weakref
+from collections import OrderedDict
+
+from .references import BaseReference
+
+# the contents of the most recently used references which are kept in memory per session
+# e.g. about 25 sections, older references are spilled to disk
+MAX_REFERENCE_CHARS = 500_000
+
+
+class ReferenceStore:
+    """
+    The references of a session keyed by their citation key.
+    Only the most recently used references up to max_chars of content are kept in memory,
+    the least recently used ones are spilled to a file on disk and loaded again on access.
+    """
+
+    def __init__(self, max_chars: int = MAX_REFERENCE_CHARS) -> None:
+        self.max_chars = max_chars
+        self.references: OrderedDict[str, BaseReference] = OrderedDict()
+        self.num_chars = 0
+        self.spilled_keys: set[str] = set()
+        self.spill_dir: str | None = None
+        self.spill_shelf: shelve.Shelf | None = None
+
+    def __contains__(self, reference_key: str) -> bool:
+        return reference_key in self.references or reference_key in self.spilled_keys
+
+    def __len__(self) -> int:
+        return len(self.references) + len(self.spilled_keys)
+
+    def add(self, reference: BaseReference) -> None:
+        # the first reference with a key is kept, it is only marked as recently used
+        if reference.reference_key in self:
+            self.get(reference.reference_key)
+            return
+        self._add_to_memory(reference)
+
+    def get(self, reference_key: str) -> BaseReference | None:
+        if reference_key in self.references:
+            self.references.move_to_end(reference_key)
+            return self.references[reference_key]
+
+        if reference_key in self.spilled_keys:
+            reference = self.spill_shelf[reference_key]
+            del self.spill_shelf[reference_key]
+            self.spilled_keys.remove(reference_key)
+            self._add_to_memory(reference)
+            return reference
+
+        return None
+
+    def _add_to_memory(self, reference: BaseReference) -> None:
+        self.references[reference.reference_key] = reference
+        self.num_chars += len(reference.content)
+
+        # the most recent reference always stays in memory
+        while self.num_chars > self.max_chars and len(self.references) > 1:
+            reference_key, evicted_reference = self.references.popitem(last=False)
+            self.num_chars -= len(evicted_reference.content)
+            self._spill(reference_key, evicted_reference)
+
+    def _spill(self, reference_key: str, reference: BaseReference) -> None:
+        if self.spill_shelf is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="landau_references_")
+            self.spill_shelf = shelve.open(os.path.join(self.spill_dir, "references"))
+            # the files are removed with the session, even if close is never called
+            self._finalizer = weakref.finalize(
+                self, _remove_spill_files, self.spill_shelf, self.spill_dir
+            )
+        self.spill_shelf[reference_key] = reference
+        self.spilled_keys.add(reference_key)
+
+    def close(self) -> None:
+        if self.spill_shelf is not None:
+            self._finalizer()
+            self.spill_shelf = None
+            self.spill_dir = None
+        self.references.clear()
+        self.spilled_keys.clear()
+        self.num_chars = 0
+
+
+def _remove_spill_files(spill_shelf: shelve.Shelf, spill_dir: str) -> None:
+    spill_shelf.close()
+    shutil.rmtree(spill_dir, ignore_errors=True)
@@ -1,5 +1,5 @@
 import json
-from typing import AsyncIterator
+from typing import AsyncIterator, Callable
 
 import chainlit as cl
 from langchain_anthropic import ChatAnthropic
@@ -8,7 +8,9 @@ from langchain_core.messages import AIMessage, BaseMessage, BaseMessageChunk, To
 from langchain_ollama import ChatOllama
 from langchain_openai import AzureChatOpenAI, ChatOpenAI
 
+from .functions import record_model_call, record_token_usage
 from .reference_functions import add_references_to_messsage
+from .stream_renderer import LatexDelimiterFormatter, StreamRenderer
 
 
 def apply_tool_constraints(
@@ -40,35 +42,72 @@ def format_content(content: str) -> str:
     # The model sometimes returns invalid LaTeX formatting
     # i.e. \( FORMEL \) instead of $FORMEL$
     # and \[ FORMEL \] instead of $$FORMEL$$
-    content = content.replace(r"\(", "$")
-    content = content.replace(r"\)", "$")
-    content = content.replace(r"\[", "$$")
-    content = content.replace(r"\]", "$$")
-    return content
+    # the streamed responses are formatted chunk by chunk in the StreamRenderer
+    latex_formatter = LatexDelimiterFormatter()
+    return latex_formatter.feed(content) + latex_formatter.flush()
+
+
+class JsonObjectTracker:
+    """
+    Tracks the nesting of streamed JSON, the arguments of a tool call are complete once the outer object is closed.
+    Every chunk is scanned once, so the tool call can be started before the stream has ended.
+    """
+
+    def __init__(self) -> None:
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.complete = False
+
+    def feed(self, text: str) -> bool:
+        for char in text:
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.complete = True
+        return self.complete
+
+
+def dispatch_tool_call(
+    tool_call: dict,
+    on_tool_call: Callable[[ToolCall], None],
+) -> None:
+    try:
+        args = json.loads(tool_call["args"])
+    except json.JSONDecodeError:
+        # the arguments are parsed again at the end of the stream
+        return
+    on_tool_call({"id": tool_call["id"], "name": tool_call["name"], "args": args})
 
 
 async def handle_anthropic_stream(
     stream: AsyncIterator[BaseMessageChunk],
+    on_tool_call: Callable[[ToolCall], None] | None = None,
 ) -> tuple[cl.Message, list[ToolCall]]:
-    response_created = False
+    renderer = StreamRenderer()
     tool_calls = []
-    msg = None
+    json_trackers = []
 
     async for chunk in stream:
+        # the input tokens are in the first chunk, the output tokens in the last one
+        record_token_usage(chunk)
+
         if len(chunk.content) > 0:
             content = chunk.content[0]
 
             if content["type"] == "text":
-                text_content = content.get("text", "")
-
-                if not response_created:
-                    msg = cl.Message(content="")
-                    await msg.send()
-                    response_created = True
-
-                msg.content += text_content
-                msg.content = format_content(msg.content)
-                await msg.update()
+                await renderer.write(content.get("text", ""))
 
             elif content["type"] == "tool_use":
                 if "name" in content:
@@ -79,9 +118,22 @@ async def handle_anthropic_stream(
                             "args": "",
                         }
                     )
+                    json_trackers.append(JsonObjectTracker())
                 else:
                     tool_calls[-1]["args"] += content["partial_json"]
 
+                    # start the tool call as soon as its arguments are complete
+                    json_tracker = json_trackers[-1]
+                    if (
+                        on_tool_call is not None
+                        and not json_tracker.complete
+                        and json_tracker.feed(content["partial_json"])
+                    ):
+                        dispatch_tool_call(tool_calls[-1], on_tool_call)
+
+    # the final flush, the rest of the buffered text
+    msg = await renderer.close()
+
     for tool_call in tool_calls:
         tool_call["args"] = json.loads(tool_call["args"])
 
@@ -90,24 +142,21 @@ async def handle_anthropic_stream(
 
 async def handle_openai_stream(
     stream: AsyncIterator[BaseMessageChunk],
+    on_tool_call: Callable[[ToolCall], None] | None = None,
 ) -> tuple[cl.Message, list[ToolCall]]:
-    response_created = False
+    renderer = StreamRenderer()
     tool_calls = {}
-    msg = None
+    json_trackers = {}
 
     async for chunk in stream:
         text_content = chunk.content
         tool_content = chunk.additional_kwargs.get("tool_calls", None)
 
-        if text_content:
-            if not response_created:
-                msg = cl.Message(content="")
-                await msg.send()
-                response_created = True
+        # the usage is in the last chunk, see stream_usage in load_model
+        record_token_usage(chunk)
 
-            msg.content += text_content
-            msg.content = format_content(msg.content)
-            await msg.update()
+        if text_content:
+            await renderer.write(text_content)
 
         if tool_content:
             for tool_call in tool_content:
@@ -129,6 +178,20 @@ async def handle_openai_stream(
                     else:
                         tool_calls[tool_index]["args"] += function_args
 
+                    # start the tool call as soon as its arguments are complete
+                    json_tracker = json_trackers.setdefault(
+                        tool_index, JsonObjectTracker()
+                    )
+                    if (
+                        on_tool_call is not None
+                        and not json_tracker.complete
+                        and json_tracker.feed(function_args)
+                    ):
+                        dispatch_tool_call(tool_calls[tool_index], on_tool_call)
+
+    # the final flush, the rest of the buffered text
+    msg = await renderer.close()
+
     tool_calls = list(tool_calls.values())
     for tool_call in tool_calls:
         tool_call["args"] = json.loads(tool_call["args"])
@@ -138,10 +201,11 @@ async def handle_openai_stream(
 
 async def handle_ollama_stream(
     stream: AsyncIterator[BaseMessageChunk],
+    on_tool_call: Callable[[ToolCall], None] | None = None,
 ) -> tuple[cl.Message, list[ToolCall]]:
-    response_created = False
+    # ollama only returns complete tool calls, they are started after the stream
+    renderer = StreamRenderer()
     tool_calls = {}
-    msg = None
 
     async for chunk in stream:
         text_content = chunk.content
@@ -149,15 +213,10 @@ async def handle_ollama_stream(
             tool_content = chunk.tool_calls
         except AttributeError:
             tool_content = None
-        if text_content:
-            if not response_created:
-                msg = cl.Message(content="")
-                await msg.send()
-                response_created = True
 
-            msg.content += text_content
-            msg.content = format_content(msg.content)
-            await msg.update()
+        record_token_usage(chunk)
+        if text_content:
+            await renderer.write(text_content)
 
         if tool_content:
             for tool_call in tool_content:
@@ -179,6 +238,9 @@ async def handle_ollama_stream(
                     else:
                         tool_calls[tool_id]["args"] += function_args
 
+    # the final flush, the rest of the buffered text
+    msg = await renderer.close()
+
     tool_calls = list(tool_calls.values())
 
     return msg, tool_calls
@@ -187,15 +249,19 @@ async def handle_ollama_stream(
 async def handle_stream(
     stream: AsyncIterator[BaseMessageChunk],
     model: BaseChatModel,
+    on_tool_call: Callable[[ToolCall], None] | None = None,
 ) -> tuple[cl.Message, list[ToolCall]]:
+    # on_tool_call is called with every tool call as soon as its arguments are complete
+    record_model_call()
     if type(model) == ChatOpenAI:
-        return await handle_openai_stream(stream)
+        return await handle_openai_stream(stream, on_tool_call)
     if type(model) == AzureChatOpenAI:
-        return await handle_openai_stream(stream)
-    elif type(model) == ChatAnthropic:
-        return await handle_anthropic_stream(stream)
+        return await handle_openai_stream(stream, on_tool_call)
+    # includes ChatAnthropicWithCacheUsage
+    elif isinstance(model, ChatAnthropic):
+        return await handle_anthropic_stream(stream, on_tool_call)
     elif type(model) == ChatOllama:
-        return await handle_ollama_stream(stream)
+        return await handle_ollama_stream(stream, on_tool_call)
     else:
         raise ValueError(f"Model type {type(model)} not supported.")
 
@@ -0,0 +1,98 @@
+import re
+import time
+
+import chainlit as cl
+
+# a flush sends the whole message over the websocket (and to the datalayer),
+# so the tokens are collected and flushed at most every 50 ms or 64 characters
+FLUSH_INTERVAL = 0.05
+FLUSH_SIZE = 64
+
+# the model sometimes returns \( FORMEL \) instead of $FORMEL$ and \[ FORMEL \] instead of $$FORMEL$$
+LATEX_DELIMITERS = {"(": "$", ")": "$", "[": "$$", "]": "$$"}
+LATEX_DELIMITER_PATTERN = re.compile(r"\\([()\[\]])")
+
+
+class LatexDelimiterFormatter:
+    """
+    Streaming version of format_content, only the new text of every chunk is rewritten.
+    A trailing backslash is held back until the next chunk shows whether it starts a delimiter.
+    """
+
+    def __init__(self) -> None:
+        self.pending = ""
+
+    def feed(self, text: str) -> str:
+        text = self.pending + text
+        if text.endswith("\\"):
+            text, self.pending = text[:-1], text[-1]
+        else:
+            self.pending = ""
+        return LATEX_DELIMITER_PATTERN.sub(
+            lambda match: LATEX_DELIMITERS[match.group(1)], text
+        )
+
+    def flush(self) -> str:
+        pending, self.pending = self.pending, ""
+        return pending
+
+
+class StreamRenderer:
+    """
+    Buffers the streamed text of a model response and updates the message on a time/size cadence
+    instead of on every token. The message is created with the first text, close() does the final flush.
+    """
+
+    def __init__(
+        self,
+        msg: cl.Message | None = None,
+        flush_interval: float = FLUSH_INTERVAL,
+        flush_size: int = FLUSH_SIZE,
+        format_latex: bool = True,
+    ) -> None:
+        self.msg = msg
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.latex_formatter = LatexDelimiterFormatter() if format_latex else None
+        self.content = ""
+        self.pending_chars = 0
+        self.last_flush = time.perf_counter()
+        self.frames_sent = 0
+
+    async def write(self, text: str) -> None:
+        if not text:
+            return
+
+        if self.msg is None:
+            self.msg = cl.Message(content="")
+            await self.msg.send()
+            self.frames_sent += 1
+
+        if self.latex_formatter is not None:
+            text = self.latex_formatter.feed(text)
+        self.content += text
+        self.pending_chars += len(text)
+        if (
+            self.pending_chars >= self.flush_size
+            or time.perf_counter() - self.last_flush >= self.flush_interval
+        ):
+            await self.flush()
+
+    async def flush(self) -> None:
+        if self.msg is None or self.pending_chars == 0:
+            return
+
+        self.msg.content = self.content
+        await self.msg.update()
+
+        self.pending_chars = 0
+        self.last_flush = time.perf_counter()
+        self.frames_sent += 1
+
+    async def close(self) -> cl.Message | None:
+        if self.latex_formatter is not None:
+            text = self.latex_formatter.flush()
+            self.content += text
+            self.pending_chars += len(text)
+        await self.flush()
+        return self.msg
@@ -1,16 +1,20 @@
+import asyncio
 import random
 
 import chainlit as cl
 from langchain.pydantic_v1 import ValidationError
 from langchain_core.messages import ToolCall, ToolMessage
 
+from .stream_handler import apply_tool_constraints
 from .tools import (
+    end_tool_requests,
     query_vector_db,
     query_wolfram_alpha,
     question_setup,
     retrieve_formula,
     retrieve_section,
     retrieve_table_of_contents,
+    start_tool_request,
 )
 
 
@@ -22,7 +26,7 @@ def generate_tool_id() -> str:
     return f"call_{call_id}"
 
 
-async def execute_tool_call(tool: ToolCall) -> None:
+async def run_tool_call(tool: ToolCall) -> ToolMessage | None:
     async def handle_query_vector_db(
         args: dict,
         **kwargs,
@@ -124,16 +128,68 @@ async def execute_tool_call(tool: ToolCall) -> None:
 
     elif tool_name == "question_setup":
         await handle_question_setup(tool_args)
-        return
+        return None
 
     else:
         tool_response = f"Tool call failed. Function '{tool['name']}' not found."
 
-    chat_history: list = cl.user_session.get("chat_history")
-    chat_history.append(
-        ToolMessage(
-            tool_call_id=tool_id,
-            name=tool_name,
-            content=tool_response,
-        )
+    return ToolMessage(
+        tool_call_id=tool_id,
+        name=tool_name,
+        content=tool_response,
     )
+
+
+class ToolDispatcher:
+    """
+    Starts the backend requests of the tool calls while the model is still streaming, see handle_stream.
+    A later tool call can still drop an earlier one through the constraints (e.g. a table of contents call),
+    so only the requests are started early, the tool calls themselves (steps, references) are run in gather
+    for the tool calls which survived the constraints of the complete response.
+    """
+
+    def __init__(self, max_parallel_tool_calls: int = 3) -> None:
+        self.max_parallel_tool_calls = max_parallel_tool_calls
+        self.completed_tool_calls: list[ToolCall] = []
+        self.requests: dict[str, asyncio.Task | None] = {}
+
+    def dispatch(self, tool: ToolCall) -> None:
+        self.completed_tool_calls.append(tool)
+        for tool_call in apply_tool_constraints(
+            self.completed_tool_calls,
+            max_parallel_tool_calls=self.max_parallel_tool_calls,
+        ):
+            if tool_call["id"] not in self.requests:
+                self.requests[tool_call["id"]] = start_tool_request(tool_call)
+
+    async def gather(self, tool_calls: list[ToolCall]) -> list[ToolMessage]:
+        # tool_calls are the final tool calls after the constraints
+        tool_ids = [tool_call["id"] for tool_call in tool_calls]
+        used_requests = [self.requests.get(tool_id, None) for tool_id in tool_ids]
+        for tool_id, request in self.requests.items():
+            if request is not None and request not in used_requests:
+                request.cancel()
+
+        try:
+            tool_messages = await asyncio.gather(
+                *[run_tool_call(tool_call) for tool_call in tool_calls]
+            )
+        finally:
+            end_tool_requests()
+
+        return [
+            tool_message for tool_message in tool_messages if tool_message is not None
+        ]
+
+
+async def execute_tool_calls(
+    tool_calls: list[ToolCall],
+    tool_dispatcher: ToolDispatcher | None = None,
+) -> None:
+    # the tool messages are added in the order of the tool calls, not in the order they finished
+    if tool_dispatcher is None:
+        tool_dispatcher = ToolDispatcher()
+    tool_messages = await tool_dispatcher.gather(tool_calls)
+
+    chat_history: list = cl.user_session.get("chat_history")
+    chat_history.extend(tool_messages)
@@ -1,3 +1,6 @@
+import asyncio
+import functools
+import json
 import os
 import random
 import time
@@ -6,7 +9,7 @@ from typing import Optional
 
 import aiohttp
 import chainlit as cl
-from aiohttp.client_exceptions import ClientConnectorError
+from aiohttp.client_exceptions import ClientConnectorError, ClientResponseError
 from constants.urls import (
     CHAPTER_DB_URL,
     FORMULA_DB_URL,
@@ -16,9 +19,11 @@ from constants.urls import (
 )
 from langchain.pydantic_v1 import BaseModel, Field
 from langchain.tools import tool
-from langchain_core.messages import BaseMessage, HumanMessage
+from langchain_core.messages import BaseMessage, HumanMessage, ToolCall
 
 from .functions import add_system_message
+from .http_client import get_http_session
+from .prefetch import QueryPrefetch
 from .reference_functions import to_reference, update_references
 
 
@@ -80,6 +85,180 @@ class QuestionSetup(BaseModel):
     )
 
 
+# the backend rejects shorter queries
+MIN_QUERY_LENGTH = 5
+
+
+def build_query_request(query: str) -> dict:
+    ret_settings = cl.user_session.get("settings")["retrieval_settings"]
+    permitted_document_ids = cl.user_session.get("permitted_document_ids", None)
+
+    request_json_body = {
+        "query": query,
+        "collection_name": ret_settings["collection_name"],
+        "top_k": ret_settings["top_k"] or 200,
+        "top_n": ret_settings["top_n"] or 5,
+        "use_rerank": ret_settings["use_rerank"] or False,
+        "extend_results": ret_settings["extend_results"] or False,
+        "rerank_score_threshold": ret_settings["rerank_score_threshold"] or 0.1,
+    }
+
+    # only add permitted_document_ids if it is not None
+    if permitted_document_ids:
+        request_json_body["permitted_document_ids"] = permitted_document_ids
+
+    return request_json_body
+
+
+def build_toc_request(script_id: str) -> dict:
+    ret_settings = cl.user_session.get("settings")["retrieval_settings"]
+    return {
+        "document_id": script_id,
+        "collection_name": ret_settings["collection_name"],
+    }
+
+
+def build_section_request(script_id: str, chapter_id: str, section_id: str) -> dict:
+    ret_settings = cl.user_session.get("settings")["retrieval_settings"]
+    return {
+        "document_id": script_id,
+        "chapter_id": chapter_id,
+        "section_id": section_id,
+        "collection_name": ret_settings["collection_name"],
+    }
+
+
+def build_formula_request(script_id: str, formula_id: str) -> dict:
+    ret_settings = cl.user_session.get("settings")["retrieval_settings"]
+    return {
+        "document_id": script_id,
+        "formula_id": formula_id,
+        "collection_name": ret_settings["collection_name"],
+    }
+
+
+async def post_json(url: str, request_json_body: dict) -> dict:
+    session = get_http_session()
+    async with session.post(url, json=request_json_body) as response:
+        # e.g. a rejected query, the error body must not be used as a result
+        response.raise_for_status()
+        return await response.json()
+
+
+def _request_key(url: str, request_json_body: dict) -> str:
+    return url + json.dumps(request_json_body, sort_keys=True)
+
+
+def build_tool_request(tool_call: ToolCall) -> tuple[str, dict] | None:
+    # the backend request of a retrieval tool call, None for all other tool calls
+    args = tool_call.get("args", {}) or {}
+    permitted_document_ids = cl.user_session.get("permitted_document_ids", None)
+    if (
+        "script_id" in args
+        and permitted_document_ids
+        and args["script_id"] not in permitted_document_ids
+    ):
+        return None
+
+    try:
+        if tool_call["name"] == "query_vector_db":
+            return VECTOR_DB_URL, build_query_request(args["query"])
+        if tool_call["name"] == "retrieve_table_of_contents":
+            return TOC_DB_URL, build_toc_request(args["script_id"])
+        if tool_call["name"] == "retrieve_section":
+            return CHAPTER_DB_URL, build_section_request(
+                args["script_id"], args["chapter_id"], args["section_id"]
+            )
+        if tool_call["name"] == "retrieve_formula":
+            return FORMULA_DB_URL, build_formula_request(
+                args["script_id"], args["formula_id"]
+            )
+    except KeyError:
+        # bad arguments, the tool reports them
+        return None
+    return None
+
+
+def start_tool_request(tool_call: ToolCall) -> asyncio.Task | None:
+    """
+    Sends the backend request of a tool call while the model is still streaming.
+    Only the request is sent, the step and the references are added once the tool call is run,
+    so a tool call which is dropped by the constraints later on leaves no trace.
+    """
+    tool_request = build_tool_request(tool_call)
+    if tool_request is None:
+        return None
+
+    # a similar query is already answered by the prefetch of the user message
+    query_prefetch: QueryPrefetch | None = cl.user_session.get("query_prefetch", None)
+    if (
+        tool_call["name"] == "query_vector_db"
+        and query_prefetch is not None
+        and query_prefetch.matches(tool_call["args"]["query"])
+    ):
+        return None
+
+    tool_requests: dict = cl.user_session.get("tool_requests", None) or {}
+    request_key = _request_key(*tool_request)
+    if request_key not in tool_requests:
+        task = asyncio.create_task(post_json(*tool_request))
+        # the result of a dropped request is never awaited
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        tool_requests[request_key] = task
+    cl.user_session.set("tool_requests", tool_requests)
+    return tool_requests[request_key]
+
+
+def end_tool_requests() -> None:
+    tool_requests: dict = cl.user_session.get("tool_requests", None) or {}
+    for task in tool_requests.values():
+        task.cancel()
+    cl.user_session.set("tool_requests", None)
+
+
+async def get_tool_response(url: str, request_json_body: dict) -> dict:
+    # uses the request started by start_tool_request, if there is one
+    tool_requests: dict = cl.user_session.get("tool_requests", None) or {}
+    task: asyncio.Task | None = tool_requests.pop(
+        _request_key(url, request_json_body), None
+    )
+    if task is not None:
+        return await task
+    return await post_json(url, request_json_body)
+
+
+def start_query_prefetch(query: str) -> None:
+    # the vector search with the user message runs concurrently with the first model call
+    end_query_prefetch()
+    # e.g. "Hi", the backend would reject the query anyway
+    if len(query.strip()) < MIN_QUERY_LENGTH:
+        return
+    cl.user_session.set(
+        "query_prefetch",
+        QueryPrefetch(
+            query,
+            functools.partial(post_json, VECTOR_DB_URL, build_query_request(query)),
+        ),
+    )
+
+
+def end_query_prefetch() -> None:
+    query_prefetch: QueryPrefetch | None = cl.user_session.get("query_prefetch", None)
+    if query_prefetch is not None:
+        query_prefetch.close()
+        cl.user_session.set("query_prefetch", None)
+
+
+async def get_query_results(query: str) -> dict:
+    query_prefetch: QueryPrefetch | None = cl.user_session.get("query_prefetch", None)
+    if query_prefetch is not None:
+        response_json = await query_prefetch.consume(query)
+        if response_json is not None:
+            return response_json
+
+    return await get_tool_response(VECTOR_DB_URL, build_query_request(query))
+
+
 @tool(args_schema=QueryVectorDB)
 async def query_vector_db(query: str) -> str:
     """
@@ -118,23 +297,6 @@ async def query_vector_db(query: str) -> str:
 
         return input_string, output_string
 
-    ret_settings = cl.user_session.get("settings")["retrieval_settings"]
-    permitted_document_ids = cl.user_session.get("permitted_document_ids", None)
-
-    request_json_body = {
-        "query": query,
-        "collection_name": ret_settings["collection_name"],
-        "top_k": ret_settings["top_k"] or 200,
-        "top_n": ret_settings["top_n"] or 5,
-        "use_rerank": ret_settings["use_rerank"] or False,
-        "extend_results": ret_settings["extend_results"] or False,
-        "rerank_score_threshold": ret_settings["rerank_score_threshold"] or 0.1,
-    }
-
-    # only add permitted_document_ids if it is not None
-    if permitted_document_ids:
-        request_json_body["permitted_document_ids"] = permitted_document_ids
-
     async with cl.Step(
         name="Vektorsuche",
         language=None,
@@ -145,47 +307,55 @@ async def query_vector_db(query: str) -> str:
         step.input = f"Die Vektorsuche wird mit der Frage '**{query}**' durchgeführt."
 
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    VECTOR_DB_URL, json=request_json_body
-                ) as response:
-
-                    response_json = await response.json()
-                    document_list: list[dict] = response_json["documents"]
-
-                    # each document is a dictionary with the following keys
-                    # "id", The id of the document in the database, Typically "script_id.chapter_id.section_id.paragraph_id"
-                    # "document_id", The id of the document in the database
-                    # "chapter_id", The id of the chapter in the document
-                    # "section_id", The id of the section in the document
-                    # "paragraph_id", The id of the paragraph in the document
-                    # "document_name", The name of the document
-                    # "chapter_name", The name of the chapter
-                    # "section_name", The name of the section
-                    # "content", The content of the (extended) paragraph
-                    # "score", The score of the paragraph between 0 and 1
-                    # "num_tokens", The number of tokens of the content
-
-                    reference_list = [
-                        to_reference(doc, "snippet") for doc in document_list
-                    ]
-                    update_references(reference_list)
-
-                    input_str, output_str = format_query_step(
-                        query,
-                        document_list,
-                    )
-                    step.input = input_str
-                    step.output = output_str
-
-                    return (
-                        "## Tool Response\n\n"
-                        + "\n\n".join([ref.print_reference() for ref in reference_list])
-                        + "\n## Ende der Antwort\n"
-                        + "Wenn informationen hieraus benutzt werden, müssen die Quellen korrekt zitiert werden."
-                    )
-
-        except ClientConnectorError as e:
+            response_json = await get_query_results(query)
+            document_list: list[dict] = response_json["documents"]
+
+            # lookups like "Inhaltsverzeichnis EX1" are routed to the table of content
+            toc: list | None = response_json.get("toc", None)
+            if toc is not None:
+                toc = "\n".join(toc)
+                step.output = toc
+                return toc
+
+            # each document is a dictionary with the following keys
+            # "id", The id of the document in the database, Typically "script_id.chapter_id.section_id.paragraph_id"
+            # "document_id", The id of the document in the database
+            # "chapter_id", The id of the chapter in the document
+            # "section_id", The id of the section in the document
+            # "paragraph_id", The id of the paragraph in the document
+            # "document_name", The name of the document
+            # "chapter_name", The name of the chapter
+            # "section_name", The name of the section
+            # "content", The content of the (extended) paragraph
+            # "score", The score of the paragraph between 0 and 1
+            # "num_tokens", The number of tokens of the content
+            # "reference_type", Only for routed lookups, "snippet", "section" or "formula"
+
+            reference_list = [
+                to_reference(doc, doc.get("reference_type", "snippet"))
+                for doc in document_list
+            ]
+            update_references(reference_list)
+
+            input_str, output_str = format_query_step(
+                query,
+                document_list,
+            )
+            step.input = input_str
+            step.output = output_str
+
+            return (
+                "## Tool Response\n\n"
+                + "\n\n".join([ref.print_reference() for ref in reference_list])
+                + "\n## Ende der Antwort\n"
+                + "Wenn informationen hieraus benutzt werden, müssen die Quellen korrekt zitiert werden."
+            )
+
+        except ClientResponseError as e:
+            step.output = "Die Anfrage ist fehlgeschlagen."
+            return f"Die Vektorsuche ist fehlgeschlagen ({e.status}). Formuliere die Frage um und versuche es erneut."
+
+        except (ClientConnectorError, asyncio.TimeoutError) as e:
             step.output = f"Server Aktuell nicht erreichbar."
             return "Der Server ist aktuell nicht erreichbar. Versuchen Sie es später erneut."
 
@@ -197,12 +367,7 @@ async def retrieve_table_of_contents(script_id: str) -> str:
     Gibt das Inhaltsverzeichnis mit Sektions-IDs zurück.
     """
 
-    ret_settings = cl.user_session.get("settings")["retrieval_settings"]
-
-    request_json_body = {
-        "document_id": script_id,
-        "collection_name": ret_settings["collection_name"],
-    }
+    request_json_body = build_toc_request(script_id)
 
     with cl.Step(
         name="Inhaltsverzeichnis",
@@ -214,24 +379,22 @@ async def retrieve_table_of_contents(script_id: str) -> str:
         step.input = f"Das Inhaltsverzeichnis für **{script_id}** wird abgefragt."
 
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(TOC_DB_URL, json=request_json_body) as response:
-                    if response.status != 200:
-                        step.output = "Die Anfrage ist fehlgeschlagen."
-                        return "Es konnte kein Inhaltsverzeichnis gefunden werden."
+            response_json = await get_tool_response(TOC_DB_URL, request_json_body)
 
-                    response_json: dict = await response.json()
+            toc: list | None = response_json.get("toc", None)
+            if toc is None:
+                step.output = "Die Anfrage ist fehlgeschlagen."
+                return "Es konnte kein Inhaltsverzeichnis gefunden werden."
 
-                    toc: list | None = response_json.get("toc", None)
-                    if toc is None:
-                        step.output = "Die Anfrage ist fehlgeschlagen."
-                        return "Es konnte kein Inhaltsverzeichnis gefunden werden."
+            toc = "\n".join(toc)
+            step.output = toc
+            return toc
 
-                    toc = "\n".join(toc)
-                    step.output = toc
-                    return toc
+        except ClientResponseError as e:
+            step.output = "Die Anfrage ist fehlgeschlagen."
+            return "Es konnte kein Inhaltsverzeichnis gefunden werden."
 
-        except ClientConnectorError as e:
+        except (ClientConnectorError, asyncio.TimeoutError) as e:
             step.output = f"Server Aktuell nicht erreichbar."
             return "Der Server ist aktuell nicht erreichbar. Versuchen Sie es später erneut."
 
@@ -248,14 +411,7 @@ async def retrieve_section(
     Wenn snippets aus diesem Tool verwendet werden müssen sie zitiert werden.
     """
 
-    retrival_settings = cl.user_session.get("settings")["retrieval_settings"]
-
-    request_json_body = {
-        "document_id": script_id,
-        "chapter_id": chapter_id,
-        "section_id": section_id,
-        "collection_name": retrival_settings["collection_name"],
-    }
+    request_json_body = build_section_request(script_id, chapter_id, section_id)
 
     async with cl.Step(
         name="Sektions Abfrage",
@@ -267,24 +423,22 @@ async def retrieve_section(
         step.input = f"Die Sektion {chapter_id}.{section_id} wird abgefragt..."
 
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    CHAPTER_DB_URL, json=request_json_body
-                ) as response:
-                    if response.status != 200:
-                        out_str = f"Die Sektion {chapter_id}.{section_id} konnte nicht gefunden werden."
-                        step.output = out_str
-                        return out_str
+            response_json = await get_tool_response(CHAPTER_DB_URL, request_json_body)
+            step.output = f"Sektion **{response_json['section_name']}** aus Kapitel **{response_json['chapter_name']}** in **{response_json['document_name']}** wurde abgefragt."
 
-                    response_json = await response.json()
-                    step.output = f"Sektion **{response_json['section_name']}** aus Kapitel **{response_json['chapter_name']}** in **{response_json['document_name']}** wurde abgefragt."
+            reference = to_reference(response_json, "section")
+            update_references(reference)
 
-                    reference = to_reference(response_json, "section")
-                    update_references(reference)
+            return reference.print_reference()
 
-                    return reference.print_reference()
+        except ClientResponseError as e:
+            out_str = (
+                f"Die Sektion {chapter_id}.{section_id} konnte nicht gefunden werden."
+            )
+            step.output = out_str
+            return out_str
 
-        except ClientConnectorError as e:
+        except (ClientConnectorError, asyncio.TimeoutError) as e:
             step.output = f"Server Aktuell nicht erreichbar."
             return "Der Server ist aktuell nicht erreichbar. Versuchen Sie es später erneut."
 
@@ -299,13 +453,7 @@ async def retrieve_formula(
     Mögliche Anwendungen sind wenn der User eine spezifische Formel sucht oder im text eine wichtige Formel referenziert wird.
     """
 
-    retrival_settings = cl.user_session.get("settings")["retrieval_settings"]
-
-    request_json_body = {
-        "document_id": script_id,
-        "formula_id": formula_id,
-        "collection_name": retrival_settings["collection_name"],
-    }
+    request_json_body = build_formula_request(script_id, formula_id)
 
     async with cl.Step(
         name="Formel Abfrage",
@@ -319,24 +467,20 @@ async def retrieve_formula(
         )
 
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    FORMULA_DB_URL, json=request_json_body
-                ) as response:
-                    if response.status != 200:
-                        out_str = f"Die Anfrage ist fehlgeschlagen. Es wurde keine Formel mit ID '{formula_id}' in Skript '{script_id}' gefunden."
-                        step.output = out_str
-                        return out_str
+            response_json = await get_tool_response(FORMULA_DB_URL, request_json_body)
+            step.output = f"Es wurde Formel ({response_json['formula_id']}) in Sektion **{response_json['section_name']}** aus Kapitel **{response_json['chapter_name']}** in **{response_json['document_name']}** wurde abgefragt.\n{response_json['content']}"
 
-                    response_json = await response.json()
-                    step.output = f"Es wurde Formel ({response_json['formula_id']}) in Sektion **{response_json['section_name']}** aus Kapitel **{response_json['chapter_name']}** in **{response_json['document_name']}** wurde abgefragt.\n{response_json['content']}"
+            reference = to_reference(response_json, "formula")
+            update_references(reference)
 
-                    reference = to_reference(response_json, "formula")
-                    update_references(reference)
+            return reference.print_reference()
 
-                    return reference.print_reference()
+        except ClientResponseError as e:
+            out_str = f"Die Anfrage ist fehlgeschlagen. Es wurde keine Formel mit ID '{formula_id}' in Skript '{script_id}' gefunden."
+            step.output = out_str
+            return out_str
 
-        except ClientConnectorError as e:
+        except (ClientConnectorError, asyncio.TimeoutError) as e:
             step.output = f"Server Aktuell nicht erreichbar."
             return "Der Server ist aktuell nicht erreichbar. Versuchen Sie es später erneut."
 
@@ -409,21 +553,21 @@ async def query_wolfram_alpha(query: str) -> str:
 
         try:
 
-            async with aiohttp.ClientSession() as session:
-                async with session.get(query_url) as response:
-                    if response.status != 200:
-                        print(response.status)
-                        print(await response.text())
-                        step.output = "Die Anfrage ist fehlgeschlagen."
-                        return "Die Anfrage ist fehlgeschlagen."
+            session = get_http_session()
+            async with session.get(query_url) as response:
+                if response.status != 200:
+                    print(response.status)
+                    print(await response.text())
+                    step.output = "Die Anfrage ist fehlgeschlagen."
+                    return "Die Anfrage ist fehlgeschlagen."
 
-                    res_json = response_to_json(await response.text())
+                res_json = response_to_json(await response.text())
 
-                    output_str = format_query_response(res_json)
-                    step.output = output_str
-                    return output_str
+                output_str = format_query_response(res_json)
+                step.output = output_str
+                return output_str
 
-        except ClientConnectorError as e:
+        except (ClientConnectorError, asyncio.TimeoutError) as e:
             step.output = f"Server aktuell nicht erreichbar."
             return "Der Server ist aktuell nicht erreichbar. Versuchen Sie es später erneut."
 
@@ -434,29 +578,22 @@ async def retrieve_section_no_step(
     section_id: str,
 ) -> str:
 
-    retrival_settings = cl.user_session.get("settings")["retrieval_settings"]
-
-    request_json_body = {
-        "document_id": script_id,
-        "chapter_id": chapter_id,
-        "section_id": section_id,
-        "collection_name": retrival_settings["collection_name"],
-    }
+    request_json_body = build_section_request(script_id, chapter_id, section_id)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(CHAPTER_DB_URL, json=request_json_body) as response:
-                if response.status != 200:
-                    out_str = f"Die Sektion {chapter_id}.{section_id} konnte nicht gefunden werden."
-                    return out_str
+        session = get_http_session()
+        async with session.post(CHAPTER_DB_URL, json=request_json_body) as response:
+            if response.status != 200:
+                out_str = f"Die Sektion {chapter_id}.{section_id} konnte nicht gefunden werden."
+                return out_str
 
-                response_json = await response.json()
-                reference = to_reference(response_json, "section")
-                update_references(reference)
+            response_json = await response.json()
+            reference = to_reference(response_json, "section")
+            update_references(reference)
 
-                return reference.print_reference()
+            return reference.print_reference()
 
-    except ClientConnectorError as e:
+    except (ClientConnectorError, asyncio.TimeoutError) as e:
         return (
             "Der Server ist aktuell nicht erreichbar. Versuchen Sie es später erneut."
         )
@@ -468,26 +605,21 @@ async def retrieve_table_of_contents_no_step(script_id: str) -> str:
     Gibt das Inhaltsverzeichnis mit Sektions-IDs zurück.
     """
 
-    ret_settings = cl.user_session.get("settings")["retrieval_settings"]
+    request_json_body = build_toc_request(script_id)
 
-    request_json_body = {
-        "document_id": script_id,
-        "collection_name": ret_settings["collection_name"],
-    }
+    session = get_http_session()
+    async with session.post(TOC_DB_URL, json=request_json_body) as response:
+        if response.status != 200:
+            return "Es konnte kein Inhaltsverzeichnis gefunden werden."
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(TOC_DB_URL, json=request_json_body) as response:
-            if response.status != 200:
-                return "Es konnte kein Inhaltsverzeichnis gefunden werden."
+        response_json: dict = await response.json()
 
-            response_json: dict = await response.json()
+        toc: list | None = response_json.get("toc", None)
+        if toc is None:
+            return "Es konnte kein Inhaltsverzeichnis gefunden werden."
 
-            toc: list | None = response_json.get("toc", None)
-            if toc is None:
-                return "Es konnte kein Inhaltsverzeichnis gefunden werden."
-
-            toc = "\n".join(toc)
-            return toc
+        toc = "\n".join(toc)
+        return toc
 
 
 @tool(args_schema=QuestionSetup)
@@ -526,25 +658,23 @@ async def question_setup(topic: str | None = None) -> None:
                 "rerank_score_threshold": 0.5,
                 "permitted_document_ids": cl.user_session.get("permitted_document_ids"),
             }
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    VECTOR_DB_URL, json=request_json_body
-                ) as response:
-
-                    response_json = await response.json()
-                    document_list: list[dict] = response_json["documents"]
-                    if len(document_list) == 0:
-                        await cl.Message(
-                            content=f"Zu dem Thema **{topic}** konnten ich leider keine Sektionen finden. Ich werde eine zufällige Sektion auswählen."
-                        ).send()
-                        available_sections = cl.user_session.get("available_sections")
-                    else:
-                        available_sections = [
-                            f"{doc['section_name']} | {doc['document_id']}"
-                            for doc in document_list
-                        ]
-                        # deduplicate the list
-                        available_sections = list(set(available_sections))
+            session = get_http_session()
+            async with session.post(VECTOR_DB_URL, json=request_json_body) as response:
+
+                response_json = await response.json()
+                document_list: list[dict] = response_json["documents"]
+                if len(document_list) == 0:
+                    await cl.Message(
+                        content=f"Zu dem Thema **{topic}** konnten ich leider keine Sektionen finden. Ich werde eine zufällige Sektion auswählen."
+                    ).send()
+                    available_sections = cl.user_session.get("available_sections")
+                else:
+                    available_sections = [
+                        f"{doc['section_name']} | {doc['document_id']}"
+                        for doc in document_list
+                    ]
+                    # deduplicate the list
+                    available_sections = list(set(available_sections))
 
         except Exception as e:
             available_sections = cl.user_session.get("available_sections")
@@ -1,28 +1,84 @@
+import time
+
+# measure how long the imports take, scaled-out workers should boot fast
+IMPORT_START_TIME = time.perf_counter()
+
+import asyncio
+import functools
+import queue
+import zlib
+from contextlib import asynccontextmanager
+
 import chromadb
 import pandas as pd
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from utils.alias_functions import (
+    StaleCollectionVersion,
+    resolve_collection_name,
+    rollback_alias,
+)
 from utils.app_dataclasses import (
+    CollectionRequest,
     ScriptInsert,
+    ScriptsInsert,
     DocumentQuery,
     FormulaRequest,
+    FormulaSearchRequest,
     SectionRequest,
     TOCRequest,
 )
 from utils.chroma_functions import (
     extend_chroma_results,
+    get_formulas,
+    get_sections,
+    get_toc,
     insert_script_into_chroma,
-    query_chroma_collection,
+    insert_script_records_into_chroma,
+    insert_scripts_into_chroma,
+    query_chroma_collections,
 )
 from utils.etc_functions import load_env_vars
-from utils.query_functions import generate_multiquery, process_results, rerank_results
+from utils.formula_functions import get_formula_index
+from utils.query_functions import (
+    STAGE_DURATION_ESTIMATES,
+    LatencyBudget,
+    generate_multiquery,
+    process_results,
+    rerank_results,
+)
+from utils.route_functions import (
+    get_routable_document_ids,
+    lookup_route,
+    route_query,
+)
+from utils.stream_functions import (
+    STREAM_END,
+    iter_ndjson_records,
+    iter_record_batches,
+)
 from utils.transform_functions import format_script, linting_script
-from wrappers.cohere_wrappers import Cohere_Reranker
+from utils.warmup_functions import start_warm_up_thread, warmup_state
+from utils.provider_registry import ProviderRegistry
+from utils.singleflight import SingleFlight
+from wrappers.cohere_wrappers import RerankerUnavailable, create_reranker
 from wrappers.openai_wrappers import OpenAI_Embedding
 
+IMPORT_DURATION = time.perf_counter() - IMPORT_START_TIME
+print(f"Imported the backend modules in {IMPORT_DURATION:.2f}s")
+
 load_env_vars()
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # preload everything the first request would otherwise pay for
+    start_warm_up_thread(providers)
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -31,17 +87,87 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-reranker = Cohere_Reranker()
-embedding_function = OpenAI_Embedding()
-chroma_client = chromadb.HttpClient(
-    host="chroma",
-    port=8000,
-    settings=chromadb.Settings(
-        allow_reset=True,
-        anonymized_telemetry=False,
+
+@app.exception_handler(StaleCollectionVersion)
+def stale_collection_version_handler(request: Request, e: StaleCollectionVersion):
+    # another worker swapped the collection during the insert, the client can simply retry
+    return JSONResponse(status_code=409, content={"detail": str(e)})
+
+
+# the clients are only constructed on first use, see the warm-up
+providers = ProviderRegistry()
+providers.register("reranker", create_reranker)
+providers.register("embedding_function", OpenAI_Embedding)
+providers.register(
+    "chroma_client",
+    lambda: chromadb.HttpClient(
+        host="chroma",
+        port=8000,
+        settings=chromadb.Settings(
+            allow_reset=True,
+            anonymized_telemetry=False,
+        ),
     ),
 )
 
+# identical concurrent requests only hit chroma, the embedding and the reranker once
+singleflight = SingleFlight()
+
+
+def get_collection(collection_name: str) -> chromadb.Collection:
+    # the collection name is an alias which points to the currently active version
+    chroma_client = providers.get("chroma_client")
+    try:
+        return chroma_client.get_collection(
+            name=resolve_collection_name(chroma_client, collection_name),
+            embedding_function=providers.get("embedding_function"),
+        )
+    except ValueError:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Collection '{collection_name}' not found",
+        )
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok"}
+
+
+@app.get("/ready")
+def ready():
+    if not warmup_state["ready"]:
+        raise HTTPException(
+            status_code=503,
+            detail={
+                "status": "warming up",
+                "attempts": warmup_state["attempts"],
+                "error": warmup_state["error"],
+            },
+        )
+
+    return {
+        "status": "ready",
+        "import_duration": IMPORT_DURATION,
+        "warmup_duration": warmup_state["duration"],
+    }
+
+
+@app.get("/metrics")
+def metrics():
+    # only report the reranker if it was constructed already
+    reranker = providers.instances.get("reranker", None)
+
+    return {
+        "reranker": reranker.metrics() if reranker is not None else None,
+        "reranker_warmup": {
+            "failures": warmup_state["reranker_failures"],
+            "error": warmup_state["reranker_error"],
+        },
+        "singleflight": singleflight.stats,
+        "stage_duration_estimates": STAGE_DURATION_ESTIMATES,
+    }
+
 
 @app.post("/insert_script")
 def insert_script(script_insert: ScriptInsert):
@@ -57,8 +183,8 @@ def insert_script(script_insert: ScriptInsert):
         script=script_content,
         script_name=script_name,
         script_id=script_id,
-        chroma_client=chroma_client,
-        embedding_function=embedding_function,
+        chroma_client=providers.get("chroma_client"),
+        embedding_function=providers.get("embedding_function"),
         collection_name=script_insert.collection_name,
     )
 
@@ -67,22 +193,168 @@ def insert_script(script_insert: ScriptInsert):
     }
 
 
-@app.post("/query")
-def query_database(document_query: DocumentQuery):
+@app.post("/insert_script_stream")
+async def insert_script_stream(
+    request: Request,
+    script_id: str,
+    script_name: str,
+    collection_name: str = "default",
+    batch_size: int = 256,
+):
+    # the body is a NDJSON stream of paragraph records, see utils/stream_functions.py
+    # batches are embedded and inserted in a background thread while the upload continues
+    if script_id.strip() == "" or script_name.strip() == "":
+        raise HTTPException(400, detail="script_id and script_name must not be empty")
+    if collection_name.strip() == "":
+        raise HTTPException(400, detail="collection_name must not be empty")
+    if batch_size < 1:
+        raise HTTPException(400, detail="batch_size must be greater than 0")
+
+    # bounded, so a slow embedding API throttles the upload instead of buffering it
+    record_queue = queue.Queue(maxsize=4)
+    ingestion = asyncio.get_running_loop().run_in_executor(
+        None,
+        functools.partial(
+            insert_script_records_into_chroma,
+            record_batches=iter_record_batches(record_queue),
+            script_name=script_name,
+            script_id=script_id,
+            chroma_client=providers.get("chroma_client"),
+            embedding_function=providers.get("embedding_function"),
+            collection_name=collection_name,
+        ),
+    )
+
+    async def _put(batch) -> None:
+        while not ingestion.done():
+            try:
+                await asyncio.to_thread(record_queue.put, batch, timeout=1.0)
+                return
+            except queue.Full:
+                continue
 
+    records = []
     try:
-        collection = chroma_client.get_collection(
-            name=document_query.collection_name,
-            embedding_function=embedding_function,
-        )
-    except ValueError:
-        raise HTTPException(
-            status_code=404,
-            detail=f"Collection '{document_query.collection_name}' not found",
+        async for record in iter_ndjson_records(
+            request.stream(),
+            compressed=request.headers.get("content-encoding", "") == "gzip",
+        ):
+            records.append(record)
+            if len(records) >= batch_size:
+                await _put(records)
+                records = []
+            # the ingestion failed, the error is raised below
+            if ingestion.done():
+                break
+        if len(records) > 0:
+            await _put(records)
+        await _put(STREAM_END)
+    except BaseException as e:
+        # e.g. an invalid record or a disconnected client, the new collection version is discarded
+        await _put(ValueError(f"Invalid stream: {e}"))
+        try:
+            await ingestion
+        except Exception:
+            pass
+        # json.JSONDecodeError is a ValueError
+        if isinstance(e, (ValueError, zlib.error)):
+            raise HTTPException(400, detail=f"Invalid stream: {e}")
+        raise
+
+    try:
+        num_rows = await ingestion
+    except (ValueError, TypeError, KeyError) as e:
+        # e.g. an empty stream or a record the transformation rejects
+        raise HTTPException(400, detail=f"Invalid stream: {e}")
+
+    return {
+        "status": f"Successfully inserted document '{script_name}' with id '{script_id}' and {num_rows} paragraphs into the collection '{collection_name}'"
+    }
+
+
+@app.post("/insert_scripts")
+def insert_scripts(scripts_insert: ScriptsInsert):
+
+    insert_scripts_into_chroma(
+        scripts=[
+            {
+                "script": script_insert.script_content,
+                "script_name": script_insert.script_name,
+                "script_id": script_insert.script_id,
+            }
+            for script_insert in scripts_insert.scripts
+        ],
+        chroma_client=providers.get("chroma_client"),
+        embedding_function=providers.get("embedding_function"),
+        collection_name=scripts_insert.collection_name,
+        format_and_lint=not scripts_insert.skip_format_and_lint,
+        max_workers=scripts_insert.max_workers,
+    )
+
+    script_ids = [script_insert.script_id for script_insert in scripts_insert.scripts]
+    return {
+        "status": f"Successfully inserted the documents {script_ids} into the collection '{scripts_insert.collection_name}'"
+    }
+
+
+@app.post("/rollback")
+def rollback_collection(collection_request: CollectionRequest):
+
+    try:
+        active_name = rollback_alias(
+            providers.get("chroma_client"), collection_request.collection_name
         )
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    return {
+        "status": f"Rolled back the collection '{collection_request.collection_name}' to '{active_name}'"
+    }
+
+
+@app.post("/query")
+@singleflight.coalesce
+def query_database(document_query: DocumentQuery):
+
+    # with a deadline, optional stages are skipped or truncated once the budget runs out
+    budget = LatencyBudget(document_query.deadline_ms)
+
+    collection_names = document_query.collection_names or [
+        document_query.collection_name
+    ]
+    # keeps the order of the requested collections, duplicates are only searched once
+    collections = {
+        collection_name: get_collection(collection_name)
+        for collection_name in collection_names
+    }
 
     queries = [document_query.query]
 
+    # lookups like "Gleichung 3.13" or "Kapitel 4.2" are answered directly without embedding or reranking
+    for collection in collections.values():
+        if not document_query.use_routing:
+            break
+
+        route = route_query(
+            document_query.query,
+            get_routable_document_ids(
+                collection, document_query.permitted_document_ids
+            ),
+        )
+        if route is None:
+            continue
+
+        with budget.stage("lookup"):
+            lookup_response = lookup_route(route, collection, document_query.top_n)
+        if lookup_response is not None:
+            return {
+                "route": route["route"],
+                "queries": queries,
+                **lookup_response,
+                "skipped_stages": budget.skipped_stages,
+                "stage_durations": budget.stage_durations,
+            }
+
     # Sometimes leads to errors, so disabled for now
     if document_query.num_multiquery > 1 and False:
         queries.append(
@@ -93,69 +365,97 @@ def query_database(document_query: DocumentQuery):
             )
         )
 
-    documents: pd.DataFrame = query_chroma_collection(
-        collection=collection,
-        queries=queries,
-        top_k=document_query.top_k,
-        permitted_document_ids=document_query.permitted_document_ids,
-    )
+    with budget.stage("search"):
+        documents: pd.DataFrame = query_chroma_collections(
+            collections=collections,
+            queries=queries,
+            top_k=document_query.top_k,
+            permitted_document_ids=document_query.permitted_document_ids,
+            chroma_client=providers.get("chroma_client"),
+            embedding_function=providers.get("embedding_function"),
+            include_embeddings=document_query.diversity > 0,
+        )
 
     if len(documents) == 0:
         return {
+            "route": "vector",
             "queries": queries,
             "documents": [],
+            "skipped_stages": budget.skipped_stages,
+            "stage_durations": budget.stage_durations,
         }
 
-    if document_query.use_rerank:
-        documents: pd.DataFrame = rerank_results(
-            query=queries[0],
-            documents=documents,
-            reranker=reranker,
-        )
+    # without a reranker the vector scores are used by process_results
+    # the reranker is only created if a query actually asks for it
+    reranker = providers.get("reranker") if document_query.use_rerank else None
+    if reranker is not None:
+        # rerank only as many candidates as fit into the remaining budget
+        max_documents = int(len(documents) * budget.fraction_available("rerank"))
+        if max_documents < 2:
+            budget.skip("rerank")
+        else:
+            try:
+                with budget.stage("rerank"):
+                    documents: pd.DataFrame = rerank_results(
+                        query=queries[0],
+                        documents=documents,
+                        reranker=reranker,
+                        max_documents=max_documents,
+                        timeout=(
+                            None if budget.deadline is None else budget.remaining()
+                        ),
+                    )
+            except RerankerUnavailable as e:
+                # e.g. a timeout or an open circuit breaker, use the vector scores instead
+                print(f"{e}, falling back to the vector scores")
+                budget.skip("rerank")
 
     documents: pd.DataFrame = process_results(
         documents=documents,
         top_n=document_query.top_n,
         rerank_score_threshold=document_query.rerank_score_threshold,
+        diversity=document_query.diversity,
     )
 
-    if document_query.extend_results:
-        documents: pd.DataFrame = extend_chroma_results(
-            documents=documents,
-            collection=collection,
-        )
+    if document_query.extend_results and len(documents) > 0 and budget.allows("extend"):
+        with budget.stage("extend"):
+            # the paragraphs are extended from the collection they were found in
+            extended_documents = []
+            for collection_name, collection_documents in documents.groupby(
+                "collection_name", sort=False
+            ):
+                collection_documents = extend_chroma_results(
+                    documents=collection_documents,
+                    collection=collections[collection_name],
+                )
+                collection_documents["collection_name"] = collection_name
+                extended_documents.append(collection_documents)
+            documents = pd.concat(extended_documents, ignore_index=True).sort_values(
+                by=["score"], ascending=False
+            )
 
     return {
+        "route": "vector",
         "queries": queries,
         "documents": documents.to_dict(orient="records"),
+        "skipped_stages": budget.skipped_stages,
+        "stage_durations": budget.stage_durations,
     }
 
 
 @app.post("/toc")
+@singleflight.coalesce
 def retrieve_toc(toc_request: TOCRequest):
 
-    try:
-        collection = chroma_client.get_collection(
-            name=toc_request.collection_name,
-            embedding_function=embedding_function,
-        )
-    except ValueError:
-        raise HTTPException(
-            status_code=404,
-            detail=f"Collection '{toc_request.collection_name}' not found",
-        )
+    collection = get_collection(toc_request.collection_name)
 
-    try:
-        toc = collection.metadata[toc_request.document_id + "_toc"]
-    except KeyError:
+    toc = get_toc(collection, toc_request.document_id)
+    if toc is None:
         raise HTTPException(
             status_code=404,
             detail=f"The Table of Content for '{toc_request.document_id}' not found in the collection '{toc_request.collection_name}'",
         )
 
-    # now format the TOC, as Chroma supports only a string
-    toc = toc.split("\n")
-
     return {
         "collection_name": toc_request.collection_name,
         "document_id": toc_request.document_id,
@@ -164,32 +464,19 @@ def retrieve_toc(toc_request: TOCRequest):
 
 
 @app.post("/section")
+@singleflight.coalesce
 def retrieve_section(section_request: SectionRequest):
 
-    print(section_request)
-
-    try:
-        collection = chroma_client.get_collection(
-            name=section_request.collection_name,
-            embedding_function=embedding_function,
-        )
-    except ValueError:
-        raise HTTPException(
-            status_code=404,
-            detail=f"Collection '{section_request.collection_name}' not found",
-        )
+    collection = get_collection(section_request.collection_name)
 
-    db_response = collection.get(
-        where={
-            "$and": [
-                {"document_id": section_request.document_id},
-                {"chapter_id": section_request.chapter_id},
-                {"section_id": section_request.section_id},
-            ]
-        }
+    sections = get_sections(
+        collection,
+        section_request.chapter_id,
+        section_request.section_id,
+        [section_request.document_id],
     )
 
-    if len(db_response["ids"]) == 0:
+    if len(sections) == 0:
         raise HTTPException(
             status_code=404,
             detail=(
@@ -199,52 +486,31 @@ def retrieve_section(section_request: SectionRequest):
             ),
         )
 
-    metadatas = db_response["metadatas"]
-    paragraph_ids = [metadata["paragraph_id"] for metadata in metadatas]
-    documents = db_response["documents"]
-
-    # sort the documents and ref_idxs by the ref_idxs
-    # this is necessary because the ref_idxs are not always in order and we concatenate the documents
-    # If we don't sort the documents, the paragraphs will be out of order
-    sorted_paragraph_id_indexs = sorted(
-        range(len(paragraph_ids)), key=lambda k: int(paragraph_ids[k])
-    )
-
+    section = sections[0]
     return {
-        "document_id": section_request.document_id,
-        "chapter_id": section_request.chapter_id,
-        "section_id": section_request.section_id,
-        "document_name": metadatas[0]["document_name"],
-        "chapter_name": metadatas[0]["chapter_name"],
-        "section_name": metadatas[0]["section_name"],
-        "content": "\n".join([documents[i] for i in sorted_paragraph_id_indexs]),
+        "document_id": section["document_id"],
+        "chapter_id": section["chapter_id"],
+        "section_id": section["section_id"],
+        "document_name": section["document_name"],
+        "chapter_name": section["chapter_name"],
+        "section_name": section["section_name"],
+        "content": section["content"],
     }
 
 
 @app.post("/formula")
+@singleflight.coalesce
 def retrieve_formula(formula_request: FormulaRequest):
 
-    try:
-        collection = chroma_client.get_collection(
-            name=formula_request.collection_name,
-            embedding_function=embedding_function,
-        )
-    except ValueError:
-        raise HTTPException(
-            status_code=404,
-            detail=f"Collection '{formula_request.collection_name}' not found",
-        )
+    collection = get_collection(formula_request.collection_name)
 
-    db_response = collection.get(
-        where={
-            "$and": [
-                {"document_id": formula_request.document_id},
-                {"formula_id": formula_request.formula_id},
-            ],
-        }
+    formulas = get_formulas(
+        collection,
+        [formula_request.formula_id],
+        [formula_request.document_id],
     )
 
-    if len(db_response["ids"]) == 0:
+    if len(formulas) == 0:
         raise HTTPException(
             status_code=404,
             detail=(
@@ -253,16 +519,35 @@ def retrieve_formula(formula_request: FormulaRequest):
             ),
         )
 
-    metadata = db_response["metadatas"][0]
-    document = db_response["documents"][0]
+    formula = formulas[0]
+    return {
+        "document_id": formula["document_id"],
+        "chapter_id": formula["chapter_id"],
+        "section_id": formula["section_id"],
+        "formula_id": formula["formula_id"],
+        "document_name": formula["document_name"],
+        "chapter_name": formula["chapter_name"],
+        "section_name": formula["section_name"],
+        "content": formula["content"],
+    }
+
+
+@app.post("/formula_search")
+@singleflight.coalesce
+def search_formula(formula_search_request: FormulaSearchRequest):
+
+    collection = get_collection(formula_search_request.collection_name)
+
+    # structural search over the normalized LaTeX, nothing is embedded
+    start_time = time.perf_counter()
+    formulas = get_formula_index(collection).search(
+        formula_search_request.latex,
+        top_n=formula_search_request.top_n,
+        permitted_document_ids=formula_search_request.permitted_document_ids,
+    )
 
     return {
-        "document_id": metadata["document_id"],
-        "chapter_id": metadata["chapter_id"],
-        "section_id": metadata["section_id"],
-        "formula_id": metadata["formula_id"],
-        "document_name": metadata["document_name"],
-        "chapter_name": metadata["chapter_name"],
-        "section_name": metadata["section_name"],
-        "content": document,
+        "latex": formula_search_request.latex,
+        "formulas": formulas,
+        "duration": time.perf_counter() - start_time,
     }
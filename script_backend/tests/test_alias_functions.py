@@ -0,0 +1,129 @@
+import threading
+
+import chromadb
+import pytest
+
+from utils import alias_functions
+from utils.alias_functions import (
+    StaleCollectionVersion,
+    delete_collection_version,
+    get_partition_name,
+    resolve_collection_name,
+    swap_alias,
+)
+from utils.chroma_functions import (
+    add_rows_to_collection,
+    query_partitions,
+    shadow_collection,
+)
+
+
+@pytest.fixture
+def chroma_client():
+    chroma_client = chromadb.EphemeralClient(
+        settings=chromadb.Settings(allow_reset=True, anonymized_telemetry=False)
+    )
+    chroma_client.reset()
+    alias_functions._alias_cache.update(aliases={}, loaded_at=0.0)
+    return chroma_client
+
+
+def add_document(
+    collection: chromadb.Collection,
+    chroma_client: chromadb.ClientAPI,
+    document_id: str,
+) -> None:
+    add_rows_to_collection(
+        collection,
+        chroma_client,
+        ids=[f"{document_id}_0", f"{document_id}_1"],
+        embeddings=[[1.0, 0.0], [0.0, 1.0]],
+        documents=["a", "b"],
+        metadatas=[{"document_id": document_id}, {"document_id": document_id}],
+    )
+
+
+class StubEmbeddingFunction(chromadb.EmbeddingFunction):
+    def __call__(self, input: chromadb.Documents) -> chromadb.Embeddings:
+        return [[1.0, 0.0] for _ in input]
+
+
+def list_collection_names(chroma_client: chromadb.ClientAPI) -> set[str]:
+    return {collection.name for collection in chroma_client.list_collections()}
+
+
+def test_delete_collection_version_keeps_other_collections(chroma_client):
+    # a legacy collection and an unrelated collection sharing its prefix
+    legacy_collection = chroma_client.create_collection("default")
+    add_document(legacy_collection, chroma_client, "mechanics")
+    physics_collection = chroma_client.create_collection("default-physics")
+    add_document(physics_collection, chroma_client, "optics")
+
+    delete_collection_version(chroma_client, "default")
+
+    assert list_collection_names(chroma_client) == {
+        "default-physics",
+        get_partition_name("default-physics", "optics"),
+    }
+
+
+def test_swap_alias_rejects_a_stale_version(chroma_client):
+    chroma_client.create_collection("default_v1")
+    chroma_client.create_collection("default_v2")
+    chroma_client.create_collection("default_v3")
+    swap_alias(chroma_client, "default", "default_v1", None)
+    swap_alias(chroma_client, "default", "default_v2", "default_v1")
+
+    # default_v3 was built from default_v1, it would drop the changes of default_v2
+    with pytest.raises(StaleCollectionVersion):
+        swap_alias(chroma_client, "default", "default_v3", "default_v1")
+
+    assert resolve_collection_name(chroma_client, "default", False) == "default_v2"
+
+
+def test_concurrent_shadow_builds_keep_all_documents(chroma_client):
+    def insert(document_id: str) -> None:
+        with shadow_collection(
+            chroma_client,
+            "default",
+            embedding_function=None,
+            replaced_document_ids=[document_id],
+        ) as collection:
+            add_document(collection, chroma_client, document_id)
+
+    threads = [
+        threading.Thread(target=insert, args=(document_id,))
+        for document_id in ["mechanics", "optics", "thermodynamics"]
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    active_collection = chroma_client.get_collection(
+        resolve_collection_name(chroma_client, "default", False)
+    )
+    assert active_collection.count() == 6
+
+
+def test_partitions_of_similar_document_ids_are_kept_apart(chroma_client):
+    collection = chroma_client.create_collection("default_v1")
+    long_document_id = (
+        "Skript_Experimentalphysik_Wintersemester_2024_Mechanik_und_Waerme"
+    )
+    for document_id in ["A.B", "A_B", long_document_id]:
+        add_document(collection, chroma_client, document_id)
+
+    assert get_partition_name("default_v1", "A.B") != get_partition_name(
+        "default_v1", "A_B"
+    )
+    assert len(get_partition_name("default_v1", long_document_id)) <= 63
+
+    rows_per_query = query_partitions(
+        ["Was ist Impuls?"],
+        collection,
+        chroma_client,
+        StubEmbeddingFunction(),
+        permitted_document_ids=["A_B"],
+    )
+    assert {row["document_id"] for row in rows_per_query[0]} == {"A_B"}
@@ -0,0 +1,33 @@
+import pytest
+from fastapi import HTTPException
+
+from utils.app_dataclasses import ScriptsInsert
+
+
+def script(**kwargs) -> dict:
+    return {
+        "script_content": {"1 Einleitung": {"1.1 Grundlagen": {"1": "Text"}}},
+        "script_name": "Experimentalphysik 1",
+        "script_id": "EX1",
+        **kwargs,
+    }
+
+
+def test_scripts_use_the_values_of_the_request():
+    scripts_insert = ScriptsInsert(
+        scripts=[script(), script(script_id="EX2", collection_name="physics")],
+        collection_name="physics",
+    )
+
+    assert scripts_insert.collection_name == "physics"
+
+
+@pytest.mark.parametrize(
+    "script_values",
+    [{"collection_name": "default"}, {"skip_format_and_lint": False}],
+)
+def test_scripts_with_other_values_are_rejected(script_values):
+    with pytest.raises(HTTPException) as exc_info:
+        ScriptsInsert(scripts=[script(**script_values)], collection_name="physics")
+
+    assert exc_info.value.status_code == 400
@@ -0,0 +1,130 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from wrappers.cohere_wrappers import (
+    Cohere_Reranker,
+    RerankBudgetExceeded,
+    RerankerUnavailable,
+    create_reranker,
+)
+
+
+class StubClient:
+    # answers every rerank after latency seconds, or raises error
+    def __init__(self, latency: float = 0.0, error: Exception | None = None) -> None:
+        self.latency = latency
+        self.error = error
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def rerank(self, model, query, documents, return_documents, request_options):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        if self.error is not None:
+            raise self.error
+        return SimpleNamespace(
+            results=[
+                SimpleNamespace(index=i, relevance_score=1.0 / (i + 1))
+                for i in range(len(documents))
+            ]
+        )
+
+
+def create_stub_reranker(client: StubClient, **kwargs) -> Cohere_Reranker:
+    reranker = Cohere_Reranker(
+        reranking_api="cohere",
+        api_key="test",
+        use_hedging=False,
+        **kwargs,
+    )
+    reranker.client = client
+    return reranker
+
+
+def test_budget_timeout_does_not_open_the_circuit_breaker():
+    reranker = create_stub_reranker(StubClient(latency=0.3), timeout=10.0)
+
+    for _ in range(reranker.circuit_breaker.failure_threshold + 1):
+        with pytest.raises(RerankBudgetExceeded):
+            reranker("query", ["a", "b"], timeout=0.05)
+
+    assert reranker.circuit_breaker.state == "closed"
+    assert reranker.circuit_breaker.consecutive_failures == 0
+    assert reranker.metrics()["budget_exceeded"] == 6
+    assert reranker.metrics()["failures"] == 0
+
+
+def test_own_timeout_counts_as_failure():
+    reranker = create_stub_reranker(StubClient(latency=0.3), timeout=0.05)
+
+    with pytest.raises(RerankerUnavailable) as exc_info:
+        reranker("query", ["a", "b"], timeout=1.0)
+
+    assert not isinstance(exc_info.value, RerankBudgetExceeded)
+    assert reranker.circuit_breaker.consecutive_failures == 1
+
+
+def test_provider_errors_open_the_circuit_breaker():
+    client = StubClient(error=RuntimeError("500"))
+    reranker = create_stub_reranker(client)
+
+    for _ in range(reranker.circuit_breaker.failure_threshold):
+        with pytest.raises(RerankerUnavailable):
+            reranker("query", ["a", "b"], timeout=1.0)
+
+    assert reranker.circuit_breaker.state == "open"
+    with pytest.raises(RerankerUnavailable):
+        reranker("query", ["a", "b"])
+    assert client.calls == reranker.circuit_breaker.failure_threshold
+
+
+def test_budget_timeout_releases_the_half_open_trial():
+    reranker = create_stub_reranker(StubClient(latency=0.3), timeout=10.0)
+    reranker.circuit_breaker.state = "open"
+    reranker.circuit_breaker.opened_at = 0.0
+
+    with pytest.raises(RerankBudgetExceeded):
+        reranker("query", ["a", "b"], timeout=0.05)
+
+    # the next call is let through as the trial again
+    reranker.client.latency = 0.0
+    assert reranker("query", ["a", "b"]) == [1.0, 0.5]
+    assert reranker.circuit_breaker.state == "closed"
+
+
+def test_chunks_share_one_deadline():
+    # the chunks run one after another, each one would fit into the timeout on its own
+    reranker = create_stub_reranker(
+        StubClient(latency=0.2),
+        timeout=0.5,
+        max_documents_per_call=2,
+        max_parallel_calls=1,
+    )
+
+    start_time = time.perf_counter()
+    with pytest.raises(RerankerUnavailable):
+        reranker("query", ["a", "b", "c", "d", "e", "f", "g", "h"])
+
+    assert time.perf_counter() - start_time < 0.7
+    assert reranker.circuit_breaker.consecutive_failures == 1
+
+
+def test_chunk_scores_are_concatenated():
+    reranker = create_stub_reranker(
+        StubClient(),
+        max_documents_per_call=2,
+        max_parallel_calls=2,
+    )
+
+    assert reranker("query", ["a", "b", "c"]) == [1.0, 0.5, 1.0]
+
+
+def test_create_reranker_without_configuration_disables_the_reranking(monkeypatch):
+    monkeypatch.delenv("USED_RERANKING_API", raising=False)
+    monkeypatch.delenv("COHERE_API_KEY", raising=False)
+
+    assert create_reranker() is None
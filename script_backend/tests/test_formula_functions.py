@@ -0,0 +1,52 @@
+from utils.formula_functions import FormulaIndex, extract_latex, normalize_latex
+
+
+def formula(id: str, document_id: str, latex: str) -> dict:
+    return {
+        "id": id,
+        "document_id": document_id,
+        "formula_id": id.split(".")[-1],
+        "content": f"Gl. {id} $${latex}$$",
+        "formula_tokens": " ".join(normalize_latex(extract_latex(f"$${latex}$$"))),
+    }
+
+
+FORMULAS = [
+    formula("EX1.1", "EX1", r"E = \frac{1}{2} m v^2"),
+    formula("EX1.2", "EX1", r"\vec{p} = m \vec{v}"),
+    formula("EX2.1", "EX2", r"E = \dfrac{1}{2} m v^2 + m g h"),
+]
+
+
+def test_normalize_latex_ignores_the_typesetting():
+    assert normalize_latex(r"\left( \dfrac{a}{b} \right)") == normalize_latex(
+        r"(\frac a b)"
+    )
+    assert extract_latex("Gl. 3.13 $$F = m a$$") == "F = m a"
+
+
+def test_search_prefers_the_shorter_formula_on_equal_scores():
+    results = FormulaIndex(FORMULAS).search(r"E = \tfrac{1}{2} m v^2")
+
+    assert [result["id"] for result in results] == ["EX1.1", "EX2.1"]
+    assert results[0]["score"] == 1.0
+    # the tokens are only used by the index
+    assert "formula_tokens" not in results[0]
+
+
+def test_search_only_returns_permitted_documents():
+    results = FormulaIndex(FORMULAS).search(
+        r"\mathbf{p} = m \mathbf{v}", permitted_document_ids=["EX2"]
+    )
+
+    assert results == []
+
+
+def test_short_queries_are_matched_with_single_tokens():
+    results = FormulaIndex(FORMULAS).search(r"\vec{p}", top_n=1)
+
+    assert [result["id"] for result in results] == ["EX1.2"]
+
+
+def test_empty_queries_return_nothing():
+    assert FormulaIndex(FORMULAS).search("{ }") == []
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+
+from utils.query_functions import maximal_marginal_relevance, process_results
+
+# two near duplicates of the most relevant paragraph and one different paragraph
+EMBEDDINGS = [[1.0, 0.0], [0.99, 0.01], [0.0, 1.0]]
+
+
+def test_maximal_marginal_relevance_skips_near_duplicates():
+    relevances = np.array([0.9, 0.85, 0.5])
+    embeddings = np.array(EMBEDDINGS)
+
+    assert maximal_marginal_relevance(relevances, embeddings, 2, diversity=0.0) == [
+        0,
+        1,
+    ]
+    assert maximal_marginal_relevance(relevances, embeddings, 2, diversity=0.5) == [
+        0,
+        2,
+    ]
+
+
+def test_process_results_diversifies_the_reranked_documents():
+    documents = pd.DataFrame(
+        {
+            "id": ["a", "b", "c", "d"],
+            "score": [0.1, 0.2, 0.3, 0.4],
+            "rerank_score": [0.9, 0.85, 0.5, 0.05],
+            "embedding": [*EMBEDDINGS, [0.5, 0.5]],
+        }
+    )
+
+    results = process_results(
+        documents, top_n=2, rerank_score_threshold=0.1, diversity=0.5
+    )
+
+    assert results["id"].tolist() == ["a", "c"]
+    assert results["score"].tolist() == [0.9, 0.5]
+    # the embeddings are only needed for the diversification
+    assert "embedding" not in results.columns
+
+
+def test_process_results_without_diversity_keeps_the_vector_order():
+    documents = pd.DataFrame(
+        {
+            "id": ["a", "b", "c"],
+            "score": [0.0, 0.5, 1.0],
+            "embedding": EMBEDDINGS,
+        }
+    )
+
+    results = process_results(documents, top_n=2)
+
+    assert results["id"].tolist() == ["a", "b"]
+    assert results["score"].tolist() == [1.0, 1 / 1.5]
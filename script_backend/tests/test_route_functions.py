@@ -0,0 +1,66 @@
+import pytest
+
+from utils.route_functions import route_query
+
+DOCUMENT_IDS = ["EX1", "EX2"]
+
+
+@pytest.mark.parametrize(
+    "query, route",
+    [
+        ("EX1 15.7/1", {"route": "snippet", "ids": ["EX1.15.7.1"]}),
+        (
+            "EX2 4.2 (1.3)",
+            {"route": "formula", "document_ids": ["EX2"], "formula_id": "1.3"},
+        ),
+        (
+            "[EX1 4.2]",
+            {
+                "route": "section",
+                "document_ids": ["EX1"],
+                "chapter_id": "4",
+                "section_id": "2",
+            },
+        ),
+        (
+            "Gleichung 3.13",
+            {"route": "formula", "document_ids": DOCUMENT_IDS, "formula_id": "3.13"},
+        ),
+        (
+            "Gl. (3.13) in EX2",
+            {"route": "formula", "document_ids": ["EX2"], "formula_id": "3.13"},
+        ),
+        (
+            "Kapitel 4.2",
+            {
+                "route": "section",
+                "document_ids": DOCUMENT_IDS,
+                "chapter_id": "4",
+                "section_id": "2",
+            },
+        ),
+        ("Inhaltsverzeichnis EX1", {"route": "toc", "document_ids": ["EX1"]}),
+    ],
+)
+def test_structured_lookups_are_routed(query, route):
+    assert route_query(query, DOCUMENT_IDS) == route
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        # real questions go through the vector search
+        "Wie folgt Gleichung 3.13 aus der Energieerhaltung?",
+        "Was ist Impuls?",
+        # the table of content is ambiguous without a document
+        "Inhaltsverzeichnis",
+        # the document of the key is not permitted
+        "EX3 15.7/1",
+    ],
+)
+def test_other_queries_use_the_vector_search(query):
+    assert route_query(query, DOCUMENT_IDS) is None
+
+
+def test_no_permitted_documents_use_the_vector_search():
+    assert route_query("Gleichung 3.13", []) is None
@@ -0,0 +1,66 @@
+import threading
+import time
+
+from utils.singleflight import SingleFlight, normalize_request
+
+
+def test_normalize_request_only_ignores_the_order_of_permitted_documents():
+    request = {
+        "query": "Was ist  Impuls?",
+        "collection_names": ["default", "physics"],
+        "permitted_document_ids": ["optics", "mechanics"],
+    }
+
+    assert normalize_request(request) == {
+        "query": "Was ist  Impuls?",
+        "collection_names": ["default", "physics"],
+        "permitted_document_ids": ["mechanics", "optics"],
+    }
+    assert normalize_request({"permitted_document_ids": None}) == {
+        "permitted_document_ids": None
+    }
+
+
+def test_coalesce_keys_on_the_exact_request():
+    singleflight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    @singleflight.coalesce
+    def query(collection_names: list[str], permitted_document_ids: list[str]):
+        calls.append(collection_names)
+        started.set()
+        release.wait(timeout=5)
+        return collection_names
+
+    results = []
+
+    def run(collection_names, permitted_document_ids):
+        results.append(
+            query(
+                collection_names=collection_names,
+                permitted_document_ids=permitted_document_ids,
+            )
+        )
+
+    leader = threading.Thread(target=run, args=(["default", "physics"], ["a", "b"]))
+    leader.start()
+    started.wait(timeout=5)
+    followers = [
+        # same request with the permitted documents in another order
+        threading.Thread(target=run, args=(["default", "physics"], ["b", "a"])),
+        # the order of the collections matters for the routing
+        threading.Thread(target=run, args=(["physics", "default"], ["a", "b"])),
+    ]
+    for follower in followers:
+        follower.start()
+    # wait until the followers are either coalesced or executed
+    while singleflight.stats["coalesced"] + singleflight.stats["executed"] < 3:
+        time.sleep(0.01)
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join()
+
+    assert singleflight.stats == {"executed": 2, "coalesced": 1}
+    assert sorted(map(tuple, calls)) == [("default", "physics"), ("physics", "default")]
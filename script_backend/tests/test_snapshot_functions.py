@@ -0,0 +1,110 @@
+import chromadb
+import numpy as np
+import pytest
+
+from utils.alias_functions import get_partition_name
+from utils import snapshot_functions
+from utils.snapshot_functions import (
+    CollectionSnapshot,
+    export_collection_snapshot,
+    import_collection_snapshot,
+)
+
+
+@pytest.fixture
+def chroma_client():
+    chroma_client = chromadb.EphemeralClient(
+        settings=chromadb.Settings(allow_reset=True, anonymized_telemetry=False)
+    )
+    chroma_client.reset()
+    return chroma_client
+
+
+def test_empty_collection_round_trip(chroma_client, tmp_path):
+    collection = chroma_client.create_collection(
+        "empty", metadata={"mechanics_toc": "1 Kinematik"}
+    )
+    snapshot_path = str(tmp_path / "empty.snap")
+
+    assert export_collection_snapshot(collection, snapshot_path) == 0
+    assert CollectionSnapshot(snapshot_path).embeddings.shape == (0, 0)
+
+    imported_collection = import_collection_snapshot(
+        snapshot_path, chroma_client, collection_name="empty_v2"
+    )
+    assert imported_collection.count() == 0
+    assert imported_collection.metadata == {"mechanics_toc": "1 Kinematik"}
+
+
+def add_rows(collection):
+    collection.add(
+        ids=["mechanics.1.1.1", "mechanics.1.1.2"],
+        embeddings=[[1.0, 0.0, 0.5], [0.0, 1.0, 0.5]],
+        documents=["Erster Absatz", "Zweiter Absatz"],
+        metadatas=[
+            {"document_id": "mechanics", "paragraph_id": "1"},
+            {"document_id": "mechanics", "paragraph_id": "2"},
+        ],
+    )
+
+
+# a batch size of 1 writes and reads the columns in several batches
+@pytest.mark.parametrize("batch_size", [1, 5000])
+def test_collection_round_trip(chroma_client, tmp_path, batch_size):
+    collection = chroma_client.create_collection("default", embedding_function=None)
+    add_rows(collection)
+    snapshot_path = str(tmp_path / "default.snap")
+
+    assert (
+        export_collection_snapshot(collection, snapshot_path, batch_size=batch_size)
+        == 2
+    )
+    assert CollectionSnapshot(snapshot_path).strings("ids") == [
+        "mechanics.1.1.1",
+        "mechanics.1.1.2",
+    ]
+
+    imported_collection = import_collection_snapshot(
+        snapshot_path,
+        chroma_client,
+        collection_name="default_v2",
+        batch_size=batch_size,
+    )
+    results = imported_collection.get(
+        ids=["mechanics.1.1.2"], include=["embeddings", "documents", "metadatas"]
+    )
+    assert results["documents"] == ["Zweiter Absatz"]
+    assert results["metadatas"] == [{"document_id": "mechanics", "paragraph_id": "2"}]
+    np.testing.assert_allclose(results["embeddings"][0], [0.0, 1.0, 0.5])
+    # the partition of the document is restored as well
+    assert (
+        chroma_client.get_collection(
+            get_partition_name("default_v2", "mechanics")
+        ).count()
+        == 2
+    )
+
+
+def test_failed_import_removes_the_collection(chroma_client, tmp_path, monkeypatch):
+    collection = chroma_client.create_collection("default", embedding_function=None)
+    add_rows(collection)
+    snapshot_path = str(tmp_path / "default.snap")
+    export_collection_snapshot(collection, snapshot_path)
+    add_rows_to_collection = snapshot_functions.add_rows_to_collection
+
+    def failing_add_rows_to_collection(*args, **kwargs):
+        # the first batch (and its partition) is added before the import fails
+        add_rows_to_collection(*args, **kwargs)
+        raise RuntimeError("chroma is not reachable")
+
+    monkeypatch.setattr(
+        snapshot_functions, "add_rows_to_collection", failing_add_rows_to_collection
+    )
+    with pytest.raises(RuntimeError):
+        import_collection_snapshot(
+            snapshot_path, chroma_client, collection_name="default_v2", batch_size=1
+        )
+
+    assert [collection.name for collection in chroma_client.list_collections()] == [
+        "default"
+    ]
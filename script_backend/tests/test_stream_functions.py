@@ -0,0 +1,71 @@
+import asyncio
+import gzip
+import queue
+
+import pytest
+
+from utils.stream_functions import (
+    STREAM_END,
+    iter_ndjson_records,
+    iter_record_batches,
+)
+
+RECORDS = [
+    b'{"chapter": "1 Einleitung", "section": "1.1 Grundlagen", "content": "a"}',
+    b'{"chapter": "1 Einleitung", "section": "1.2 Einheiten", "content": "b"}',
+]
+
+
+async def _chunks(body: bytes, chunk_size: int):
+    for start in range(0, len(body), chunk_size):
+        yield body[start : start + chunk_size]
+
+
+def parse(body: bytes, chunk_size: int = 7, compressed: bool = False) -> list[dict]:
+    async def _parse():
+        return [
+            record
+            async for record in iter_ndjson_records(
+                _chunks(body, chunk_size), compressed=compressed
+            )
+        ]
+
+    return asyncio.run(_parse())
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_records_split_across_chunks_are_parsed(compressed):
+    # blank lines are skipped and the last line needs no newline
+    body = RECORDS[0] + b"\n\n" + RECORDS[1]
+    if compressed:
+        body = gzip.compress(body)
+
+    records = parse(body, compressed=compressed)
+
+    assert [record["section"] for record in records] == [
+        "1.1 Grundlagen",
+        "1.2 Einheiten",
+    ]
+
+
+def test_records_without_the_required_keys_are_rejected():
+    with pytest.raises(ValueError):
+        parse(RECORDS[0] + b'\n{"chapter": "1 Einleitung"}\n')
+
+
+def test_invalid_json_is_rejected():
+    with pytest.raises(ValueError):
+        parse(RECORDS[0] + b"\n{not json\n")
+
+
+def test_an_exception_in_the_queue_aborts_the_batches():
+    record_queue = queue.Queue()
+    record_queue.put([{"content": "a"}])
+    record_queue.put(ValueError("Invalid stream"))
+    record_queue.put(STREAM_END)
+
+    batches = iter_record_batches(record_queue)
+
+    assert next(batches) == [{"content": "a"}]
+    with pytest.raises(ValueError):
+        next(batches)
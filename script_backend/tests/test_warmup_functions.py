@@ -0,0 +1,76 @@
+import chromadb
+import pytest
+
+from utils import alias_functions, warmup_functions
+from utils.alias_functions import get_partition_name, swap_alias
+from utils.chroma_functions import add_rows_to_collection
+from utils.provider_registry import ProviderRegistry
+
+
+@pytest.fixture
+def chroma_client():
+    chroma_client = chromadb.EphemeralClient(
+        settings=chromadb.Settings(allow_reset=True, anonymized_telemetry=False)
+    )
+    chroma_client.reset()
+    alias_functions._alias_cache.update(aliases={}, loaded_at=0.0)
+    return chroma_client
+
+
+def add_document(
+    chroma_client: chromadb.ClientAPI, collection_name: str, document_id: str
+) -> None:
+    add_rows_to_collection(
+        chroma_client.create_collection(collection_name),
+        chroma_client,
+        ids=[f"{document_id}_0"],
+        embeddings=[[1.0, 0.0]],
+        documents=["a"],
+        metadatas=[{"document_id": document_id}],
+    )
+
+
+def test_warm_up_skips_previous_versions_and_indexes_no_partitions(
+    chroma_client, monkeypatch
+):
+    # an alias containing "-" with an active and a previous version, and a legacy collection
+    add_document(chroma_client, "default-physics_v1", "optics")
+    add_document(chroma_client, "default-physics_v2", "optics")
+    add_document(chroma_client, "default", "mechanics")
+    swap_alias(chroma_client, "default-physics", "default-physics_v1", None)
+    swap_alias(
+        chroma_client, "default-physics", "default-physics_v2", "default-physics_v1"
+    )
+
+    queried_names, indexed_names = [], []
+    query = chromadb.Collection.query
+
+    def recording_query(collection, *args, **kwargs):
+        queried_names.append(collection.name)
+        return query(collection, *args, **kwargs)
+
+    monkeypatch.setattr(chromadb.Collection, "query", recording_query)
+    monkeypatch.setattr(warmup_functions, "get_encoder", lambda: None)
+    monkeypatch.setattr(
+        warmup_functions,
+        "get_formula_index",
+        lambda collection: indexed_names.append(collection.name),
+    )
+    providers = ProviderRegistry()
+    providers.register("chroma_client", lambda: chroma_client)
+    providers.register(
+        "embedding_function", lambda: lambda texts: [[1.0, 0.0] for _ in texts]
+    )
+    providers.register("reranker", lambda: None)
+
+    warmup_functions.warm_up(providers)
+
+    assert sorted(indexed_names) == ["default", "default-physics_v2"]
+    assert sorted(queried_names) == sorted(
+        [
+            "default",
+            get_partition_name("default", "mechanics"),
+            "default-physics_v2",
+            get_partition_name("default-physics_v2", "optics"),
+        ]
+    )
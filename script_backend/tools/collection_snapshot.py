@@ -0,0 +1,76 @@
+import argparse
+import os
+import sys
+import time
+
+import chromadb
+
+FILE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(FILE_DIR)
+
+from utils.alias_functions import (
+    StaleCollectionVersion,
+    delete_collection_version,
+    get_active_version,
+    next_version_name,
+    resolve_collection_name,
+    swap_alias,
+)
+from utils.snapshot_functions import (
+    export_collection_snapshot,
+    import_collection_snapshot,
+)
+
+parser = argparse.ArgumentParser(
+    description="Export or import a chroma collection as a compact snapshot file"
+)
+parser.add_argument("command", choices=["export", "import"])
+parser.add_argument("--collection", default="default")
+parser.add_argument(
+    "--path",
+    default=None,
+    help="The snapshot file, defaults to data/snapshots/<collection>.snap",
+)
+parser.add_argument("--host", default="localhost")
+parser.add_argument("--port", type=int, default=9666)
+args = parser.parse_args()
+
+snapshot_path = args.path or os.path.join(
+    FILE_DIR, "data", "snapshots", f"{args.collection}.snap"
+)
+
+chroma_client = chromadb.HttpClient(
+    host=args.host,
+    port=args.port,
+    settings=chromadb.Settings(anonymized_telemetry=False),
+)
+
+start_time = time.time()
+if args.command == "export":
+    collection = chroma_client.get_collection(
+        name=resolve_collection_name(chroma_client, args.collection)
+    )
+    num_rows = export_collection_snapshot(collection, snapshot_path)
+    print(f"Exported {num_rows} rows of '{args.collection}' to '{snapshot_path}'")
+else:
+    # the snapshot is imported as a new version and the alias is swapped afterwards
+    active_name = get_active_version(chroma_client, args.collection)
+    collection = import_collection_snapshot(
+        snapshot_path,
+        chroma_client,
+        collection_name=next_version_name(args.collection),
+    )
+    try:
+        unreferenced_name = swap_alias(
+            chroma_client, args.collection, collection.name, active_name
+        )
+    except StaleCollectionVersion:
+        # the collection was changed during the import, the snapshot would undo the change
+        delete_collection_version(chroma_client, collection.name)
+        raise
+    if unreferenced_name is not None:
+        delete_collection_version(chroma_client, unreferenced_name)
+    print(
+        f"Imported {collection.count()} rows from '{snapshot_path}' into '{args.collection}'"
+    )
+print(f"Took {time.time() - start_time:.1f}s")
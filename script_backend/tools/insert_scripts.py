@@ -0,0 +1,66 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import chromadb
+
+FILE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(FILE_DIR)
+
+from utils.chroma_functions import insert_scripts_into_chroma
+from utils.etc_functions import load_env_vars
+from wrappers.openai_wrappers import OpenAI_Embedding
+
+# the guard is required, the preprocessing workers are spawned and import this module again
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Insert several scripts at once, the preprocessing runs on all cores"
+    )
+    parser.add_argument(
+        "--script",
+        nargs=3,
+        action="append",
+        required=True,
+        metavar=("SCRIPT_ID", "PATH", "SCRIPT_NAME"),
+        help="Can be given multiple times, e.g. --script EX1 data/scripts/EX1.json 'Experimentalphysik 1'",
+    )
+    parser.add_argument("--collection", default="default")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--format-and-lint", action="store_true")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=9666)
+    args = parser.parse_args()
+
+    load_env_vars()
+
+    scripts = []
+    for script_id, script_path, script_name in args.script:
+        with open(script_path, "r", encoding="utf-8") as f:
+            scripts.append(
+                {
+                    "script": json.load(f),
+                    "script_name": script_name,
+                    "script_id": script_id,
+                }
+            )
+
+    chroma_client = chromadb.HttpClient(
+        host=args.host,
+        port=args.port,
+        settings=chromadb.Settings(anonymized_telemetry=False),
+    )
+
+    start_time = time.time()
+    insert_scripts_into_chroma(
+        scripts=scripts,
+        chroma_client=chroma_client,
+        embedding_function=OpenAI_Embedding(),
+        collection_name=args.collection,
+        format_and_lint=args.format_and_lint,
+        max_workers=args.workers,
+    )
+    print(
+        f"Inserted {len(scripts)} scripts into '{args.collection}' in {time.time() - start_time:.1f}s"
+    )
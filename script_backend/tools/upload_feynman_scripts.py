@@ -15,17 +15,21 @@ script_names = [
     "The Feynman Lectures III",
 ]
 
+# all volumes are sent in one request, so they share one preprocessing and embedding pass
+json_body = {"scripts": []}
 for index, (script_id, script_path) in enumerate(scripts.items()):
     script_path = os.path.join(FILE_DIR, script_path)
     with open(script_path, "r", encoding="utf-8") as f:
         script = json.load(f)
 
-    json_body = {
-        "script_id": script_id,
-        "script_content": script,
-        "script_name": script_names[index],
-    }
+    json_body["scripts"].append(
+        {
+            "script_id": script_id,
+            "script_content": script,
+            "script_name": script_names[index],
+        }
+    )
 
-    response = requests.post("http://localhost:9667/insert_script", json=json_body)
+response = requests.post("http://localhost:9667/insert_scripts", json=json_body)
 
-    print(response.json())
+print(response.json())
@@ -0,0 +1,59 @@
+import argparse
+import json
+import os
+import sys
+import zlib
+
+import requests
+
+FILE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(FILE_DIR)
+
+from utils.stream_functions import script_to_records
+
+parser = argparse.ArgumentParser(
+    description="Upload a script as a (gzip compressed) NDJSON stream of paragraphs"
+)
+parser.add_argument("script_id")
+parser.add_argument("path", help="The script in the nested JSON format")
+parser.add_argument("script_name")
+parser.add_argument("--collection", default="default")
+parser.add_argument("--no-gzip", action="store_true")
+parser.add_argument("--url", default="http://localhost:9667/insert_script_stream")
+args = parser.parse_args()
+
+
+def iter_body(script: dict, compress: bool):
+    # the body is generated on the fly, requests sends it with chunked transfer encoding
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+    for record in script_to_records(script):
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        if compressor is None:
+            yield line
+        else:
+            chunk = compressor.compress(line)
+            if chunk:
+                yield chunk
+    if compressor is not None:
+        yield compressor.flush()
+
+
+with open(args.path, "r", encoding="utf-8") as f:
+    script = json.load(f)
+
+headers = {"Content-Type": "application/x-ndjson"}
+if not args.no_gzip:
+    headers["Content-Encoding"] = "gzip"
+
+response = requests.post(
+    args.url,
+    params={
+        "script_id": args.script_id,
+        "script_name": args.script_name,
+        "collection_name": args.collection,
+    },
+    data=iter_body(script, compress=not args.no_gzip),
+    headers=headers,
+)
+
+print(response.json())
@@ -0,0 +1,197 @@
+import hashlib
+import re
+import time
+
+import chromadb
+
+# The aliases are stored in the metadata of a dedicated collection, so all workers share them
+# alias -> active collection version, "{alias}_previous" -> the version before, used for rollbacks
+ALIAS_COLLECTION_NAME = "collection_aliases"
+ALIAS_CACHE_SECONDS = 1.0
+
+_alias_cache = {"aliases": {}, "loaded_at": 0.0}
+
+
+class StaleCollectionVersion(Exception):
+    """Raised if the alias was swapped by someone else while a new version was built from the old one."""
+
+
+def get_partition_name(collection_name: str, document_id: str) -> str:
+    # every document is additionally stored in its own collection (partition)
+    # chroma only allows 3-63 characters of [a-zA-Z0-9._-] in collection names,
+    # the hash keeps the name short and different ids (e.g. "A.B" and "A_B") apart
+    document_hash = hashlib.sha1(document_id.encode("utf-8")).hexdigest()[:16]
+    return f"{collection_name}-p{document_hash}"
+
+
+def _get_legacy_partition_name(collection_name: str, document_id: str) -> str:
+    # the partitions of collections built before the names were hashed
+    document_id = re.sub(r"[^a-zA-Z0-9_-]", "_", document_id)
+    return f"{collection_name}-{document_id}"
+
+
+def _get_alias_registry(chroma_client: chromadb.ClientAPI) -> chromadb.Collection:
+    return chroma_client.get_or_create_collection(name=ALIAS_COLLECTION_NAME)
+
+
+def _load_aliases(
+    chroma_client: chromadb.ClientAPI,
+    use_cache: bool = True,
+) -> dict:
+    if use_cache and time.monotonic() - _alias_cache["loaded_at"] < ALIAS_CACHE_SECONDS:
+        return _alias_cache["aliases"]
+
+    aliases = dict(_get_alias_registry(chroma_client).metadata or {})
+    _alias_cache.update(aliases=aliases, loaded_at=time.monotonic())
+    return aliases
+
+
+def resolve_collection_name(
+    chroma_client: chromadb.ClientAPI,
+    collection_name: str,
+    use_cache: bool = True,
+) -> str:
+    # collections without an alias are used directly, this keeps old collections working
+    return _load_aliases(chroma_client, use_cache).get(collection_name, collection_name)
+
+
+def list_previous_collection_names(chroma_client: chromadb.ClientAPI) -> list[str]:
+    # the versions which are only kept for rollbacks
+    return [
+        collection_name
+        for key, collection_name in _load_aliases(chroma_client).items()
+        if key.endswith("_previous")
+    ]
+
+
+def next_version_name(alias: str) -> str:
+    # e.g. default_v20241019153012123456, the microseconds keep quick successive inserts apart
+    now = time.time()
+    return f"{alias}_v{time.strftime('%Y%m%d%H%M%S', time.localtime(now))}{int(now % 1 * 1e6):06d}"
+
+
+def list_document_ids(
+    collection: chromadb.Collection,
+    batch_size: int = 10_000,
+) -> set[str]:
+    document_ids = set()
+    offset = 0
+    while True:
+        results = collection.get(include=["metadatas"], limit=batch_size, offset=offset)
+        if len(results["ids"]) == 0:
+            break
+        document_ids.update(
+            metadata["document_id"]
+            for metadata in results["metadatas"]
+            if metadata is not None and "document_id" in metadata
+        )
+        offset += batch_size
+    return document_ids
+
+
+def list_partition_names(collection: chromadb.Collection) -> set[str]:
+    # the names of the partitions the documents of the collection may have (not all of them exist)
+    partition_names = set()
+    for document_id in list_document_ids(collection):
+        partition_names.add(get_partition_name(collection.name, document_id))
+        partition_names.add(_get_legacy_partition_name(collection.name, document_id))
+    return partition_names
+
+
+def delete_collection_version(
+    chroma_client: chromadb.ClientAPI,
+    collection_name: str,
+) -> None:
+    # delete the collection together with the partitions of its documents
+    # a prefix match would also delete other collections, e.g. "default-physics" with "default"
+    try:
+        collection = chroma_client.get_collection(name=collection_name)
+    except ValueError:
+        return
+
+    partition_names = list_partition_names(collection)
+    for existing_collection in chroma_client.list_collections():
+        if existing_collection.name in partition_names:
+            print(f"Deleting collection '{existing_collection.name}'...")
+            chroma_client.delete_collection(name=existing_collection.name)
+
+    print(f"Deleting collection '{collection_name}'...")
+    chroma_client.delete_collection(name=collection_name)
+
+
+def get_active_version(
+    chroma_client: chromadb.ClientAPI,
+    alias: str,
+) -> str | None:
+    return _get_active_version(
+        chroma_client, _load_aliases(chroma_client, use_cache=False), alias
+    )
+
+
+def _get_active_version(
+    chroma_client: chromadb.ClientAPI,
+    aliases: dict,
+    alias: str,
+) -> str | None:
+    if alias in aliases:
+        return aliases[alias]
+
+    # a collection created before aliases existed is the active version
+    existing_names = [
+        collection.name for collection in chroma_client.list_collections()
+    ]
+    return alias if alias in existing_names else None
+
+
+def swap_alias(
+    chroma_client: chromadb.ClientAPI,
+    alias: str,
+    collection_name: str,
+    expected_active_name: str | None,
+) -> str | None:
+    """
+    Points the alias to the given collection version in a single metadata write.
+    The swap only happens if the active version is still expected_active_name (the version the new one was built from),
+    otherwise StaleCollectionVersion is raised and the alias is left untouched.
+    The previously active version is kept for rollbacks.
+    Returns the version which is no longer referenced and can be deleted, if any.
+    """
+    registry = _get_alias_registry(chroma_client)
+    aliases = dict(registry.metadata or {})
+
+    # chroma has no compare and swap, the check right before the write keeps the window small
+    active_name = _get_active_version(chroma_client, aliases, alias)
+    if active_name != expected_active_name:
+        raise StaleCollectionVersion(
+            f"'{alias}' was swapped to '{active_name}' while '{collection_name}' was built from '{expected_active_name}'"
+        )
+
+    unreferenced_name = aliases.get(f"{alias}_previous", None)
+
+    aliases[alias] = collection_name
+    if active_name is not None and active_name != collection_name:
+        aliases[f"{alias}_previous"] = active_name
+
+    registry.modify(metadata=aliases)
+    _alias_cache.update(aliases=aliases, loaded_at=time.monotonic())
+
+    if unreferenced_name in [None, collection_name, active_name]:
+        return None
+    return unreferenced_name
+
+
+def rollback_alias(chroma_client: chromadb.ClientAPI, alias: str) -> str:
+    registry = _get_alias_registry(chroma_client)
+    aliases = dict(registry.metadata or {})
+
+    if alias not in aliases or f"{alias}_previous" not in aliases:
+        raise ValueError(f"There is no previous version of '{alias}' to roll back to")
+
+    aliases[alias], aliases[f"{alias}_previous"] = (
+        aliases[f"{alias}_previous"],
+        aliases[alias],
+    )
+
+    registry.modify(metadata=aliases)
+    _alias_cache.update(aliases=aliases, loaded_at=time.monotonic())
+    return aliases[alias]
@@ -7,6 +7,8 @@ from pydantic import BaseModel, model_validator
 class DocumentQuery(BaseModel):
     query: str
     collection_name: str = "default"
+    # searches several collections at once, replaces collection_name
+    collection_names: list[str] | None = None
     top_k: int = 10
     top_n: int = 5
     num_multiquery: int = 0
@@ -14,6 +16,9 @@ class DocumentQuery(BaseModel):
     use_rerank: bool = False
     extend_results: bool = False
     permitted_document_ids: list[str] | None = None
+    deadline_ms: int | None = None
+    use_routing: bool = True
+    diversity: float = 0.0
 
     @model_validator(mode="after")
     def custom_validation(self) -> Self:
@@ -30,6 +35,15 @@ class DocumentQuery(BaseModel):
                 detail="collection_name must not be empty",
             )
 
+        if self.collection_names is not None and (
+            len(self.collection_names) == 0
+            or any(name.strip() == "" for name in self.collection_names)
+        ):
+            raise HTTPException(
+                400,
+                detail="collection_names must not be empty or contain empty names",
+            )
+
         if self.top_k < 1:
             raise HTTPException(
                 400,
@@ -60,6 +74,18 @@ class DocumentQuery(BaseModel):
                 detail="rerank_score_threshold must be between 0 and 1",
             )
 
+        if self.diversity < 0 or self.diversity > 1:
+            raise HTTPException(
+                400,
+                detail="diversity must be between 0 and 1",
+            )
+
+        if self.deadline_ms is not None and self.deadline_ms < 1:
+            raise HTTPException(
+                400,
+                detail="deadline_ms must be greater than 0",
+            )
+
         return self
 
 
@@ -115,6 +141,51 @@ class FormulaRequest(BaseModel):
         return self
 
 
+class FormulaSearchRequest(BaseModel):
+    latex: str
+    collection_name: str = "default"
+    top_n: int = 5
+    permitted_document_ids: list[str] | None = None
+
+    @model_validator(mode="after")
+    def custom_validation(self) -> Self:
+
+        if self.latex.strip() == "":
+            raise HTTPException(
+                400,
+                detail="latex must not be empty",
+            )
+
+        if self.collection_name.strip() == "":
+            raise HTTPException(
+                400,
+                detail="collection_name must not be empty",
+            )
+
+        if self.top_n < 1:
+            raise HTTPException(
+                400,
+                detail="top_n must be greater than 0",
+            )
+
+        return self
+
+
+class CollectionRequest(BaseModel):
+    collection_name: str = "default"
+
+    @model_validator(mode="after")
+    def custom_validation(self) -> Self:
+
+        if self.collection_name.strip() == "":
+            raise HTTPException(
+                400,
+                detail="collection_name must not be empty",
+            )
+
+        return self
+
+
 class ScriptInsert(BaseModel):
     script_content: dict
     script_name: str
@@ -138,3 +209,52 @@ class ScriptInsert(BaseModel):
             )
 
         return self
+
+
+class ScriptsInsert(BaseModel):
+    # all scripts are inserted into collection_name, the scripts may only repeat the top level values
+    scripts: list[ScriptInsert]
+    collection_name: str = "default"
+    skip_format_and_lint: bool = True
+    max_workers: int | None = None
+
+    @model_validator(mode="after")
+    def custom_validation(self) -> Self:
+
+        if len(self.scripts) == 0:
+            raise HTTPException(
+                400,
+                detail="scripts must not be empty",
+            )
+
+        script_ids = [script.script_id for script in self.scripts]
+        if len(script_ids) != len(set(script_ids)):
+            raise HTTPException(
+                400,
+                detail="script ids must be unique",
+            )
+
+        if self.collection_name.strip() == "":
+            raise HTTPException(
+                400,
+                detail="collection_name must not be empty",
+            )
+
+        if self.max_workers is not None and self.max_workers < 1:
+            raise HTTPException(
+                400,
+                detail="max_workers must be greater than 0",
+            )
+
+        # only values which were actually sent with a script are compared, not the defaults
+        for script in self.scripts:
+            for key in ["collection_name", "skip_format_and_lint"]:
+                if key in script.model_fields_set and getattr(script, key) != getattr(
+                    self, key
+                ):
+                    raise HTTPException(
+                        400,
+                        detail=f"{key} of script '{script.script_id}' differs from the {key} of the request, insert the scripts in separate requests",
+                    )
+
+        return self
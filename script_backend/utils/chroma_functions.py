@@ -1,11 +1,206 @@
 import copy
-from typing import List
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List
 
 import chromadb
+import numpy as np
 import pandas as pd
-import tiktoken
 
-from .transform_functions import add_embeddings, formatted_script_to_pandas
+from .alias_functions import (
+    delete_collection_version,
+    get_active_version,
+    get_partition_name,
+    next_version_name,
+    swap_alias,
+)
+from .transform_functions import (
+    add_embeddings,
+    formatted_script_to_pandas,
+    get_encoder,
+    paragraph_to_row,
+    preprocess_script,
+)
+
+# metadata which is only used inside the backend (by the formula index) and not returned
+INTERNAL_METADATA_KEYS = ["formula_tokens"]
+
+
+def public_metadata(metadata: dict) -> dict:
+    return {
+        key: value
+        for key, value in metadata.items()
+        if key not in INTERNAL_METADATA_KEYS
+    }
+
+
+def upsert_in_batches(
+    collection: chromadb.Collection,
+    ids: list[str],
+    embeddings: list,
+    documents: list[str],
+    metadatas: list[dict],
+    add_per_iter: int = 1000,
+) -> None:
+    for i in range(0, len(ids), add_per_iter):
+        print(f"Adding papers {i} to {min(i + add_per_iter, len(ids))}...")
+        embedding_batch = embeddings[i : i + add_per_iter]
+        # numpy arrays (e.g. from a memory mapped snapshot) are only converted per batch
+        if isinstance(embedding_batch, np.ndarray):
+            embedding_batch = embedding_batch.tolist()
+        collection.upsert(
+            ids=ids[i : i + add_per_iter],
+            embeddings=embedding_batch,
+            documents=documents[i : i + add_per_iter],
+            metadatas=metadatas[i : i + add_per_iter],
+        )
+
+
+def add_rows_to_collection(
+    collection: chromadb.Collection,
+    chroma_client: chromadb.ClientAPI,
+    ids: list[str],
+    embeddings: list,
+    documents: list[str],
+    metadatas: list[dict],
+) -> None:
+    upsert_in_batches(collection, ids, embeddings, documents, metadatas)
+
+    # every document is also added to its own partition
+    row_indices_per_document = {}
+    for row_idx, metadata in enumerate(metadatas):
+        row_indices_per_document.setdefault(metadata["document_id"], []).append(row_idx)
+
+    for document_id, row_indices in row_indices_per_document.items():
+        partition = chroma_client.get_or_create_collection(
+            name=get_partition_name(collection.name, document_id)
+        )
+        upsert_in_batches(
+            partition,
+            [ids[i] for i in row_indices],
+            (
+                embeddings[row_indices]
+                if isinstance(embeddings, np.ndarray)
+                else [embeddings[i] for i in row_indices]
+            ),
+            [documents[i] for i in row_indices],
+            [metadatas[i] for i in row_indices],
+        )
+
+
+def copy_collection(
+    source: chromadb.Collection,
+    target: chromadb.Collection,
+    chroma_client: chromadb.ClientAPI,
+    exclude_document_ids: list[str] | None = None,
+    batch_size: int = 1000,
+) -> None:
+    # copies all rows including their embeddings, so nothing has to be embedded again
+    where = None
+    if exclude_document_ids:
+        where = {"document_id": {"$nin": exclude_document_ids}}
+
+    offset = 0
+    while True:
+        results = source.get(
+            where=where,
+            limit=batch_size,
+            offset=offset,
+            include=["embeddings", "documents", "metadatas"],
+        )
+        if len(results["ids"]) == 0:
+            break
+
+        print(f"Copying papers {offset} to {offset + len(results['ids'])}...")
+        add_rows_to_collection(
+            target,
+            chroma_client,
+            results["ids"],
+            results["embeddings"],
+            results["documents"],
+            results["metadatas"],
+        )
+        offset += batch_size
+
+
+# concurrent inserts into the same collection would copy the same active version and the last swap would win
+_shadow_locks: dict[str, threading.Lock] = {}
+_shadow_locks_lock = threading.Lock()
+
+
+def _get_shadow_lock(collection_name: str) -> threading.Lock:
+    with _shadow_locks_lock:
+        return _shadow_locks.setdefault(collection_name, threading.Lock())
+
+
+@contextmanager
+def shadow_collection(
+    chroma_client: chromadb.ClientAPI,
+    collection_name: str,
+    embedding_function: chromadb.EmbeddingFunction,
+    replaced_document_ids: list[str],
+) -> Iterator[chromadb.Collection]:
+    """
+    Builds a new version of the collection next to the active one.
+    All documents which are not replaced are copied from the active version.
+    Once the block finishes the alias is swapped, readers never see a half-built collection.
+    Builds of the same collection are serialized, a swap by another worker in the meantime raises StaleCollectionVersion.
+    """
+    with _get_shadow_lock(collection_name):
+        active_name = get_active_version(chroma_client, collection_name)
+        active_collection = None
+        shadow_metadata = {}
+        if active_name is not None:
+            try:
+                active_collection = chroma_client.get_collection(
+                    name=active_name,
+                    embedding_function=embedding_function,
+                )
+                # keep the table of contents of the documents which are not replaced
+                # hnsw settings can not be set through the metadata of a new collection
+                shadow_metadata = {
+                    key: value
+                    for key, value in (active_collection.metadata or {}).items()
+                    if not key.startswith("hnsw:")
+                    and key
+                    not in [
+                        f"{document_id}_toc" for document_id in replaced_document_ids
+                    ]
+                }
+            except ValueError:
+                pass
+
+        shadow_name = next_version_name(collection_name)
+        print(f"Building new collection version '{shadow_name}'...")
+        collection = chroma_client.create_collection(
+            name=shadow_name,
+            embedding_function=embedding_function,
+            metadata=shadow_metadata or None,
+        )
+
+        try:
+            if active_collection is not None:
+                copy_collection(
+                    active_collection,
+                    collection,
+                    chroma_client,
+                    exclude_document_ids=replaced_document_ids,
+                )
+            yield collection
+
+            # only swap if the active version is still the one the shadow was copied from
+            print(f"Swapping '{collection_name}' to '{shadow_name}'...")
+            unreferenced_name = swap_alias(
+                chroma_client, collection_name, shadow_name, active_name
+            )
+        except BaseException:
+            delete_collection_version(chroma_client, shadow_name)
+            raise
+
+        if unreferenced_name is not None:
+            delete_collection_version(chroma_client, unreferenced_name)
 
 
 def add_toc_to_chroma(
@@ -35,14 +230,12 @@ def add_toc_to_chroma(
     collection.modify(metadata=collection_metadata)
 
 
-def insert_script_into_chroma(
+def script_to_dataframe(
     script: dict,
     script_name: str,
     script_id: str,
-    chroma_client: chromadb.ClientAPI,
     embedding_function: chromadb.EmbeddingFunction,
-    collection_name: str,
-) -> None:
+) -> pd.DataFrame:
 
     print("Converting Script to Pandas...", end=" ")
     script_dataframe = formatted_script_to_pandas(
@@ -61,28 +254,23 @@ def insert_script_into_chroma(
     )
     print("Done")
 
-    print("Loading Chroma DB...", end=" ")
-    collection = chroma_client.get_or_create_collection(
-        name=collection_name,
-        embedding_function=embedding_function,
-    )
-    print("Done")
+    return script_dataframe
 
-    print("Purging old script data if it exists...", end=" ")
-    collection.delete(where={"document_id": script_id})
-    if collection.metadata is not None:
-        if (script_id + "_toc") in collection.metadata:
-            collection_metadata = copy.deepcopy(collection.metadata)
-            del collection_metadata[script_id + "_toc"]
-            collection.modify(metadata=collection_metadata)
-    print("Done")
+
+def add_script_dataframe_to_collection(
+    script_dataframe: pd.DataFrame,
+    collection: chromadb.Collection,
+    chroma_client: chromadb.ClientAPI,
+) -> None:
+    # the dataframe may contain several scripts, each gets its own table of contents
 
     print("Adding table of contents to DB...", end=" ")
-    add_toc_to_chroma(
-        script_id=script_id,
-        script_dataframe=script_dataframe,
-        collection=collection,
-    )
+    for script_id, script_group in script_dataframe.groupby("document_id"):
+        add_toc_to_chroma(
+            script_id=script_id,
+            script_dataframe=script_group,
+            collection=collection,
+        )
     print("Done")
 
     ids = script_dataframe["id"].astype(str).tolist()
@@ -92,29 +280,174 @@ def insert_script_into_chroma(
         script_dataframe.columns.difference(["content", "id", "embedding"])
     ].to_dict("records")
 
-    ADD_PER_ITER = 1000
-    for i in range(0, len(ids), ADD_PER_ITER):
+    add_rows_to_collection(
+        collection,
+        chroma_client,
+        ids,
+        embeddings,
+        documents,
+        metadatas,
+    )
 
-        if i + ADD_PER_ITER < len(ids):
-            print(f"Adding papers {i} to {i + ADD_PER_ITER}...")
-            id_batch = ids[i : i + ADD_PER_ITER]
-            embeddding_batch = embeddings[i : i + ADD_PER_ITER]
-            document_batch = documents[i : i + ADD_PER_ITER]
-            metadata_batch = metadatas[i : i + ADD_PER_ITER]
-        else:
-            print(f"Adding papers {i} to {len(ids)}...")
-            id_batch = ids[i:]
-            embeddding_batch = embeddings[i:]
-            document_batch = documents[i:]
-            metadata_batch = metadatas[i:]
 
-        collection.upsert(
-            ids=id_batch,
-            embeddings=embeddding_batch,
-            documents=document_batch,
-            metadatas=metadata_batch,
+def insert_script_into_chroma(
+    script: dict,
+    script_name: str,
+    script_id: str,
+    chroma_client: chromadb.ClientAPI,
+    embedding_function: chromadb.EmbeddingFunction,
+    collection_name: str,
+) -> None:
+
+    # embed the script before building the new version, the embedding takes the longest
+    script_dataframe = script_to_dataframe(
+        script=script,
+        script_name=script_name,
+        script_id=script_id,
+        embedding_function=embedding_function,
+    )
+
+    with shadow_collection(
+        chroma_client,
+        collection_name,
+        embedding_function,
+        replaced_document_ids=[script_id],
+    ) as collection:
+        add_script_dataframe_to_collection(
+            script_dataframe,
+            collection,
+            chroma_client,
+        )
+
+
+def insert_scripts_into_chroma(
+    scripts: list[dict],
+    chroma_client: chromadb.ClientAPI,
+    embedding_function: chromadb.EmbeddingFunction,
+    collection_name: str,
+    format_and_lint: bool = False,
+    max_workers: int | None = None,
+) -> None:
+    """
+    Inserts several scripts at once, scripts is a list of dicts with script, script_name and script_id.
+    The parsing, linting and token counting runs in a process pool, one per core by default.
+    All scripts share one embedding pass and one new collection version.
+    """
+    script_args = [
+        (script["script"], script["script_name"], script["script_id"], format_and_lint)
+        for script in scripts
+    ]
+
+    print(f"Preprocessing {len(scripts)} scripts...", end=" ", flush=True)
+    if len(scripts) == 1:
+        script_dataframes = [preprocess_script(*script_args[0])]
+    else:
+        # spawn instead of fork, the server process has running threads (warm-up, chroma client)
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            script_dataframes = list(
+                executor.map(preprocess_script, *zip(*script_args))
+            )
+    script_dataframe = pd.concat(script_dataframes, ignore_index=True)
+    print("Done")
+
+    print(f"Adding Embeddings for {len(script_dataframe)} rows...", end=" ", flush=True)
+    script_dataframe = add_embeddings(
+        script_dataframe,
+        embedding_function,
+        token_target=0,
+        overlap=0,
+    )
+    print("Done")
+
+    with shadow_collection(
+        chroma_client,
+        collection_name,
+        embedding_function,
+        replaced_document_ids=[script["script_id"] for script in scripts],
+    ) as collection:
+        add_script_dataframe_to_collection(
+            script_dataframe,
+            collection,
+            chroma_client,
+        )
+
+
+def insert_script_records_into_chroma(
+    record_batches: Iterable[list[dict]],
+    script_name: str,
+    script_id: str,
+    chroma_client: chromadb.ClientAPI,
+    embedding_function: chromadb.EmbeddingFunction,
+    collection_name: str,
+) -> int:
+    """
+    Inserts a script which arrives as batches of paragraph records, see utils/stream_functions.py.
+    Every batch is embedded and added as soon as it arrives, so only one batch is held in memory.
+    Returns the number of inserted paragraphs.
+    """
+    num_rows = 0
+    # the paragraph ids are counted per section, the records arrive in order
+    paragraph_counts: dict[tuple[str, str], int] = {}
+
+    with shadow_collection(
+        chroma_client,
+        collection_name,
+        embedding_function,
+        replaced_document_ids=[script_id],
+    ) as collection:
+        for records in record_batches:
+            rows = []
+            for record in records:
+                section_key = (record["chapter"], record["section"])
+                paragraph_id = paragraph_counts.get(section_key, 0)
+                paragraph_counts[section_key] = paragraph_id + 1
+                rows.append(
+                    paragraph_to_row(
+                        record["chapter"],
+                        record["section"],
+                        paragraph_id,
+                        record["content"],
+                        script_name,
+                        script_id,
+                    )
+                )
+
+            add_rows_to_collection(
+                collection,
+                chroma_client,
+                [row["id"] for row in rows],
+                embedding_function([row["content"] for row in rows]),
+                [row["content"] for row in rows],
+                [
+                    {
+                        key: value
+                        for key, value in row.items()
+                        if key not in ["id", "content"]
+                    }
+                    for row in rows
+                ],
+            )
+            num_rows += len(rows)
+
+        if num_rows == 0:
+            raise ValueError(
+                f"The stream for '{script_id}' did not contain any records"
+            )
+
+        # the table of contents only needs the chapter and section names
+        add_toc_to_chroma(
+            script_dataframe=pd.DataFrame(
+                list(paragraph_counts), columns=["chapter_name", "section_name"]
+            ),
+            script_id=script_id,
+            collection=collection,
         )
 
+    return num_rows
+
 
 def extend_chroma_results(
     documents: pd.DataFrame,
@@ -137,7 +470,7 @@ def extend_chroma_results(
 
         return continuous_segments
 
-    encoder = tiktoken.get_encoding("o200k_base")
+    encoder = get_encoder()
     section_groups = documents.groupby(["document_id", "chapter_id", "section_id"])
     extended_documents = []
 
@@ -190,7 +523,7 @@ def extend_chroma_results(
             results = collection.get(ids=dcsp_ids)
             metadatas = results["metadatas"]
 
-            main_metadata = metadatas[0]
+            main_metadata = public_metadata(metadatas[0])
             if "reference_anchor" in main_metadata:
                 del main_metadata["reference_anchor"]
 
@@ -217,40 +550,19 @@ def extend_chroma_results(
     return pd.DataFrame(extended_documents)
 
 
-def query_chroma_collection(
-    queries: List[str],
-    collection: chromadb.Collection,
-    top_k: int = 25,
-    permitted_document_ids: List[str] | None = None,
-) -> pd.DataFrame:
-
-    rows = []
-    if permitted_document_ids:
-        results = collection.query(
-            query_texts=queries,
-            n_results=top_k,
-            include=["distances", "metadatas", "documents"],
-            where={
-                "document_id": {
-                    "$in": permitted_document_ids,
-                },
-            },
-        )
-    else:
-        results = collection.query(
-            query_texts=queries,
-            n_results=top_k,
-            include=["distances", "metadatas", "documents"],
-        )
-
-    if len(results["ids"]) == 0:
-        return pd.DataFrame()
-
-    for query_idx in range(len(queries)):
+def _results_to_rows(
+    results: dict,
+    num_queries: int,
+    top_k: int,
+) -> list[list[dict]]:
+    rows_per_query = []
+    for query_idx in range(num_queries):
         query_ids = results["ids"][query_idx]
         query_metadatas = results["metadatas"][query_idx]
         query_documents = results["documents"][query_idx]
         query_distances = results["distances"][query_idx]
+
+        rows = []
         for result_idx in range(min(top_k, len(query_ids))):
             row = {
                 "id": query_ids[result_idx],
@@ -258,8 +570,139 @@ def query_chroma_collection(
                 "content": query_documents[result_idx],
             }
             ## Merge the metadata directly into the row dictionary
-            row.update(query_metadatas[result_idx])
+            row.update(public_metadata(query_metadatas[result_idx]))
+            if "embeddings" in results and results["embeddings"] is not None:
+                row["embedding"] = results["embeddings"][query_idx][result_idx]
             rows.append(row)
+        rows_per_query.append(rows)
+
+    return rows_per_query
+
+
+def query_partitions(
+    queries: List[str],
+    collection: chromadb.Collection,
+    chroma_client: chromadb.ClientAPI,
+    embedding_function: chromadb.EmbeddingFunction,
+    permitted_document_ids: List[str],
+    top_k: int = 25,
+    max_workers: int = 8,
+    include_embeddings: bool = False,
+) -> list[list[dict]]:
+    # embed the queries once and reuse them for every partition
+    query_embeddings = embedding_function(queries)
+    include = ["distances", "metadatas", "documents"]
+    if include_embeddings:
+        include.append("embeddings")
+
+    def _query_partition(document_id: str) -> dict | None:
+        try:
+            partition = chroma_client.get_collection(
+                name=get_partition_name(collection.name, document_id),
+                embedding_function=embedding_function,
+            )
+        except ValueError:
+            # the document was inserted before partitions (with hashed names) existed
+            return None
+        # a partition must never return the rows of another document
+        return partition.query(
+            query_embeddings=query_embeddings,
+            n_results=top_k,
+            include=include,
+            where={"document_id": document_id},
+        )
+
+    with ThreadPoolExecutor(
+        max_workers=min(max_workers, len(permitted_document_ids))
+    ) as executor:
+        partition_results = list(executor.map(_query_partition, permitted_document_ids))
+
+    # fall back to the filtered query on the whole collection for missing partitions
+    missing_document_ids = [
+        document_id
+        for document_id, results in zip(permitted_document_ids, partition_results)
+        if results is None
+    ]
+    if missing_document_ids:
+        partition_results.append(
+            collection.query(
+                query_embeddings=query_embeddings,
+                n_results=top_k,
+                include=include,
+                where={"document_id": {"$in": missing_document_ids}},
+            )
+        )
+
+    # merge the top_k of all partitions per query
+    merged_rows = [[] for _ in queries]
+    for results in partition_results:
+        if results is None or len(results["ids"]) == 0:
+            continue
+        for query_idx, rows in enumerate(
+            _results_to_rows(results, len(queries), top_k)
+        ):
+            merged_rows[query_idx].extend(rows)
+
+    return [sorted(rows, key=lambda row: row["score"])[:top_k] for rows in merged_rows]
+
+
+def query_chroma_collection(
+    queries: List[str],
+    collection: chromadb.Collection,
+    top_k: int = 25,
+    permitted_document_ids: List[str] | None = None,
+    chroma_client: chromadb.ClientAPI | None = None,
+    embedding_function: chromadb.EmbeddingFunction | None = None,
+    include_embeddings: bool = False,
+) -> pd.DataFrame:
+    include = ["distances", "metadatas", "documents"]
+    # the embeddings are only needed for the diversification of the results
+    if include_embeddings:
+        include.append("embeddings")
+
+    # query the per-document partitions if a client is available
+    # so the cost only scales with the permitted documents and not the whole collection
+    if (
+        permitted_document_ids
+        and chroma_client is not None
+        and embedding_function is not None
+    ):
+        rows_per_query = query_partitions(
+            queries=queries,
+            collection=collection,
+            chroma_client=chroma_client,
+            embedding_function=embedding_function,
+            permitted_document_ids=permitted_document_ids,
+            top_k=top_k,
+            include_embeddings=include_embeddings,
+        )
+    else:
+        if permitted_document_ids:
+            results = collection.query(
+                query_texts=queries,
+                n_results=top_k,
+                include=include,
+                where={
+                    "document_id": {
+                        "$in": permitted_document_ids,
+                    },
+                },
+            )
+        else:
+            results = collection.query(
+                query_texts=queries,
+                n_results=top_k,
+                include=include,
+            )
+
+        if len(results["ids"]) == 0:
+            return pd.DataFrame()
+
+        rows_per_query = _results_to_rows(results, len(queries), top_k)
+
+    rows = [row for query_rows in rows_per_query for row in query_rows]
+    if len(rows) == 0:
+        return pd.DataFrame()
 
     # Convert the list of row data into a DataFrame in one go
     final_df = pd.DataFrame(rows)
@@ -267,3 +710,153 @@ def query_chroma_collection(
     final_df = final_df.drop_duplicates(subset=["id"])
 
     return final_df
+
+
+def query_chroma_collections(
+    queries: List[str],
+    collections: dict[str, chromadb.Collection],
+    top_k: int = 25,
+    permitted_document_ids: List[str] | None = None,
+    chroma_client: chromadb.ClientAPI | None = None,
+    embedding_function: chromadb.EmbeddingFunction | None = None,
+    include_embeddings: bool = False,
+    max_workers: int = 4,
+) -> pd.DataFrame:
+    """
+    Queries several collections concurrently and merges the results.
+    collections maps the requested collection names to the collections.
+    The distances are min-max normalized per collection so they are comparable across collections.
+    """
+
+    def _query_collection(collection_name: str) -> pd.DataFrame:
+        documents = query_chroma_collection(
+            queries=queries,
+            collection=collections[collection_name],
+            top_k=top_k,
+            permitted_document_ids=permitted_document_ids,
+            chroma_client=chroma_client,
+            embedding_function=embedding_function,
+            include_embeddings=include_embeddings,
+        )
+        if len(documents) > 0:
+            documents["collection_name"] = collection_name
+        return documents
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(collections))) as executor:
+        results = list(executor.map(_query_collection, collections))
+    results = [documents for documents in results if len(documents) > 0]
+
+    if len(results) == 0:
+        return pd.DataFrame()
+    if len(results) == 1:
+        return results[0]
+
+    for documents in results:
+        # the spread of the distances differs between collections, e.g. by their size and content
+        min_score, max_score = documents["score"].min(), documents["score"].max()
+        documents["score"] = (documents["score"] - min_score) / max(
+            max_score - min_score, 1e-9
+        )
+
+    return pd.concat(results, ignore_index=True)
+
+
+def _where_all(conditions: list[dict]) -> dict:
+    # chroma requires at least two conditions for $and
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+def get_document_ids(collection: chromadb.Collection) -> list[str]:
+    # every inserted document stores its table of content in the collection metadata
+    return [
+        key.removesuffix("_toc")
+        for key in (collection.metadata or {})
+        if key.endswith("_toc")
+    ]
+
+
+def get_toc(collection: chromadb.Collection, document_id: str) -> list[str] | None:
+    toc = (collection.metadata or {}).get(document_id + "_toc", None)
+    # chroma only supports strings in the metadata
+    return None if toc is None else toc.split("\n")
+
+
+def get_sections(
+    collection: chromadb.Collection,
+    chapter_id: str,
+    section_id: str,
+    document_ids: list[str] | None = None,
+) -> list[dict]:
+    # one entry per document containing the section, with all paragraphs concatenated
+    conditions = [{"chapter_id": chapter_id}, {"section_id": section_id}]
+    if document_ids is not None:
+        conditions.append({"document_id": {"$in": document_ids}})
+    db_response = collection.get(where=_where_all(conditions))
+
+    paragraphs_per_document: dict[str, list[tuple[dict, str]]] = {}
+    for metadata, document in zip(db_response["metadatas"], db_response["documents"]):
+        paragraphs_per_document.setdefault(metadata["document_id"], []).append(
+            (metadata, document)
+        )
+
+    sections = []
+    for document_id, paragraphs in paragraphs_per_document.items():
+        # the paragraphs are not always returned in order, but they are concatenated
+        paragraphs = sorted(paragraphs, key=lambda x: int(x[0]["paragraph_id"]))
+        metadata = paragraphs[0][0]
+        sections.append(
+            {
+                "document_id": document_id,
+                "chapter_id": chapter_id,
+                "section_id": section_id,
+                "paragraph_id": metadata["paragraph_id"],
+                "document_name": metadata["document_name"],
+                "chapter_name": metadata["chapter_name"],
+                "section_name": metadata["section_name"],
+                "content": "\n".join([document for _, document in paragraphs]),
+                "num_tokens": sum(
+                    metadata.get("num_tokens", 0) for metadata, _ in paragraphs
+                ),
+            }
+        )
+
+    return sections
+
+
+def get_formulas(
+    collection: chromadb.Collection,
+    formula_ids: list[str],
+    document_ids: list[str] | None = None,
+) -> list[dict]:
+    conditions = [{"formula_id": {"$in": formula_ids}}]
+    if document_ids is not None:
+        conditions.append({"document_id": {"$in": document_ids}})
+    db_response = collection.get(where=_where_all(conditions))
+
+    return [
+        {
+            "document_id": metadata["document_id"],
+            "chapter_id": metadata["chapter_id"],
+            "section_id": metadata["section_id"],
+            "paragraph_id": metadata["paragraph_id"],
+            "formula_id": metadata["formula_id"],
+            "document_name": metadata["document_name"],
+            "chapter_name": metadata["chapter_name"],
+            "section_name": metadata["section_name"],
+            "content": document,
+            "num_tokens": metadata.get("num_tokens", 0),
+        }
+        for metadata, document in zip(
+            db_response["metadatas"], db_response["documents"]
+        )
+    ]
+
+
+def get_paragraphs(collection: chromadb.Collection, ids: list[str]) -> list[dict]:
+    db_response = collection.get(ids=ids)
+    return [
+        {"id": id, "content": document, **public_metadata(metadata)}
+        for id, metadata, document in zip(
+            db_response["ids"], db_response["metadatas"], db_response["documents"]
+        )
+    ]
@@ -0,0 +1,197 @@
+import re
+import threading
+import time
+from collections import Counter
+
+import chromadb
+
+# commands, letters, numbers and single symbols, e.g. "\frac{\partial E}{\partial t}"
+LATEX_TOKEN_PATTERN = re.compile(r"\\[a-zA-Z]+|\\.|[a-zA-Z]|\d+(?:\.\d+)?|\S")
+LATEX_MATH_PATTERN = re.compile(r"\$\$(.+?)\$\$|\$(.+?)\$", re.DOTALL)
+
+# tokens which only change the typesetting, not the formula
+IGNORED_LATEX_TOKENS = {
+    "{",
+    "}",
+    "\\left",
+    "\\right",
+    "\\big",
+    "\\Big",
+    "\\bigg",
+    "\\Bigg",
+    "\\displaystyle",
+    "\\textstyle",
+    "\\mathrm",
+    "\\mathit",
+    "\\text",
+    "\\operatorname",
+    "\\,",
+    "\\;",
+    "\\:",
+    "\\!",
+    "\\ ",
+    "\\quad",
+    "\\qquad",
+    "&",
+    "\\\\",
+}
+# different commands for the same symbol
+LATEX_TOKEN_ALIASES = {
+    "\\dfrac": "\\frac",
+    "\\tfrac": "\\frac",
+    "\\le": "\\leq",
+    "\\ge": "\\geq",
+    "\\ne": "\\neq",
+    "\\to": "\\rightarrow",
+    "\\gets": "\\leftarrow",
+    "\\varepsilon": "\\epsilon",
+    "\\vartheta": "\\theta",
+    "\\varphi": "\\phi",
+    "\\vec": "\\boldsymbol",
+    "\\mathbf": "\\boldsymbol",
+    "\\bm": "\\boldsymbol",
+    "\\lbrace": "(",
+    "\\rbrace": ")",
+    "[": "(",
+    "]": ")",
+    "\\{": "(",
+    "\\}": ")",
+    "\\lvert": "|",
+    "\\rvert": "|",
+    "\\vert": "|",
+}
+MAX_NGRAM_SIZE = 3
+
+
+def extract_latex(content: str) -> str:
+    # the formula paragraphs look like "Gl. 3.13 $$...$$", plain queries are LaTeX already
+    math_parts = [
+        display or inline for display, inline in LATEX_MATH_PATTERN.findall(content)
+    ]
+    return " ".join(math_parts) if math_parts else content
+
+
+def normalize_latex(latex: str) -> list[str]:
+    tokens = []
+    for token in LATEX_TOKEN_PATTERN.findall(latex):
+        token = LATEX_TOKEN_ALIASES.get(token, token)
+        if token not in IGNORED_LATEX_TOKENS:
+            tokens.append(token)
+    return tokens
+
+
+def _ngrams(tokens: list[str], n: int) -> list[str]:
+    return [" ".join(tokens[i : i + n]) for i in range(len(tokens) - n + 1)]
+
+
+class FormulaIndex:
+    """
+    In-memory n-gram postings over the normalized LaTeX tokens of all formulas of a collection.
+    A search counts the n-grams of the query contained in each formula, nothing is embedded.
+    """
+
+    def __init__(self, formulas: list[dict]) -> None:
+        self.formulas = formulas
+        self.postings: dict[str, set[int]] = {}
+        for formula_idx, formula in enumerate(formulas):
+            tokens = formula["formula_tokens"].split(" ")
+            for n in range(1, MAX_NGRAM_SIZE + 1):
+                for ngram in _ngrams(tokens, n):
+                    self.postings.setdefault(ngram, set()).add(formula_idx)
+
+    def search(
+        self,
+        latex: str,
+        top_n: int = 5,
+        permitted_document_ids: list[str] | None = None,
+    ) -> list[dict]:
+        tokens = normalize_latex(latex)
+        if len(tokens) == 0:
+            return []
+
+        # short queries or queries without any matching trigram are matched with shorter n-grams
+        hits = Counter()
+        for n in range(min(MAX_NGRAM_SIZE, len(tokens)), 0, -1):
+            query_ngrams = set(_ngrams(tokens, n))
+            for ngram in query_ngrams:
+                hits.update(self.postings.get(ngram, ()))
+            if len(hits) > 0:
+                break
+
+        results = []
+        for formula_idx, num_hits in hits.items():
+            formula = self.formulas[formula_idx]
+            if (
+                permitted_document_ids is not None
+                and formula["document_id"] not in permitted_document_ids
+            ):
+                continue
+            results.append(
+                {
+                    **formula,
+                    # the fraction of the query found in the formula
+                    "score": num_hits / len(query_ngrams),
+                }
+            )
+
+        # on equal scores the shorter, i.e. more specific, formula wins
+        results.sort(key=lambda x: (-x["score"], len(x["formula_tokens"])))
+        # the tokens are only used by the index
+        return [
+            {key: value for key, value in result.items() if key != "formula_tokens"}
+            for result in results[:top_n]
+        ]
+
+
+# collection versions are never modified after the alias swap, so the physical name is a stable key
+_formula_indexes: dict[str, FormulaIndex] = {}
+_formula_index_lock = threading.Lock()
+MAX_CACHED_FORMULA_INDEXES = 8
+
+
+def get_formula_index(collection: chromadb.Collection) -> FormulaIndex:
+    if collection.name in _formula_indexes:
+        return _formula_indexes[collection.name]
+
+    with _formula_index_lock:
+        if collection.name not in _formula_indexes:
+            start_time = time.perf_counter()
+            db_response = collection.get(where={"formula_id": {"$ne": ""}})
+
+            formulas = []
+            for id, metadata, document in zip(
+                db_response["ids"], db_response["metadatas"], db_response["documents"]
+            ):
+                # collections built before the formula tokens were stored are normalized here
+                formula_tokens = metadata.get("formula_tokens", None) or " ".join(
+                    normalize_latex(extract_latex(document))
+                )
+                if formula_tokens == "":
+                    continue
+                formulas.append(
+                    {
+                        "id": id,
+                        "document_id": metadata["document_id"],
+                        "chapter_id": metadata["chapter_id"],
+                        "section_id": metadata["section_id"],
+                        "paragraph_id": metadata["paragraph_id"],
+                        "formula_id": metadata["formula_id"],
+                        "document_name": metadata["document_name"],
+                        "chapter_name": metadata["chapter_name"],
+                        "section_name": metadata["section_name"],
+                        "content": document,
+                        "num_tokens": metadata.get("num_tokens", 0),
+                        "formula_tokens": formula_tokens,
+                    }
+                )
+
+            # the oldest indexes belong to replaced versions
+            while len(_formula_indexes) >= MAX_CACHED_FORMULA_INDEXES:
+                _formula_indexes.pop(next(iter(_formula_indexes)))
+            _formula_indexes[collection.name] = FormulaIndex(formulas)
+            print(
+                f"Built the formula index of '{collection.name}' with {len(formulas)} formulas "
+                f"in {time.perf_counter() - start_time:.2f}s"
+            )
+
+    return _formula_indexes[collection.name]
@@ -0,0 +1,33 @@
+import threading
+import time
+from typing import Any, Callable
+
+
+class ProviderRegistry:
+    """
+    Constructs the provider clients (embedding, reranking, chroma) lazily on first use.
+    A factory may return None if the provider is disabled.
+    """
+
+    def __init__(self) -> None:
+        self.factories: dict[str, Callable[[], Any]] = {}
+        self.instances: dict[str, Any] = {}
+        self.lock = threading.Lock()
+
+    def register(self, name: str, factory: Callable[[], Any]) -> None:
+        self.factories[name] = factory
+
+    def get(self, name: str) -> Any:
+        if name in self.instances:
+            return self.instances[name]
+
+        # concurrent first requests must not construct the same client twice
+        with self.lock:
+            if name not in self.instances:
+                start_time = time.perf_counter()
+                self.instances[name] = self.factories[name]()
+                print(
+                    f"Constructed provider '{name}' in {time.perf_counter() - start_time:.2f}s"
+                )
+
+        return self.instances[name]
@@ -1,15 +1,100 @@
-import openai
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Iterator
+
+import numpy as np
 import pandas as pd
 import requests
 
+if TYPE_CHECKING:
+    import openai
+
+
+# running estimates of the stage durations in seconds, updated after every query
+STAGE_DURATION_ESTIMATES = {
+    "search": 0.5,
+    "rerank": 0.5,
+    "extend": 0.2,
+}
+
+
+class LatencyBudget:
+    """
+    Tracks the remaining time of a query with a deadline.
+    Optional stages are skipped if their estimated duration exceeds the remaining budget.
+    """
+
+    def __init__(self, deadline_ms: int | None = None) -> None:
+        self.start_time = time.perf_counter()
+        self.deadline = None if deadline_ms is None else deadline_ms / 1000
+        self.stage_durations: dict[str, float] = {}
+        self.skipped_stages: list[str] = []
+
+    def remaining(self) -> float:
+        if self.deadline is None:
+            return float("inf")
+        return self.deadline - (time.perf_counter() - self.start_time)
+
+    def fraction_available(self, stage: str) -> float:
+        # how much of the stage fits into the remaining budget, 1.0 if it fits completely
+        return min(1.0, max(0.0, self.remaining() / STAGE_DURATION_ESTIMATES[stage]))
+
+    def allows(self, stage: str) -> bool:
+        if self.remaining() < STAGE_DURATION_ESTIMATES.get(stage, 0.0):
+            self.skip(stage)
+            return False
+        return True
+
+    def skip(self, stage: str) -> None:
+        self.skipped_stages.append(stage)
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        stage_start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            # failed stages (e.g. timeouts) are also counted, they are the slow ones
+            duration = time.perf_counter() - stage_start_time
+            self.stage_durations[stage] = duration
+            # exponential moving average, so slow providers are noticed quickly
+            if stage in STAGE_DURATION_ESTIMATES:
+                STAGE_DURATION_ESTIMATES[stage] = (
+                    0.8 * STAGE_DURATION_ESTIMATES[stage] + 0.2 * duration
+                )
+
 
 def rerank_results(
     query: str,
     documents: pd.DataFrame,
     reranker,
+    max_documents: int | None = None,
+    timeout: float | None = None,
+    max_tokens_per_document: int | None = 512,
 ) -> pd.DataFrame:
+    # only the best max_documents by vector distance are reranked, the rest is dropped
+    if max_documents is not None and max_documents < len(documents):
+        documents = documents.sort_values(by=["score"], ascending=True).head(
+            max_documents
+        )
+
     contents = documents["content"].tolist()
-    scores = reranker(query, contents)
+
+    # long paragraphs are cut to roughly max_tokens_per_document before they are sent to the reranker
+    # the stored num_tokens is used, so nothing has to be tokenized here
+    if max_tokens_per_document is not None and "num_tokens" in documents.columns:
+        contents = [
+            (
+                content[: int(len(content) * max_tokens_per_document / num_tokens)]
+                if num_tokens > max_tokens_per_document
+                else content
+            )
+            for content, num_tokens in zip(
+                contents, documents["num_tokens"].fillna(0).tolist()
+            )
+        ]
+
+    scores = reranker(query, contents, timeout=timeout)
     documents["rerank_score"] = scores
     return documents
 
@@ -17,7 +102,7 @@ def rerank_results(
 def generate_multiquery(
     query: str,
     num_multiquery: int,
-    openai_client: openai.Client,
+    openai_client: "openai.Client",
 ) -> list[str]:
 
     if num_multiquery < 2:
@@ -59,10 +144,62 @@ def generate_multiquery(
     return questions
 
 
+def maximal_marginal_relevance(
+    relevances: np.ndarray,
+    embeddings: np.ndarray,
+    top_n: int,
+    diversity: float = 0.5,
+) -> list[int]:
+    """
+    Greedily selects top_n indices which are relevant but not similar to the already selected ones.
+    diversity = 0 keeps the relevance order, diversity = 1 only maximizes the dissimilarity.
+    """
+    embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    similarities = embeddings @ embeddings.T
+
+    # the similarity of every candidate to its most similar selected candidate
+    max_similarities = np.full(len(relevances), -np.inf)
+    selected = np.zeros(len(relevances), dtype=bool)
+    selected_indices = []
+    for _ in range(min(top_n, len(relevances))):
+        if len(selected_indices) == 0:
+            mmr_scores = relevances.astype(float)
+        else:
+            mmr_scores = (1 - diversity) * relevances - diversity * max_similarities
+        mmr_scores[selected] = -np.inf
+
+        best_index = int(np.argmax(mmr_scores))
+        selected_indices.append(best_index)
+        selected[best_index] = True
+        max_similarities = np.maximum(max_similarities, similarities[best_index])
+
+    return selected_indices
+
+
+def _select_top_n(
+    documents: pd.DataFrame,
+    relevances: np.ndarray,
+    top_n: int,
+    diversity: float,
+) -> pd.DataFrame:
+    # without diversification the documents are already sorted by relevance
+    if diversity <= 0 or "embedding" not in documents.columns or len(documents) <= 1:
+        return documents.head(top_n)
+
+    selected_indices = maximal_marginal_relevance(
+        relevances,
+        np.stack(documents["embedding"].to_numpy()).astype(np.float32),
+        top_n,
+        diversity,
+    )
+    return documents.iloc[selected_indices]
+
+
 def process_results(
     documents: pd.DataFrame,
     top_n: int = 5,
     rerank_score_threshold: float = 0.0,
+    diversity: float = 0.0,
 ) -> pd.DataFrame:
 
     # rename the score column to distance, as the "score" is typically the return value of the vector search
@@ -75,7 +212,9 @@ def process_results(
             .query(f"rerank_score > {rerank_score_threshold}")
             .reset_index(drop=True)
             .sort_values(by=["rerank_score"], ascending=False)
-            .head(top_n)
+        )
+        documents = _select_top_n(
+            documents, documents["rerank_score"].to_numpy(), top_n, diversity
         )
         # rename the rerank_score column to score as this is the actual score we want to return
         # the score should always be a value between 0 and 1 and a high score indicates a high relevance
@@ -86,7 +225,9 @@ def process_results(
             documents.sort_values(by=["distance"], ascending=True)
             .reset_index(drop=True)
             .sort_values(by=["distance"], ascending=True)
-            .head(top_n)
+        )
+        documents = _select_top_n(
+            documents, 1 / (1 + documents["distance"].to_numpy()), top_n, diversity
         )
 
         # if the documents do not have a rerank_score, we can use the similarity score as the score
@@ -94,7 +235,8 @@ def process_results(
         # if distance is 0, the score will be 1, if distance is infinity, the score will be 0
         documents["score"] = documents["distance"].apply(lambda x: 1 / (1 + x))
 
-    return documents
+    # the embeddings are only needed for the diversification
+    return documents.drop(columns=["embedding"], errors="ignore")
 
 
 def poll_script(url, cookie=None):
@@ -0,0 +1,162 @@
+import re
+
+import chromadb
+
+from .chroma_functions import (
+    get_document_ids,
+    get_formulas,
+    get_paragraphs,
+    get_sections,
+    get_toc,
+)
+
+# longer queries are real questions and always go through the vector search
+# e.g. "Gleichung 3.13" is a lookup, "Wie folgt Gleichung 3.13 aus der Energieerhaltung?" is not
+MAX_ROUTED_QUERY_WORDS = 6
+
+# the citation keys of the frontend, see add_references_to_messsage
+# [EX1 15.7/1], [EX1 15.7 (1.3)] and [FEYNMAN2 4.2]
+SNIPPET_KEY_PATTERN = re.compile(r"\b([A-Z\d]+)\s(\d+)\.(\d+)\/(\d+)\b")
+FORMULA_KEY_PATTERN = re.compile(r"\b([A-Z\d]+)\s(\d+)\.(\d+)\s\((\d+(?:\.\d+)*)\)")
+SECTION_KEY_PATTERN = re.compile(r"\b([A-Z\d]+)\s(\d+)\.(\d+)\b(?!\s*[\/(])")
+
+# natural language lookups, e.g. "Gleichung 3.13", "Gl. (3.13)", "Kapitel 4.2" or "Inhaltsverzeichnis EX1"
+FORMULA_PATTERN = re.compile(
+    r"\b(?:Gleichung|Gl\.|Formel|Equation|Eq\.)\s*\(?(\d+(?:\.\d+)*)\)?",
+    re.IGNORECASE,
+)
+SECTION_PATTERN = re.compile(
+    r"\b(?:Kapitel|Sektion|Abschnitt|Chapter|Section)\s*(\d+)\.(\d+)\b",
+    re.IGNORECASE,
+)
+TOC_PATTERN = re.compile(
+    r"\b(?:Inhaltsverzeichnis|Table of contents|TOC)\b",
+    re.IGNORECASE,
+)
+
+
+def route_query(
+    query: str,
+    document_ids: list[str],
+) -> dict | None:
+    """
+    Detects structured lookups (formula, section, snippet and table of content) in the query.
+    document_ids are the documents which may be searched.
+    Returns the route with its parameters or None if the query should go through the vector search.
+    """
+    if len(query.split()) > MAX_ROUTED_QUERY_WORDS or len(document_ids) == 0:
+        return None
+
+    # explicitly mentioned documents restrict the lookup
+    mentioned_document_ids = [
+        document_id
+        for document_id in document_ids
+        if re.search(rf"\b{re.escape(document_id)}\b", query)
+    ]
+    lookup_document_ids = mentioned_document_ids or document_ids
+
+    if match := SNIPPET_KEY_PATTERN.search(query):
+        if match.group(1) in document_ids:
+            return {"route": "snippet", "ids": [".".join(match.groups())]}
+
+    if match := FORMULA_KEY_PATTERN.search(query):
+        if match.group(1) in document_ids:
+            return {
+                "route": "formula",
+                "document_ids": [match.group(1)],
+                "formula_id": match.group(4),
+            }
+
+    if match := SECTION_KEY_PATTERN.search(query):
+        if match.group(1) in document_ids:
+            return {
+                "route": "section",
+                "document_ids": [match.group(1)],
+                "chapter_id": match.group(2),
+                "section_id": match.group(3),
+            }
+
+    if match := FORMULA_PATTERN.search(query):
+        return {
+            "route": "formula",
+            "document_ids": lookup_document_ids,
+            "formula_id": match.group(1),
+        }
+
+    if match := SECTION_PATTERN.search(query):
+        return {
+            "route": "section",
+            "document_ids": lookup_document_ids,
+            "chapter_id": match.group(1),
+            "section_id": match.group(2),
+        }
+
+    # without a document the table of content is only unambiguous for a single document
+    if TOC_PATTERN.search(query) and len(lookup_document_ids) == 1:
+        return {"route": "toc", "document_ids": lookup_document_ids}
+
+    return None
+
+
+def lookup_route(
+    route: dict,
+    collection: chromadb.Collection,
+    top_n: int = 5,
+) -> dict | None:
+    """
+    Answers a routed query with direct key lookups instead of the vector search.
+    The documents have the same keys as the results of the vector search and a reference_type.
+    Returns None if nothing was found, the query then falls back to the vector search.
+    """
+    if route["route"] == "toc":
+        document_id = route["document_ids"][0]
+        toc = get_toc(collection, document_id)
+        if toc is None:
+            return None
+        return {"documents": [], "document_id": document_id, "toc": toc}
+
+    if route["route"] == "snippet":
+        documents = get_paragraphs(collection, route["ids"])
+        reference_type = "snippet"
+    elif route["route"] == "formula":
+        # the formula ids are stored with and without parentheses depending on the script
+        formula_id = route["formula_id"]
+        documents = get_formulas(
+            collection,
+            [formula_id, f"({formula_id})"],
+            route["document_ids"],
+        )
+        reference_type = "formula"
+    elif route["route"] == "section":
+        documents = get_sections(
+            collection,
+            route["chapter_id"],
+            route["section_id"],
+            route["document_ids"],
+        )
+        reference_type = "section"
+    else:
+        raise ValueError(f"Unknown route '{route['route']}'")
+
+    if len(documents) == 0:
+        return None
+
+    for document in documents:
+        # exact matches, the score is only kept for compatibility with the vector search
+        document.update(reference_type=reference_type, score=1.0)
+
+    return {"documents": documents[:top_n]}
+
+
+def get_routable_document_ids(
+    collection: chromadb.Collection,
+    permitted_document_ids: list[str] | None = None,
+) -> list[str]:
+    document_ids = get_document_ids(collection)
+    if permitted_document_ids is None:
+        return document_ids
+    return [
+        document_id
+        for document_id in document_ids
+        if document_id in permitted_document_ids
+    ]
@@ -0,0 +1,79 @@
+import functools
+import json
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable
+
+from pydantic import BaseModel
+
+# fields whose order does not change the result, every other field is keyed exactly
+UNORDERED_FIELDS = ["permitted_document_ids"]
+
+
+def normalize_request(value: Any) -> Any:
+    # requests which only differ in the order of the permitted documents produce the same result
+    if isinstance(value, BaseModel):
+        return normalize_request(value.model_dump())
+    if isinstance(value, dict):
+        return {
+            key: (
+                sorted(item)
+                if key in UNORDERED_FIELDS and isinstance(item, list)
+                else normalize_request(item)
+            )
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [normalize_request(item) for item in value]
+    return value
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls.
+    Only the first caller executes the function, all callers arriving while it runs share its result.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.calls: dict[str, Future] = {}
+        self.stats = {"executed": 0, "coalesced": 0}
+
+    def do(self, key: str, function: Callable, *args, **kwargs) -> Any:
+        with self.lock:
+            future = self.calls.get(key, None)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self.calls[key] = future
+                self.stats["executed"] += 1
+            else:
+                self.stats["coalesced"] += 1
+
+        if not is_leader:
+            # raises the exception of the leader as well, e.g. a 404
+            return future.result()
+
+        try:
+            result = function(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    def coalesce(self, endpoint_function: Callable) -> Callable:
+        # keyed by the endpoint and its normalized request body
+        @functools.wraps(endpoint_function)
+        def wrapper(**kwargs):
+            key = json.dumps(
+                [endpoint_function.__name__, normalize_request(kwargs)],
+                sort_keys=True,
+                default=str,
+            )
+            return self.do(key, endpoint_function, **kwargs)
+
+        return wrapper
@@ -0,0 +1,229 @@
+import json
+import os
+import shutil
+import tempfile
+
+import chromadb
+import numpy as np
+
+from .alias_functions import delete_collection_version
+from .chroma_functions import add_rows_to_collection
+
+# Layout of a snapshot file
+# MAGIC | uint64 header length | JSON header | padding | column 1 | padding | column 2 | ...
+# every column is aligned to ALIGNMENT bytes so it can be memory mapped directly
+# the header stores the offset and length of every column relative to the data start
+SNAPSHOT_MAGIC = b"LANDAUSNAP\x01"
+SNAPSHOT_VERSION = 1
+ALIGNMENT = 64
+STRING_COLUMNS = ["ids", "documents", "metadatas"]
+
+
+def _align(position: int) -> int:
+    return (position + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _pack_strings(
+    strings: list[str], start_offset: int = 0
+) -> tuple[np.ndarray, bytes]:
+    # strings are stored as one utf-8 blob and an offset array with len(strings) + 1 entries
+    # a batch continues the blob of the previous batches at start_offset
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = np.full(len(encoded) + 1, start_offset, dtype=np.uint64)
+    offsets[1:] += np.cumsum([len(blob) for blob in encoded], dtype=np.uint64)
+    return offsets, b"".join(encoded)
+
+
+class CollectionSnapshot:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.buffer = np.memmap(path, dtype=np.uint8, mode="r")
+
+        magic_length = len(SNAPSHOT_MAGIC)
+        if bytes(self.buffer[:magic_length]) != SNAPSHOT_MAGIC:
+            raise ValueError(f"'{path}' is not a collection snapshot")
+
+        header_length = int(
+            self.buffer[magic_length : magic_length + 8].view(np.uint64)[0]
+        )
+        header_start = magic_length + 8
+        self.header: dict = json.loads(
+            bytes(self.buffer[header_start : header_start + header_length])
+        )
+        self.data_start = _align(header_start + header_length)
+
+        self.collection_name: str = self.header["collection_name"]
+        self.collection_metadata: dict | None = self.header["collection_metadata"]
+        self.num_rows: int = self.header["num_rows"]
+        self.dim: int = self.header["dim"]
+
+    def _column(self, name: str) -> np.ndarray:
+        column = self.header["columns"][name]
+        start = self.data_start + column["offset"]
+        return self.buffer[start : start + column["length"]]
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        # an empty collection has no dimension to reshape to
+        if self.num_rows == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        # zero copy view into the memory mapped file
+        return self._column("embeddings").view(np.float32).reshape(-1, self.dim)
+
+    def strings(self, name: str, start: int = 0, stop: int | None = None) -> list[str]:
+        stop = self.num_rows if stop is None else stop
+        offsets = self._column(f"{name}_offsets").view(np.uint64)
+        blob = self._column(f"{name}_blob")
+        return [
+            bytes(blob[offsets[i] : offsets[i + 1]]).decode("utf-8")
+            for i in range(start, stop)
+        ]
+
+    def metadatas(self, start: int = 0, stop: int | None = None) -> list[dict]:
+        return [json.loads(string) for string in self.strings("metadatas", start, stop)]
+
+
+def export_collection_snapshot(
+    collection: chromadb.Collection,
+    path: str,
+    batch_size: int = 5000,
+) -> int:
+    count = collection.count()
+
+    # the columns are spooled batch by batch into temporary files, so only one batch is held in memory
+    column_names = ["embeddings"]
+    for name in STRING_COLUMNS:
+        column_names += [f"{name}_offsets", f"{name}_blob"]
+    column_files = {name: tempfile.TemporaryFile() for name in column_names}
+    blob_lengths = {name: 0 for name in STRING_COLUMNS}
+    num_rows, dim = 0, 0
+
+    try:
+        for offset in range(0, count, batch_size):
+            print(f"Exporting rows {offset} to {min(offset + batch_size, count)}...")
+            results = collection.get(
+                limit=batch_size,
+                offset=offset,
+                include=["embeddings", "documents", "metadatas"],
+            )
+            if len(results["ids"]) == 0:
+                break
+            embeddings = np.asarray(results["embeddings"], dtype=np.float32)
+            dim = int(embeddings.shape[1])
+            column_files["embeddings"].write(np.ascontiguousarray(embeddings).tobytes())
+
+            string_columns = {
+                "ids": results["ids"],
+                "documents": results["documents"],
+                "metadatas": [
+                    json.dumps(metadata) for metadata in results["metadatas"]
+                ],
+            }
+            for name, strings in string_columns.items():
+                offsets, blob = _pack_strings(strings, blob_lengths[name])
+                # the end offset of a batch is the start offset of the next one
+                if num_rows > 0:
+                    offsets = offsets[1:]
+                column_files[f"{name}_offsets"].write(offsets.tobytes())
+                column_files[f"{name}_blob"].write(blob)
+                blob_lengths[name] += len(blob)
+            num_rows += len(results["ids"])
+
+        if num_rows == 0:
+            # an empty collection still has one (zero) offset per string column
+            for name in STRING_COLUMNS:
+                column_files[f"{name}_offsets"].write(
+                    np.zeros(1, dtype=np.uint64).tobytes()
+                )
+
+        column_offsets = {}
+        position = 0
+        for name, column_file in column_files.items():
+            position = _align(position)
+            column_offsets[name] = {"offset": position, "length": column_file.tell()}
+            position += column_file.tell()
+
+        header = json.dumps(
+            {
+                "version": SNAPSHOT_VERSION,
+                "collection_name": collection.name,
+                "collection_metadata": collection.metadata,
+                "num_rows": num_rows,
+                "dim": dim,
+                "columns": column_offsets,
+            }
+        ).encode("utf-8")
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(np.uint64(len(header)).tobytes())
+            f.write(header)
+            data_start = _align(f.tell())
+            for name, column_file in column_files.items():
+                f.write(
+                    b"\0" * (data_start + column_offsets[name]["offset"] - f.tell())
+                )
+                column_file.seek(0)
+                shutil.copyfileobj(column_file, f)
+    finally:
+        for column_file in column_files.values():
+            column_file.close()
+
+    # only replace an existing snapshot once the new one is complete
+    os.replace(temp_path, path)
+    return num_rows
+
+
+def import_collection_snapshot(
+    path: str,
+    chroma_client: chromadb.ClientAPI,
+    collection_name: str | None = None,
+    overwrite: bool = False,
+    batch_size: int = 5000,
+) -> chromadb.Collection:
+    snapshot = CollectionSnapshot(path)
+    collection_name = collection_name or snapshot.collection_name
+
+    existing_names = [
+        collection.name for collection in chroma_client.list_collections()
+    ]
+    if collection_name in existing_names:
+        if not overwrite:
+            raise ValueError(
+                f"Collection '{collection_name}' already exists, use overwrite to replace it"
+            )
+        delete_collection_version(chroma_client, collection_name)
+
+    # hnsw settings can not be set through the metadata of a new collection
+    collection_metadata = {
+        key: value
+        for key, value in (snapshot.collection_metadata or {}).items()
+        if not key.startswith("hnsw:")
+    }
+    collection = chroma_client.create_collection(
+        name=collection_name,
+        metadata=collection_metadata or None,
+    )
+
+    try:
+        # the embeddings are read straight from the memory map, nothing is re-embedded
+        # this also restores the per-document partitions
+        for start in range(0, snapshot.num_rows, batch_size):
+            stop = min(start + batch_size, snapshot.num_rows)
+            print(f"Importing rows {start} to {stop}...")
+            add_rows_to_collection(
+                collection,
+                chroma_client,
+                snapshot.strings("ids", start, stop),
+                snapshot.embeddings[start:stop],
+                snapshot.strings("documents", start, stop),
+                snapshot.metadatas(start, stop),
+            )
+    except BaseException:
+        # do not leave a half imported collection and its partitions behind
+        delete_collection_version(chroma_client, collection_name)
+        raise
+
+    return collection
@@ -0,0 +1,65 @@
+import json
+import queue
+import zlib
+from typing import AsyncIterator, Iterator
+
+# Streaming upload format (NDJSON, optionally gzip compressed)
+# one paragraph per line, in the order of the script:
+# {"chapter": "1 Einleitung", "section": "1.1 Grundlagen", "content": "..."}
+RECORD_KEYS = ["chapter", "section", "content"]
+
+# put into the record queue once the upload is complete
+STREAM_END = None
+
+
+def script_to_records(script: dict) -> Iterator[dict]:
+    # the nested script format of ScriptInsert as a flat stream of records
+    for chapter_name in script:
+        for section_name in script[chapter_name]:
+            paragraphs = script[chapter_name][section_name]
+            for paragraph_id in sorted(paragraphs, key=int):
+                yield {
+                    "chapter": chapter_name,
+                    "section": section_name,
+                    "content": paragraphs[paragraph_id],
+                }
+
+
+def _parse_record(line: bytes) -> dict:
+    record = json.loads(line)
+    if not isinstance(record, dict) or any(key not in record for key in RECORD_KEYS):
+        raise ValueError(f"Every record needs the keys {RECORD_KEYS}, got {line[:200]}")
+    return record
+
+
+async def iter_ndjson_records(
+    chunks: AsyncIterator[bytes],
+    compressed: bool = False,
+) -> AsyncIterator[dict]:
+    # the body is parsed chunk by chunk, only the current incomplete line is buffered
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if compressed else None
+    buffer = b""
+    async for chunk in chunks:
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield _parse_record(line)
+
+    if decompressor is not None:
+        buffer += decompressor.flush()
+    if buffer.strip():
+        yield _parse_record(buffer)
+
+
+def iter_record_batches(record_queue: queue.Queue) -> Iterator[list[dict]]:
+    # consumed by the ingestion thread, an exception in the queue aborts the ingestion
+    while True:
+        batch = record_queue.get()
+        if batch is STREAM_END:
+            return
+        if isinstance(batch, Exception):
+            raise batch
+        yield batch
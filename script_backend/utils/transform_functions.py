@@ -1,7 +1,17 @@
+import functools
 import re
 
 import pandas as pd
-import tiktoken
+
+from .formula_functions import extract_latex, normalize_latex
+
+
+@functools.cache
+def get_encoder():
+    # tiktoken and its BPE ranks are only loaded on first use
+    import tiktoken
+
+    return tiktoken.get_encoding("o200k_base")
 
 
 def format_script(script: dict) -> dict:
@@ -100,13 +110,61 @@ def linting_script(script: dict) -> dict:
     return linted_script
 
 
+def paragraph_to_row(
+    chapter_name: str,
+    section_name: str,
+    paragraph_id: int,
+    paragraph: str,
+    script_name: str,
+    script_id: str,
+) -> dict:
+    num_tokens = len(get_encoder().encode(paragraph))
+
+    chapter_id = chapter_name.strip().split(" ")[0]
+    section_id = section_name.strip().split(" ")[0]
+
+    # the section always has the chapter index in it
+    section_id = section_id.replace(f"{chapter_id}.", "")
+
+    formula_id = ""
+    # christophs format
+    if paragraph.startswith("Gl. "):
+        try:
+            formula_id = paragraph.split("$$")[0].replace("Gl. ", "").strip()
+        except:
+            formula_id = ""
+
+    # the normalized LaTeX tokens are used by the formula index
+    formula_tokens = ""
+    if formula_id != "":
+        formula_tokens = " ".join(normalize_latex(extract_latex(paragraph)))
+
+    return {
+        # ID Keys
+        "id": f"{script_id}.{chapter_id}.{section_id}.{paragraph_id}",
+        "document_id": script_id,
+        "chapter_id": chapter_id,
+        "section_id": section_id,
+        "paragraph_id": paragraph_id,
+        "formula_id": formula_id,
+        "formula_tokens": formula_tokens,
+        # Name Keys
+        "document_name": script_name,
+        "chapter_name": chapter_name,
+        "section_name": section_name,
+        # Content Keys
+        "content": paragraph,
+        # Extra Keys
+        "num_tokens": num_tokens,
+    }
+
+
 def formatted_script_to_pandas(
     script: dict,
     script_name: str,
     script_id: str,
 ) -> pd.DataFrame:
     dataframe_list = []
-    encoder = tiktoken.get_encoding("o200k_base")
     for chapter_name in script:
         for section_name in script[chapter_name]:
             paragraph_ids, paragraphs = (
@@ -121,42 +179,15 @@ def formatted_script_to_pandas(
             paragraphs = [paragraphs[i] for i in sorted_paragraph_id_idx]
 
             for paragraph_id, paragraph in enumerate(paragraphs):
-                num_tokens = len(encoder.encode(paragraph))
-
-                chapter_id = chapter_name.strip().split(" ")[0]
-                section_id = section_name.strip().split(" ")[0]
-
-                # the section always has the chapter index in it
-                section_id = section_id.replace(f"{chapter_id}.", "")
-
-                formula_id = ""
-                # christophs format
-                if paragraph.startswith("Gl. "):
-                    try:
-                        formula_id = (
-                            paragraph.split("$$")[0].replace("Gl. ", "").strip()
-                        )
-                    except:
-                        formula_id = ""
-
                 dataframe_list.append(
-                    {
-                        # ID Keys
-                        "id": f"{script_id}.{chapter_id}.{section_id}.{paragraph_id}",
-                        "document_id": script_id,
-                        "chapter_id": chapter_id,
-                        "section_id": section_id,
-                        "paragraph_id": paragraph_id,
-                        "formula_id": formula_id,
-                        # Name Keys
-                        "document_name": script_name,
-                        "chapter_name": chapter_name,
-                        "section_name": section_name,
-                        # Content Keys
-                        "content": paragraph,
-                        # Extra Keys
-                        "num_tokens": num_tokens,
-                    }
+                    paragraph_to_row(
+                        chapter_name,
+                        section_name,
+                        paragraph_id,
+                        paragraph,
+                        script_name,
+                        script_id,
+                    )
                 )
     return pd.DataFrame(dataframe_list)
 
@@ -238,3 +269,19 @@ def add_embeddings(
     embeddings = embedding_function(contents)
     dataframe["embedding"] = embeddings
     return dataframe
+
+
+def preprocess_script(
+    script: dict,
+    script_name: str,
+    script_id: str,
+    format_and_lint: bool = False,
+) -> pd.DataFrame:
+    # the CPU bound part of the ingestion, runs in a worker process for bulk inserts
+    if format_and_lint:
+        script = linting_script(format_script(script))
+    return formatted_script_to_pandas(
+        script=script,
+        script_name=script_name,
+        script_id=script_id,
+    )
@@ -0,0 +1,106 @@
+import threading
+import time
+
+from .alias_functions import (
+    ALIAS_COLLECTION_NAME,
+    list_partition_names,
+    list_previous_collection_names,
+)
+from .formula_functions import get_formula_index
+from .provider_registry import ProviderRegistry
+from .transform_functions import get_encoder
+
+# shared between the warm-up thread and the readiness endpoint
+warmup_state = {
+    "ready": False,
+    "attempts": 0,
+    "duration": None,
+    "error": None,
+    # the reranker is optional, the results fall back to the vector scores
+    "reranker_failures": 0,
+    "reranker_error": None,
+}
+
+
+def warm_up_reranker(providers: ProviderRegistry) -> None:
+    try:
+        reranker = providers.get("reranker")
+        if reranker is not None:
+            print("Warm-up: Connecting to the reranking API...")
+            reranker.warm_up()
+        warmup_state["reranker_error"] = None
+    except Exception as e:
+        warmup_state["reranker_failures"] += 1
+        warmup_state["reranker_error"] = str(e)
+        print(f"Warm-up: Reranking API not reachable, continuing without it: {e}")
+
+
+def warm_up(providers: ProviderRegistry) -> None:
+    start_time = time.time()
+
+    print("Warm-up: Loading tiktoken encoding...")
+    get_encoder()
+
+    print("Warm-up: Connecting to chroma...")
+    chroma_client = providers.get("chroma_client")
+    chroma_client.heartbeat()
+
+    # the first calls construct the clients and open the TLS connections to the providers
+    print("Warm-up: Connecting to the embedding API...")
+    query_embeddings = providers.get("embedding_function")(["Warm-up Anfrage"])
+
+    # a failure does not block the readiness, it is reported in /metrics
+    warm_up_reranker(providers)
+
+    # a synthetic query makes chroma load the HNSW segment of every collection
+    # previous versions (and their partitions) are only kept for rollbacks and are not loaded
+    previous_names = set(list_previous_collection_names(chroma_client))
+    partition_names, skipped_names = set(), set()
+    # a partition name is always longer than the name of its collection,
+    # so every collection is visited before its partitions
+    collections = sorted(
+        chroma_client.list_collections(), key=lambda collection: len(collection.name)
+    )
+    for collection in collections:
+        if collection.name == ALIAS_COLLECTION_NAME or collection.name in skipped_names:
+            continue
+        is_partition = collection.name in partition_names
+        if not is_partition:
+            if collection.name in previous_names:
+                skipped_names.update(list_partition_names(collection))
+                continue
+            partition_names.update(list_partition_names(collection))
+        if collection.count() == 0:
+            continue
+
+        print(f"Warm-up: Querying collection '{collection.name}'...")
+        collection.query(query_embeddings=query_embeddings, n_results=1)
+
+        # the partitions only hold a copy of the rows, their formulas are already indexed
+        if not is_partition:
+            get_formula_index(collection)
+
+    warmup_state["duration"] = time.time() - start_time
+    print(f"Warm-up: Done in {warmup_state['duration']:.1f}s")
+
+
+def start_warm_up_thread(
+    providers: ProviderRegistry,
+    retry_interval: float = 10.0,
+) -> threading.Thread:
+    # runs in the background, so the server can already answer the readiness probe
+    def _warm_up_until_ready() -> None:
+        while not warmup_state["ready"]:
+            warmup_state["attempts"] += 1
+            try:
+                warm_up(providers)
+                warmup_state["error"] = None
+                warmup_state["ready"] = True
+            except Exception as e:
+                warmup_state["error"] = str(e)
+                print(f"Warm-up failed, retrying in {retry_interval}s: {e}")
+                time.sleep(retry_interval)
+
+    thread = threading.Thread(target=_warm_up_until_ready, daemon=True)
+    thread.start()
+    return thread
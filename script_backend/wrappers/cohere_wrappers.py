@@ -1,7 +1,73 @@
+import math
 import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from typing import Literal
 
-import cohere
+
+class RerankerUnavailable(Exception):
+    """Raised if the rerank failed or the circuit breaker is open, callers fall back to the vector scores."""
+
+
+class RerankBudgetExceeded(RerankerUnavailable):
+    """Raised if the time budget of the caller ran out before the rerank finished, it is not a failure of the provider."""
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and rejects all calls for reset_timeout seconds.
+    Afterwards a single trial call is let through (half open), its outcome closes or reopens the breaker.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state: Literal["closed", "open", "half_open"] = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if (
+                self.state == "open"
+                and time.monotonic() - self.opened_at > self.reset_timeout
+            ):
+                self.state = "half_open"
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.state = "closed"
+            self.consecutive_failures = 0
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.consecutive_failures += 1
+            if (
+                self.state == "half_open"
+                or self.consecutive_failures >= self.failure_threshold
+            ):
+                if self.state != "open":
+                    self.times_opened += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def release_trial(self) -> None:
+        # the trial call ended without a verdict, the next call becomes the trial
+        with self.lock:
+            if self.state == "half_open":
+                self.state = "open"
 
 
 class Cohere_Reranker:
@@ -16,15 +82,22 @@ class Cohere_Reranker:
             "rerank-multilingual-v2.0",
             "rerank-multilingual-v3.0",
         ] = "rerank-multilingual-v3.0",
+        timeout: float = 10.0,
+        use_hedging: bool = True,
+        min_hedge_delay: float = 1.0,
+        max_workers: int = 8,
+        max_documents_per_call: int = 32,
+        max_parallel_calls: int = 4,
     ) -> None:
 
         if reranking_api is None:
-            reranking_api = os.environ.get("USED_RERANKING_API", None).lower()
+            reranking_api = os.environ.get("USED_RERANKING_API", None)
             if reranking_api is None:
                 reranking_api = "cohere"
                 print(
                     f"WARNING: No reranking API specified, defaulting to {reranking_api}"
                 )
+            reranking_api = reranking_api.lower()
             if reranking_api not in ["cohere", "cohere_azure"]:
                 raise ValueError(
                     f"reranking_api must be 'cohere' or 'cohere_azure', not {reranking_api}"
@@ -45,28 +118,205 @@ class Cohere_Reranker:
                         "base_url must be provided as an argument or in the environment variable COHERE_BASE_URL if using the Azure API"
                     )
 
+        # imported here, so the backend does not pay for it if reranking is disabled
+        import cohere
+
         self.client = cohere.Client(
             api_key=api_key,
             base_url=base_url,
         )
         self.rerank_model = rerank_model
 
-    def __call__(
+        self.timeout = timeout
+        self.use_hedging = use_hedging
+        self.min_hedge_delay = min_hedge_delay
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # a separate pool for the chunks, they wait on the requests in self.executor
+        self.max_documents_per_call = max_documents_per_call
+        self.chunk_executor = ThreadPoolExecutor(max_workers=max_parallel_calls)
+        self.circuit_breaker = CircuitBreaker()
+        self.latencies = deque(maxlen=200)
+        self.stats = {
+            "calls": 0,
+            "chunks": 0,
+            "failures": 0,
+            "timeouts": 0,
+            "budget_exceeded": 0,
+            "short_circuited": 0,
+            "hedged": 0,
+            "hedge_wins": 0,
+        }
+
+    def hedge_delay(self) -> float:
+        # a second request is sent if the first one takes longer than the p95 latency
+        if len(self.latencies) < 20:
+            return self.min_hedge_delay
+        latencies = sorted(self.latencies)
+        return max(self.min_hedge_delay, latencies[int(0.95 * (len(latencies) - 1))])
+
+    def metrics(self) -> dict:
+        return {
+            **self.stats,
+            "hedge_rate": self.stats["hedged"] / max(1, self.stats["calls"]),
+            "hedge_delay": self.hedge_delay(),
+            "circuit_breaker_state": self.circuit_breaker.state,
+            "circuit_breaker_times_opened": self.circuit_breaker.times_opened,
+        }
+
+    def warm_up(self) -> None:
+        # opens the connection to the API, the outcome neither feeds the circuit breaker nor the latencies
+        self.client.rerank(
+            model=self.rerank_model,
+            query="Warm-up Anfrage",
+            documents=["Warm-up Dokument", "Warm-up Dokument"],
+            return_documents=False,
+            request_options={"timeout_in_seconds": max(1, math.ceil(self.timeout))},
+        )
+
+    def _rerank(
         self,
         query: str,
         documents: list[str],
+        timeout: float,
     ) -> list[float]:
-        if len(documents) < 2:
-            return [1.0 for _ in documents]
-
+        start_time = time.perf_counter()
         response = self.client.rerank(
             model=self.rerank_model,
             query=query,
             documents=documents,
             return_documents=False,
+            request_options={"timeout_in_seconds": max(1, math.ceil(timeout))},
         )
+        self.latencies.append(time.perf_counter() - start_time)
+
         scores = [0.0] * len(documents)
         for res in response.results:
             scores[res.index] = res.relevance_score
 
         return scores
+
+    def _hedged_rerank(
+        self,
+        query: str,
+        documents: list[str],
+        timeout: float,
+    ) -> list[float]:
+        if timeout <= 0:
+            # e.g. a chunk which waited for a free worker until the deadline passed
+            self.stats["timeouts"] += 1
+            raise TimeoutError("Rerank deadline passed before the request was sent")
+
+        deadline = time.perf_counter() + timeout
+        primary = self.executor.submit(self._rerank, query, documents, timeout)
+        futures = [primary]
+
+        hedge_delay = self.hedge_delay()
+        if self.use_hedging and hedge_delay < timeout:
+            done, _ = wait(futures, timeout=hedge_delay)
+            if not done:
+                self.stats["hedged"] += 1
+                futures.append(
+                    self.executor.submit(
+                        self._rerank,
+                        query,
+                        documents,
+                        deadline - time.perf_counter(),
+                    )
+                )
+
+        # the first successful response wins, the other one is ignored
+        error = None
+        while futures:
+            done, _ = wait(
+                futures,
+                timeout=max(0.0, deadline - time.perf_counter()),
+                return_when=FIRST_COMPLETED,
+            )
+            if not done:
+                self.stats["timeouts"] += 1
+                # requests which did not start yet do not need to hold a worker
+                for future in futures:
+                    future.cancel()
+                raise TimeoutError(f"Rerank did not finish within {timeout:.1f}s")
+
+            for future in done:
+                futures.remove(future)
+                if future.exception() is None:
+                    if future is not primary:
+                        self.stats["hedge_wins"] += 1
+                    return future.result()
+                error = future.exception()
+
+        raise error
+
+    def __call__(
+        self,
+        query: str,
+        documents: list[str],
+        timeout: float | None = None,
+    ) -> list[float]:
+        if len(documents) < 2:
+            return [1.0 for _ in documents]
+
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        self.stats["calls"] += 1
+
+        if not self.circuit_breaker.allow_request():
+            self.stats["short_circuited"] += 1
+            raise RerankerUnavailable("The circuit breaker of the reranker is open")
+
+        # large candidate lists are split into chunks which are reranked concurrently
+        # the relevance scores do not depend on the other documents, so they can simply be concatenated
+        chunks = [
+            documents[i : i + self.max_documents_per_call]
+            for i in range(0, len(documents), self.max_documents_per_call)
+        ]
+        self.stats["chunks"] += len(chunks)
+
+        # all chunks share one deadline, a chunk waiting for a worker only gets the remaining time
+        deadline = time.perf_counter() + timeout
+        try:
+            if len(chunks) == 1:
+                scores = self._hedged_rerank(query, documents, timeout)
+            else:
+                scores = []
+                for chunk_scores in self.chunk_executor.map(
+                    lambda chunk: self._hedged_rerank(
+                        query, chunk, deadline - time.perf_counter()
+                    ),
+                    chunks,
+                ):
+                    scores.extend(chunk_scores)
+        except TimeoutError as e:
+            if timeout < self.timeout:
+                # the budget of the caller ran out before the own timeout, this says nothing about the provider
+                self.stats["budget_exceeded"] += 1
+                self.circuit_breaker.release_trial()
+                raise RerankBudgetExceeded(
+                    f"Rerank did not finish within the remaining budget of {timeout:.2f}s"
+                ) from e
+            self.stats["failures"] += 1
+            self.circuit_breaker.record_failure()
+            raise RerankerUnavailable(f"Rerank failed: {e}") from e
+        except Exception as e:
+            self.stats["failures"] += 1
+            self.circuit_breaker.record_failure()
+            raise RerankerUnavailable(f"Rerank failed: {e}") from e
+
+        self.circuit_breaker.record_success()
+        return scores
+
+
+def create_reranker() -> Cohere_Reranker | None:
+    # USED_RERANKING_API=none disables the reranking, the vector scores are used instead
+    reranking_api = os.environ.get("USED_RERANKING_API", None)
+    if reranking_api is not None and reranking_api.lower() == "none":
+        print("WARNING: Reranking is disabled, falling back to the vector scores")
+        return None
+
+    try:
+        return Cohere_Reranker()
+    except ValueError as e:
+        # e.g. a missing COHERE_API_KEY, the queries must not fail because of the reranking
+        print(f"WARNING: {e}, falling back to the vector scores")
+        return None
@@ -3,7 +3,6 @@ import time
 from typing import Literal
 
 import chromadb
-from openai import AzureOpenAI, OpenAI
 
 
 class OpenAI_Embedding(chromadb.EmbeddingFunction):
@@ -32,6 +31,9 @@ class OpenAI_Embedding(chromadb.EmbeddingFunction):
         if azure_api_version is None:
             azure_api_version = os.getenv("AZURE_OPENAI_EMBEDDING_API_VERSION", None)
 
+        # imported here, so importing the backend stays fast
+        from openai import AzureOpenAI, OpenAI
+
         if used_api == "openai":
             self.client = OpenAI(api_key=api_key)
         elif used_api == "azure_openai":